@@ -4,4 +4,15 @@ from .trackcontrols import *
 from .oscillators import *
 from .noise import *
 from .wavefiles import *
-from .envelopes import *
\ No newline at end of file
+from .envelopes import *
+from .graph import *
+from .backends import *
+from .realtime import *
+from .unitgenerator import *
+from .samplecache import *
+from .profiling import *
+from .scheduler import *
+from .controlrate import *
+from .filters import *
+from .convolution import *
+from .batch import *
\ No newline at end of file
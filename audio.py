@@ -1,59 +1,182 @@
-import pyaudio
 import numpy as np
 import wave
 import os
+import time
+from .graph import ExecutionPlan
+from .unitgenerator import interleave, deinterleave
+from .backends import PyAudioBackend
+from .realtime import RealtimeEngine
 
 class AudioController(object):
-	def __init__(self,num_channels,sample_rate,buffer_size,listener = None,generator = None):
+	def __init__(self,num_channels,sample_rate,buffer_size,listener = None,generator = None,backend = None,render_ahead = None):
 		self.num_channels = num_channels
 		self.sample_rate = sample_rate
 		self.buffer_size = buffer_size
 
 		self.listener = listener
 		self.generator = generator
-
-		#Initialize pyaudio parameters
-		self.audio = pyaudio.PyAudio()
-		self.stream = self.audio.open(format = pyaudio.paFloat32,
-				 channels = self.num_channels,
-				 rate = self.sample_rate,
-				 frames_per_buffer = self.buffer_size,
-				 output = True,
-				 input = False)
+		self.plan = ExecutionPlan(generator) if generator else None
+		self.output_buffer = None
+
+		#Where the rendered audio goes. Defaults to playing through PortAudio, use a
+		#NullBackend to run without a sound device.
+		if backend is None:
+			backend = PyAudioBackend()
+		self.backend = backend
+
+		#With render_ahead set the controller runs in realtime mode: instead of polling
+		#update(), call start() and a render thread keeps render_ahead blocks queued up
+		#for the backend's callback.
+		if render_ahead is None:
+			self.engine = None
+			self.backend.open(self.num_channels,self.sample_rate,self.buffer_size)
+		else:
+			self.engine = RealtimeEngine(self,render_ahead)
+			self.backend.open(self.num_channels,self.sample_rate,self.buffer_size,callback=self.engine.callback)
 
 		#Used to determine if unitgenerators should move on in their generation or regenerate the last set of frames
 		self.frame_id = 0
 
 		self.playing = False
 
+		#Render timing of every block, to compare against the time the block lasts
+		self.reset_render_stats()
+
 	def set_generator(self,generator):
 		self.generator = generator
 		if self.generator.num_channels != self.num_channels:
 			raise TypeError("Master output to AudioController does not have the same amount of channels")
+		self.plan = ExecutionPlan(generator)
 
 	def remove_generator(self):
 		self.generator = None
+		self.plan = None
 
 	def close(self):
-		self.stream.stop_stream()
-		self.stream.close()
-		self.audio.close()
+		self.stop()
+		self.backend.close()
+
+	def start(self):
+		if not self.engine:
+			raise RuntimeError("AudioController needs render_ahead to run in realtime mode, use update() instead.")
+		if not self.playing:
+			self.engine.start()
+			self.backend.start()
+			self.playing = True
+
+	def stop(self):
+		if self.playing:
+			self.backend.stop()
+			self.engine.stop()
+			self.playing = False
+
+	# Seconds between audio being rendered and it coming out of the device
+	def get_latency(self):
+		if self.engine:
+			return self.engine.get_latency()
+		return self.backend.get_output_latency()
+
+	def get_underruns(self):
+		underruns = self.backend.underruns
+		if self.engine:
+			underruns += self.engine.underruns
+		return underruns
+
+	def reset_render_stats(self):
+		self.blocks_rendered = 0
+		self.late_blocks = 0
+		self.worst_render_time = 0.0
+		self.worst_render_load = 0.0
+
+	# How rendering is keeping up: late_blocks took longer to render than they last,
+	# worst_render_load is the worst render time as a fraction of its block's length.
+	def get_render_stats(self):
+		return {
+			"blocks": self.blocks_rendered,
+			"late_blocks": self.late_blocks,
+			"underruns": self.get_underruns(),
+			"worst_render_time": self.worst_render_time,
+			"worst_render_load": self.worst_render_load,
+		}
+
+	# Renders the next num_frames frames of the generator as a planar block (see
+	# UnitGenerator.get_buffer). The returned array may be reused by the generator for
+	# the next block.
+	def generate_block(self,num_frames):
+		if not self.generator:
+			raise ValueError("AudioController object has no generator to render.")
+		start = time.perf_counter()
+		(data,continue_flag) = self.plan.generate(self.frame_id,num_frames,self.sample_rate)
+		render_time = time.perf_counter() - start
+		self.frame_id = (self.frame_id + 1) % 2
+
+		self.blocks_rendered += 1
+		load = render_time*self.sample_rate/num_frames
+		if load > 1:
+			self.late_blocks += 1
+		if render_time > self.worst_render_time:
+			self.worst_render_time = render_time
+		if load > self.worst_render_load:
+			self.worst_render_load = load
+		return data
+
+	# Interleaved float32 copy of a planar block, the form the backends take. The
+	# returned array is reused for the next block.
+	def interleave(self,data):
+		size = data.size
+		if self.output_buffer is None or len(self.output_buffer) < size:
+			self.output_buffer = np.zeros(size,dtype=np.float32)
+		return interleave(data,self.output_buffer[:size])
+
+	# Renders the next num_frames frames of the generator as interleaved float32 data.
+	# The returned array is reused for the next block.
+	def next_block(self,num_frames):
+		return self.interleave(self.generate_block(num_frames))
 
 	def update(self):		
-		num_frames = self.stream.get_write_available()
+		if self.engine:
+			raise RuntimeError("AudioController is running in realtime mode, it does not need to be updated.")
+		num_frames = self.backend.get_write_available()
 		if num_frames > 0:
 			if self.generator:
-				(data,continue_flag) = self.generator.generate(self.frame_id,num_frames,self.sample_rate)
-				self.frame_id = (self.frame_id + 1) % 2
-				if data.dtype != np.float32:
-					data = data.astype(np.float32)
-				self.stream.write(data.tostring())
+				data = self.generate_block(num_frames)
+				self.backend.write(self.interleave(data))
 
 				if self.listener:
 					self.listener.add_audio(data, self.sample_rate,self.num_channels)
 			else:
 				raise ValueError("AudioController object has no generator to update.")
 
+	# Renders time seconds of audio in blocks of block_size frames (buffer_size by
+	# default) without touching the backend, handing each block to the listener if
+	# there is one. Yields every block as it is rendered, planar.
+	def render_planar_blocks(self,time,block_size = None):
+		if block_size is None:
+			block_size = self.buffer_size
+		remaining = int(round(time*self.sample_rate))
+		while remaining > 0:
+			num_frames = min(block_size,remaining)
+			data = self.generate_block(num_frames)
+			if self.listener:
+				self.listener.add_audio(data, self.sample_rate,self.num_channels)
+			remaining -= num_frames
+			yield data
+
+	# Same as render_planar_blocks, with every block interleaved
+	def render_blocks(self,time,block_size = None):
+		for data in self.render_planar_blocks(time,block_size):
+			yield self.interleave(data)
+
+	# Renders time seconds of audio as fast as possible into a single interleaved
+	# float32 array
+	def render_to_array(self,time,block_size = None):
+		output = np.empty(int(round(time*self.sample_rate))*self.num_channels,dtype=np.float32)
+		f = 0
+		for data in self.render_planar_blocks(time,block_size):
+			interleave(data,output[f:f+data.size])
+			f += data.size
+		return output
+
 	def render(self,time,sample_rate,verbose = True):
 		def print_progress(percentage):
 			toolbar_width = 40
@@ -73,19 +196,14 @@ class AudioController(object):
 		while(t<time):
 		
 			t+=1
-			if self.generator:
-				(data,continue_flag) = self.generator.generate(self.frame_id,sample_rate,self.sample_rate)
-				self.frame_id = (self.frame_id + 1) % 2
-				if data.dtype != np.float32:
-					data = data.astype(np.float32)
+			data = self.generate_block(sample_rate)
 
-				self.listener.add_audio(data, self.sample_rate,self.num_channels)
+			self.listener.add_audio(data, self.sample_rate,self.num_channels)
 			if verbose:
 				print_progress(t/time)
 
-			else:
-				raise ValueError("AudioController object has no generator to render.")
-		print()
+		if verbose:
+			print()
 		self.listener.stop()
 		print('Done rendering')
 
@@ -94,30 +212,34 @@ class AudioController(object):
 
 
 	def print_devices(self):
-		num_devices = self.audio.get_device_count()
-		for i in range(num_devices):
-			device_info = self.audio.get_device_info_by_index(i)
-			print(device_info)
-
-		num_apis = self.audio.get_host_api_count()
-		print(num_apis)
-		for i in range(num_apis):
-			print(self.audio.get_host_api_info_by_index(i))
+		self.backend.print_devices()
 
 class AudioWriter(object):
-	def __init__(self,num_channels, sample_rate, sample_width, filebase, output_type=".wav"):
+	def __init__(self,num_channels, sample_rate, sample_width, filebase, output_type=".wav", streaming=False, batch_frames=None, overwrite=False, verbose=True):
 		super(AudioWriter, self).__init__()
 
 		self.active = False
 
+		# With overwrite set an existing file at filebase is replaced without asking
+		# (for unattended renders), verbose prints what the writer is doing.
+		self.overwrite = overwrite
+		self.verbose = verbose
+
 		self.set_num_channels(num_channels)
 		self.set_sample_rate(sample_rate)
 		self.set_sample_width(sample_width)
 		self.filebase = filebase
 
 		self.write_filetype = {'.wav':self.wave_file_writer}
+		self.stream_filetype = {'.wav':self.wave_file_opener}
 		self.set_output_type(output_type)
 
+		# In streaming mode every block (or every batch_frames worth of blocks) is
+		# converted and written to disk as soon as it arrives instead of being kept in
+		# memory until stop(), so memory use does not grow with the recording length.
+		self.stream_file = None
+		self.set_streaming(streaming,batch_frames)
+
 
 
 		
@@ -153,6 +275,17 @@ class AudioWriter(object):
 			raise ValueError("AudioWriter currently only supports bit depths of 8, 16, or 32 for recording")
 		self.sample_width = sample_width
 
+	def set_streaming(self,streaming,batch_frames=None):
+		if self.active:
+			raise RuntimeError("Cannot change the streaming mode of the AudioWriter when the object is recording.")
+		if streaming and self.output_type not in self.stream_filetype:
+			error_str = "The file type "+self.output_type+" does not support streaming in the AudioWriter class."
+			raise ValueError(error_str)
+		if batch_frames is not None and batch_frames < 1:
+			raise ValueError("AudioWriter batch_frames must be at least one frame")
+		self.streaming = streaming
+		self.batch_frames = batch_frames
+
 	def set_sample_rate(self,sample_rate):
 		if self.active:
 			raise RuntimeError("Cannot set sample width of the AudioWriter when the object is recording.")
@@ -162,15 +295,46 @@ class AudioWriter(object):
 		if self.active:
 			if sample_rate != self.sample_rate:
 				raise ValueError("Source audio and AudioWriter do not share the same samplerate. Changing sample rates is currently not supported by the AudioWriter class.")
+			# Blocks are planar (channels, frames), interleaved ones are taken apart
+			if num_channels > 1 and data.ndim == 1:
+				data = deinterleave(data,num_channels)
+
 			# Downsample stereo to mono
 			if num_channels == 2 and self.num_channels == 1:
-				data = (data[0::2]+data[1::2])/2
+				data = (data[0]+data[1])/2
 
 			# Upsample mono to stereo
 			if num_channels == 1 and self.num_channels == 2:
-				data = np.array(list(zip(data,data)),dtype=data.dtype).flatten()
+				data = np.broadcast_to(data,(2,len(data)))
 
-			self.buffers.append(data)
+			if self.streaming:
+				self.stream_audio(data)
+			else:
+				# Generators reuse their output arrays from block to block, so keep a copy
+				self.buffers.append(np.array(data,dtype=np.float32))
+
+	def stream_audio(self,data):
+		# (frames, channels) view, which is interleaved once it is converted
+		frames = data.T if data.ndim == 2 else data[:,np.newaxis]
+		if self.batch_frames is None:
+			self.stream_file.writeframes(self.convert_samples(frames).tobytes())
+			return
+
+		# Copy into the batch buffer, writing it out every time it fills up
+		start = 0
+		while start < len(frames):
+			count = min(len(frames) - start, len(self.batch) - self.batch_fill)
+			self.batch[self.batch_fill:self.batch_fill+count] = frames[start:start+count]
+			self.batch_fill += count
+			start += count
+			if self.batch_fill == len(self.batch):
+				self.flush_batch()
+
+	def flush_batch(self):
+		if self.batch_fill > 0:
+			samples = self.convert_samples(self.batch[:self.batch_fill])
+			self.stream_file.writeframes(samples.tobytes())
+			self.batch_fill = 0
 
 	def toggle(self) :
 		if self.active:
@@ -180,25 +344,46 @@ class AudioWriter(object):
 
 	def start(self) :
 		if not self.active:
-			print('AudioWriter: starting to record audio stream')
-			self.active = True
+			if self.verbose:
+				print('AudioWriter: starting to record audio stream')
 			self.buffers = []
+			if self.streaming:
+				filename = self._get_filename()
+				if self.verbose:
+					print('AudioWriter: streaming audio to', filename)
+				self.stream_file = self.stream_filetype[self.output_type](filename)
+				if self.batch_frames is not None:
+					self.batch = np.empty((self.batch_frames,self.num_channels), dtype=np.float32)
+					self.batch_fill = 0
+			self.active = True
 
 	def stop(self) :
 		if self.active:
-			print('AudioWriter: stoped recording audio stream')
+			if self.verbose:
+				print('AudioWriter: stoped recording audio stream')
 			self.active = False
 
+			if self.streaming:
+				if self.batch_frames is not None:
+					self.flush_batch()
+					self.batch = None
+				# closing the file fills in the final length in the header
+				self.stream_file.close()
+				self.stream_file = None
+				return
+
 			output = self.combine_buffers()
 			if len(output) == 0:
-				print('AudioWriter: empty buffers. Nothing to write')
+				if self.verbose:
+					print('AudioWriter: empty buffers. Nothing to write')
 				return
 
 			self.write_file(output)
 
 	def write_file(self,output):
 		filename = self._get_filename()
-		print('AudioWriter: saving', len(output), 'samples in', filename)
+		if self.verbose:
+			print('AudioWriter: saving', len(output), 'samples in', filename)
 		self.write_filetype[self.output_type](output,filename)
 
 	# look for a filename that does not exist yet.
@@ -209,7 +394,7 @@ class AudioWriter(object):
 				filename = '%s%s' % (self.filebase, self.output_type)
 			else:
 				filename = '%s%d%s' % (self.filebase, suffix, self.output_type)
-			if not os.path.exists(filename) :
+			if self.overwrite or not os.path.exists(filename) :
 				return filename
 			else:
 				response = input("Filename " + filename + " already exists, would you like to overwrite? (y/n)")
@@ -219,27 +404,35 @@ class AudioWriter(object):
 					suffix += 1
 
 
-	# create single buffer from an array of buffers:
+	# create single interleaved buffer from an array of planar buffers:
 	def combine_buffers(self):
 		size = 0
 		for b in self.buffers:
-			size += len(b)
+			size += b.size
 
 		# create a single output buffer of the right size
 		output = np.empty( size, dtype=np.float32 )
 		f = 0
 		for b in self.buffers:
-			output[f:f+len(b)] = b
-			f += len(b)
+			interleave(b,output[f:f+b.size])
+			f += b.size
 		return output
 
 
+	# scale floating point samples in [-1, 1] to the integer type of the output file.
+	# Samples past full scale are clipped rather than left to wrap around.
+	def convert_samples(self,buf):
+		buf = np.clip(buf,-1,1)*(2**(8*self.sample_width-1)-.5)-.5
+		return buf.astype(self.sample_type)
+
 	def wave_file_writer(self,buf, name):
+		f = self.wave_file_opener(name)
+		f.writeframes(self.convert_samples(buf).tobytes())
+		f.close()
+
+	def wave_file_opener(self,name):
 		f = wave.open(name, 'w')
 		f.setnchannels(self.num_channels)
 		f.setsampwidth(self.sample_width)
 		f.setframerate(self.sample_rate)
-
-		buf = buf*(2**(8*self.sample_width-1)-.5)-.5
-		buf = buf.astype(self.sample_type)
-		f.writeframes(buf.tostring())
\ No newline at end of file
+		return f
\ No newline at end of file
@@ -0,0 +1,181 @@
+import threading
+import time
+import numpy as np
+
+# An AudioBackend is where the AudioController sends its finished blocks of
+# (interleaved, float32) audio. A backend needs to support:
+#
+# open(num_channels, sample_rate, buffer_size, callback=None)
+# get_write_available()   number of frames that can be written without blocking
+# write(data)
+# close()
+#
+# Backends that can tell when the device ran out of audio count it in underruns.
+#
+# If a callback is given to open(), the backend pulls audio instead: once start() is
+# called it calls callback(num_frames) from its own thread whenever the device needs
+# more audio, and plays the interleaved float32 array that comes back.
+class AudioBackend(object):
+	def __init__(self):
+		super(AudioBackend, self).__init__()
+		self.num_channels = None
+		self.sample_rate = None
+		self.buffer_size = None
+		self.callback = None
+		self.underruns = 0
+
+	def open(self,num_channels,sample_rate,buffer_size,callback=None):
+		self.num_channels = num_channels
+		self.sample_rate = sample_rate
+		self.buffer_size = buffer_size
+		self.callback = callback
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	# Seconds of audio the device buffers after it has been handed a block
+	def get_output_latency(self):
+		return 0.0
+
+	def get_write_available(self):
+		raise ValueError("Did not properly set up get_write_available function on class ", self.__class__)
+
+	def write(self,data):
+		raise ValueError("Did not properly set up write function on class ", self.__class__)
+
+	def close(self):
+		pass
+
+	def print_devices(self):
+		print(self.__class__.__name__, "does not use any audio devices")
+
+# Plays audio through PortAudio. pyaudio is only imported once the backend is
+# opened, so the rest of ocelot can be used on machines without PortAudio.
+class PyAudioBackend(AudioBackend):
+	def __init__(self):
+		super(PyAudioBackend, self).__init__()
+		self.audio = None
+		self.stream = None
+		self.pyaudio = None
+
+	def open(self,num_channels,sample_rate,buffer_size,callback=None):
+		super(PyAudioBackend, self).open(num_channels,sample_rate,buffer_size,callback)
+		import pyaudio
+		self.pyaudio = pyaudio
+
+		stream_callback = None
+		if callback:
+			def stream_callback(in_data, frame_count, time_info, status):
+				return (callback(frame_count).tobytes(), pyaudio.paContinue)
+
+		self.audio = pyaudio.PyAudio()
+		self.stream = self.audio.open(format = pyaudio.paFloat32,
+				 channels = num_channels,
+				 rate = sample_rate,
+				 frames_per_buffer = buffer_size,
+				 output = True,
+				 input = False,
+				 start = callback is None,
+				 stream_callback = stream_callback)
+
+	def start(self):
+		self.stream.start_stream()
+
+	def stop(self):
+		self.stream.stop_stream()
+
+	def get_output_latency(self):
+		return self.stream.get_output_latency()
+
+	def get_write_available(self):
+		return self.stream.get_write_available()
+
+	def write(self,data):
+		try:
+			self.stream.write(data.tobytes(),exception_on_underflow=True)
+		except IOError as error:
+			# PortAudio still plays the block, it just reports that the device ran
+			# dry before it arrived
+			if error.errno != self.pyaudio.paOutputUnderflowed:
+				raise
+			self.underruns += 1
+
+	def close(self):
+		if self.stream:
+			self.stream.stop_stream()
+			self.stream.close()
+			self.stream = None
+		if self.audio:
+			self.audio.terminate()
+			self.audio = None
+
+	def print_devices(self):
+		if self.audio is None:
+			raise RuntimeError("PyAudioBackend has not been opened.")
+		num_devices = self.audio.get_device_count()
+		for i in range(num_devices):
+			device_info = self.audio.get_device_info_by_index(i)
+			print(device_info)
+
+		num_apis = self.audio.get_host_api_count()
+		print(num_apis)
+		for i in range(num_apis):
+			print(self.audio.get_host_api_info_by_index(i))
+
+# Headless backend with no audio device behind it. It always has room for another
+# block, so AudioController.update() renders as fast as the CPU allows. Written
+# blocks are thrown away unless keep_blocks is set, in which case they can be
+# collected with get_audio().
+#
+# In callback mode a thread stands in for the device, asking for a block every
+# buffer_size/sample_rate seconds.
+class NullBackend(AudioBackend):
+	def __init__(self,keep_blocks=False):
+		super(NullBackend, self).__init__()
+		self.keep_blocks = keep_blocks
+		self.blocks = []
+		self.frames_written = 0
+		self.running = False
+		self.thread = None
+
+	def start(self):
+		if self.callback and not self.running:
+			self.running = True
+			self.thread = threading.Thread(target=self.device_loop,name="ocelot null device",daemon=True)
+			self.thread.start()
+
+	def stop(self):
+		self.running = False
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+	def close(self):
+		self.stop()
+
+	def device_loop(self):
+		block_time = self.buffer_size/float(self.sample_rate)
+		next_time = time.perf_counter()
+		while self.running:
+			self.write(self.callback(self.buffer_size))
+			next_time += block_time
+			time.sleep(max(0,next_time - time.perf_counter()))
+
+	def get_write_available(self):
+		return self.buffer_size
+
+	def write(self,data):
+		self.frames_written += len(data) // self.num_channels
+		if self.keep_blocks:
+			self.blocks.append(np.array(data,dtype=np.float32))
+
+	def get_audio(self):
+		if not self.blocks:
+			return np.zeros(0,dtype=np.float32)
+		return np.concatenate(self.blocks)
+
+	def clear(self):
+		self.blocks = []
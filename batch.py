@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .audio import AudioController, AudioWriter
+from .backends import NullBackend
+from .noise import set_noise_seed
+
+# One patch to render offline. factory is called with no arguments inside the worker
+# process and returns the generator to render, so it has to be picklable: a module
+# level function, a class, or a functools.partial of one. With a filename (a .wav
+# path) the audio is streamed to that file, otherwise the job comes back as an
+# interleaved float32 array. seed overrides the seed the batch hands the job.
+class RenderJob(object):
+	def __init__(self,factory,time,filename = None,num_channels = 2,seed = None):
+		super(RenderJob, self).__init__()
+		self.factory = factory
+		self.time = time
+		self.filename = filename
+		self.num_channels = num_channels
+		self.seed = seed
+
+# Aggregate progress of a batch, handed to the progress callback after every job
+class BatchProgress(object):
+	def __init__(self,total,total_frames,sample_rate):
+		super(BatchProgress, self).__init__()
+		self.total = total
+		self.done = 0
+		self.total_frames = total_frames
+		self.frames = 0
+		self.sample_rate = sample_rate
+		self.start_time = time.perf_counter()
+		self.elapsed = 0.0
+
+	def update(self,frames):
+		self.done += 1
+		self.frames += frames
+		self.elapsed = time.perf_counter() - self.start_time
+
+	# Seconds of audio rendered per second of wall time, over all workers
+	def get_realtime_factor(self):
+		if self.elapsed <= 0:
+			return 0.0
+		return self.frames/float(self.sample_rate)/self.elapsed
+
+	def get_fraction(self):
+		return self.frames/float(self.total_frames) if self.total_frames else 1.0
+
+def print_progress(progress):
+	toolbar_width = 40
+	filled = int(progress.get_fraction()*toolbar_width)
+	line = "Batch progress [%s%s] %d/%d jobs, %.1fx realtime" % ("%"*filled," "*(toolbar_width-filled),
+		progress.done,progress.total,progress.get_realtime_factor())
+	print(line,end='\n' if progress.done == progress.total else '\r')
+	sys.stdout.flush()
+
+# Seed of job index in a batch seeded with seed. It only depends on the two of them,
+# so a job renders the same wherever it sits in the batch and whichever worker runs it.
+def get_job_seed(seed,index):
+	return np.random.SeedSequence(seed,spawn_key=(index,))
+
+# Renders one job in the current process. The noise seed is set before the factory
+# runs, so every noise generator the patch makes gets a reproducible stream.
+def render_job(job,seed,sample_rate,block_size = 1024,sample_width = 2):
+	set_noise_seed(seed if job.seed is None else job.seed)
+	generator = job.factory()
+	if generator.num_channels != job.num_channels:
+		raise TypeError("Render job makes a "+str(generator.num_channels)+" channel generator, not "+str(job.num_channels))
+
+	writer = None
+	if job.filename is not None:
+		(filebase,output_type) = os.path.splitext(job.filename)
+		writer = AudioWriter(job.num_channels,sample_rate,sample_width,filebase,output_type or ".wav",
+			streaming=True,batch_frames=max(block_size,sample_rate),overwrite=True,verbose=False)
+	controller = AudioController(job.num_channels,sample_rate,block_size,listener=writer,generator=generator,backend=NullBackend())
+	try:
+		if writer:
+			writer.start()
+			for data in controller.render_planar_blocks(job.time):
+				pass
+			writer.stop()
+			result = job.filename
+		else:
+			result = controller.render_to_array(job.time)
+	finally:
+		controller.close()
+	return result
+
+def _render_job(index,job,seed,sample_rate,block_size,sample_width):
+	return (index,render_job(job,seed,sample_rate,block_size,sample_width))
+
+# Renders every job across a pool of processes (one per core by default) and
+# returns their results in job order: the filename for jobs written to disk and the
+# interleaved float32 array for the others. Jobs are seeded from seed by their
+# position in the list (see get_job_seed), so the same batch renders the same audio
+# every time. progress is called with a BatchProgress after every finished job; it
+# defaults to a progress line on stdout, pass False for none.
+#
+# Every process renders whole jobs on its own, so a batch of many jobs scales with
+# the number of cores. Numpy's own threading (BLAS) is best limited to one thread
+# per process (OMP_NUM_THREADS=1) so the workers do not compete for the cores.
+def render_batch(jobs,sample_rate = 44100,block_size = 1024,processes = None,seed = 0,sample_width = 2,progress = None):
+	jobs = list(jobs)
+	if progress is None:
+		progress = print_progress
+	total_frames = sum(int(round(job.time*sample_rate)) for job in jobs)
+	status = BatchProgress(len(jobs),total_frames,sample_rate)
+	results = [None]*len(jobs)
+	if not jobs:
+		return results
+	with ProcessPoolExecutor(max_workers=processes) as pool:
+		futures = [pool.submit(_render_job,index,job,get_job_seed(seed,index),sample_rate,block_size,sample_width)
+			for (index,job) in enumerate(jobs)]
+		try:
+			for future in as_completed(futures):
+				(index,result) = future.result()
+				results[index] = result
+				status.update(int(round(jobs[index].time*sample_rate)))
+				if progress:
+					progress(status)
+		except BaseException:
+			for future in futures:
+				future.cancel()
+			raise
+	return results
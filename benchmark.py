@@ -0,0 +1,308 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+from .unitgenerator import UnitGenerator, set_sample_dtype
+from .graph import ExecutionPlan
+from .oscillators import SineGen
+from .noise import NoiseGen, PinkNoise, BrownNoise
+from .envelopes import Envelope
+from .trackcontrols import Mixer, Panner, MonoToStereo
+from .wavefiles import WaveFile, WaveGenerator
+from .audio import AudioWriter
+from .filters import Biquad, FilterBank
+from .convolution import Convolver, ImpulseResponse
+
+# Benchmarks for the built-in generators and for synthetic graphs of growing width
+# and depth. Run it with
+#
+#   python -m ocelot.benchmark --output results.json
+#   python -m ocelot.benchmark --compare results.json
+#
+# Every case is built fresh for each block size, warmed up, and then run for a
+# number of blocks through an ExecutionPlan, the same way AudioController does.
+# Reported per case and block size:
+#   ns_per_sample        median time per block divided by its number of frames
+#   worst_ns_per_sample  the same for the slowest block
+#   realtime_factor      seconds of audio produced per second of compute (median)
+#   alloc_bytes          bytes allocated and released again inside one block (peak
+#                        traced by tracemalloc, which numpy reports its arrays to)
+#   retained_bytes       bytes still allocated after all blocks, per block
+
+SAMPLE_RATE = 44100
+BLOCK_SIZES = [64, 256, 1024, 4096]
+WIDTHS = [1, 4, 16, 64]
+DEPTHS = [1, 4, 16, 64]
+
+# Gets removed when the process exits
+_wave_dir = None
+
+def _wave_file(seconds,num_channels,sample_rate):
+	global _wave_dir
+	if _wave_dir is None:
+		_wave_dir = tempfile.TemporaryDirectory(prefix="ocelot-benchmark-")
+	filename = os.path.join(_wave_dir.name,"noise%d.wav" % num_channels)
+	if not os.path.exists(filename):
+		rng = np.random.default_rng(0)
+		samples = rng.uniform(-.5,.5,int(seconds*sample_rate)*num_channels)
+		f = wave.open(filename,'w')
+		f.setnchannels(num_channels)
+		f.setsampwidth(2)
+		f.setframerate(sample_rate)
+		f.writeframes((samples*32767).astype(np.int16).tobytes())
+		f.close()
+	return filename
+
+def _envelope():
+	rng = np.random.default_rng(0)
+	return Envelope([[0,0],[.01,1]],find_next_point = lambda point: (point[0]+.01,rng.uniform(0,1)))
+
+def _chain(length):
+	sig = SineGen(220)
+	for i in range(length):
+		sig = sig*SineGen(110*(i+2)) + SineGen(55*(i+2))*.5
+	return sig
+
+def _width(width):
+	return Mixer([Panner(SineGen(110*(i+1)),i/max(1,width-1)) for i in range(width)])
+
+# Nested mixers, each one adding a single new branch to everything below it
+def _depth(depth):
+	sig = Panner(SineGen(220),.5)
+	for i in range(depth):
+		sig = Mixer([sig,Panner(SineGen(110*(i+2)),.5)],gain=.5)
+	return sig
+
+def _filter_bank():
+	bank = FilterBank("lowpass",q=2)
+	for i in range(8):
+		bank.add(NoiseGen(seed=i),cutoff=SineGen(i+1)*300+1000)
+	return bank
+
+# decaying noise, like a reverb tail
+def _impulse_response(seconds):
+	num_frames = int(seconds*SAMPLE_RATE)
+	rng = np.random.default_rng(0)
+	return ImpulseResponse(rng.standard_normal(num_frames)*np.exp(-6*np.arange(num_frames)/num_frames))
+
+GENERATORS = {
+	"SineGen": lambda: SineGen(440),
+	"NoiseGen": lambda: NoiseGen(seed=0),
+	"PinkNoise": lambda: PinkNoise(seed=0),
+	"BrownNoise": lambda: BrownNoise(seed=0),
+	"Envelope": _envelope,
+	"Mixer": lambda: Mixer([Panner(SineGen(110*(i+1)),.5) for i in range(8)]),
+	"Mixer(parallel)": lambda: Mixer([Panner(SineGen(110*(i+1)),.5) for i in range(8)],parallel=True),
+	"Panner": lambda: Panner(SineGen(440),.3),
+	"Add": lambda: SineGen(440) + SineGen(660),
+	"Multiply": lambda: SineGen(440) * SineGen(660),
+	"AddMultiplyChain": lambda: _chain(8),
+	"Biquad": lambda: Biquad(NoiseGen(seed=0),"lowpass",1000,2),
+	"Biquad(modulated)": lambda: Biquad(NoiseGen(seed=0),"lowpass",SineGen(2)*800+1200,2),
+	"FilterBank": _filter_bank,
+	"Convolver(1s)": lambda: Convolver(NoiseGen(seed=0),_impulse_response(1)),
+	"Convolver(4s)": lambda: Convolver(NoiseGen(seed=0),_impulse_response(4)),
+	"WaveGenerator": lambda: WaveGenerator(WaveFile(_wave_file(10,2,SAMPLE_RATE)),loop=True),
+}
+
+def get_cases(widths=WIDTHS,depths=DEPTHS):
+	cases = dict(GENERATORS)
+	for width in widths:
+		cases["width%d" % width] = (lambda width: lambda: _width(width))(width)
+	for depth in depths:
+		cases["depth%d" % depth] = (lambda depth: lambda: _depth(depth))(depth)
+	return cases
+
+# Runs num_blocks blocks through step(frame_id,num_frames) and returns the time of
+# each block in nanoseconds.
+def _time_blocks(step,num_frames,num_blocks,warmup):
+	frame_id = 0
+	for i in range(warmup):
+		step(frame_id,num_frames)
+		frame_id = (frame_id + 1) % 2
+	times = np.empty(num_blocks,dtype=np.int64)
+	for i in range(num_blocks):
+		start = time.perf_counter_ns()
+		step(frame_id,num_frames)
+		times[i] = time.perf_counter_ns() - start
+		frame_id = (frame_id + 1) % 2
+	return times
+
+def _count_allocations(step,num_frames,num_blocks,warmup):
+	frame_id = 0
+	for i in range(warmup):
+		step(frame_id,num_frames)
+		frame_id = (frame_id + 1) % 2
+	tracemalloc.start()
+	try:
+		(retained_start,peak) = tracemalloc.get_traced_memory()
+		transient = 0
+		for i in range(num_blocks):
+			tracemalloc.reset_peak()
+			(current,peak) = tracemalloc.get_traced_memory()
+			step(frame_id,num_frames)
+			(after,peak) = tracemalloc.get_traced_memory()
+			transient += peak - current
+			frame_id = (frame_id + 1) % 2
+		(retained_end,peak) = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return (transient/num_blocks,(retained_end - retained_start)/num_blocks)
+
+def _result(name,num_frames,num_channels,sample_rate,times,allocations):
+	median = float(np.median(times))
+	worst = float(np.max(times))
+	return {
+		"name": name,
+		"block_size": num_frames,
+		"num_channels": num_channels,
+		"ns_per_sample": median/num_frames,
+		"worst_ns_per_sample": worst/num_frames,
+		"realtime_factor": (num_frames/sample_rate)/(median*1e-9),
+		"worst_realtime_factor": (num_frames/sample_rate)/(worst*1e-9),
+		"alloc_bytes": allocations[0],
+		"retained_bytes": allocations[1],
+	}
+
+def run_case(name,factory,num_frames,sample_rate=SAMPLE_RATE,seconds=1.0,warmup=8,optimize=True):
+	num_blocks = max(16,int(seconds*sample_rate/num_frames))
+	generator = factory()
+	plan = ExecutionPlan(generator,optimize=optimize)
+	step = lambda frame_id,num_frames: plan.generate(frame_id,num_frames,sample_rate)
+	times = _time_blocks(step,num_frames,num_blocks,warmup)
+	allocations = _count_allocations(step,num_frames,min(num_blocks,64),0)
+	num_channels = generator.num_channels
+	if getattr(generator,'executor',None):
+		generator.set_parallel(False)
+	return _result(name,num_frames,num_channels,sample_rate,times,allocations)
+
+# AudioWriter is not a generator, so it is timed on add_audio() with a block of
+# stereo audio, both keeping blocks in memory and streaming them to a file.
+def run_writer(streaming,num_frames,sample_rate=SAMPLE_RATE,seconds=1.0,warmup=8):
+	num_blocks = max(16,int(seconds*sample_rate/num_frames))
+	data = MonoToStereo(SineGen(440)).generate(0,num_frames,sample_rate)[0].copy()
+	with tempfile.TemporaryDirectory(prefix="ocelot-benchmark-") as directory:
+		with contextlib.redirect_stdout(io.StringIO()):
+			writer = AudioWriter(2,sample_rate,2,os.path.join(directory,"out"),streaming=streaming)
+			writer.start()
+			step = lambda frame_id,num_frames: writer.add_audio(data,sample_rate,2)
+			times = _time_blocks(step,num_frames,num_blocks,warmup)
+			allocations = _count_allocations(step,num_frames,min(num_blocks,64),0)
+			writer.stop()
+	name = "AudioWriter(streaming)" if streaming else "AudioWriter"
+	return _result(name,num_frames,2,sample_rate,times,allocations)
+
+def get_metadata(sample_rate,optimize):
+	try:
+		commit = subprocess.run(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),
+			capture_output=True,text=True,timeout=5).stdout.strip() or None
+	except (OSError,subprocess.SubprocessError):
+		commit = None
+	return {
+		"commit": commit,
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"processor": platform.processor(),
+		"cpu_count": os.cpu_count(),
+		"sample_rate": sample_rate,
+		"dtype": np.dtype(UnitGenerator.dtype).name,
+		"optimize": optimize,
+	}
+
+def run(block_sizes=BLOCK_SIZES,sample_rate=SAMPLE_RATE,seconds=1.0,optimize=True,names=None,widths=WIDTHS,depths=DEPTHS,verbose=True):
+	cases = get_cases(widths,depths)
+	results = []
+	for num_frames in block_sizes:
+		for (name,factory) in cases.items():
+			if names and not any(n in name for n in names):
+				continue
+			results.append(run_case(name,factory,num_frames,sample_rate,seconds,optimize=optimize))
+			if verbose:
+				print_result(results[-1])
+		for streaming in (False,True):
+			name = "AudioWriter(streaming)" if streaming else "AudioWriter"
+			if names and not any(n in name for n in names):
+				continue
+			results.append(run_writer(streaming,num_frames,sample_rate,seconds))
+			if verbose:
+				print_result(results[-1])
+	return {"metadata": get_metadata(sample_rate,optimize), "results": results}
+
+def print_result(result):
+	print("%-24s %6d  %10.2f ns/sample  %10.2f worst  %9.1fx realtime  %10.0f B/block" % (
+		result["name"],result["block_size"],result["ns_per_sample"],result["worst_ns_per_sample"],
+		result["realtime_factor"],result["alloc_bytes"]))
+
+def save(report,filename):
+	with open(filename,'w') as f:
+		json.dump(report,f,indent=1)
+
+def load(filename):
+	with open(filename) as f:
+		return json.load(f)
+
+# Matches results by case and block size and returns the ones that got more than
+# threshold (a fraction) slower in ns/sample, along with the full comparison.
+def compare(old,new,threshold=.1):
+	old_results = {(r["name"],r["block_size"]): r for r in old["results"]}
+	rows = []
+	regressions = []
+	for result in new["results"]:
+		key = (result["name"],result["block_size"])
+		if key not in old_results:
+			continue
+		before = old_results[key]["ns_per_sample"]
+		change = result["ns_per_sample"]/before - 1
+		row = (result["name"],result["block_size"],before,result["ns_per_sample"],change)
+		rows.append(row)
+		if change > threshold:
+			regressions.append(row)
+	return (rows,regressions)
+
+def print_comparison(rows,threshold):
+	for (name,block_size,before,after,change) in rows:
+		flag = "  REGRESSION" if change > threshold else ""
+		print("%-24s %6d  %10.2f -> %10.2f ns/sample  %+7.1f%%%s" % (name,block_size,before,after,change*100,flag))
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="python -m ocelot.benchmark",description="Time the Ocelot generators and graphs.")
+	parser.add_argument("--block-sizes",type=int,nargs="+",default=BLOCK_SIZES)
+	parser.add_argument("--sample-rate",type=int,default=SAMPLE_RATE)
+	parser.add_argument("--seconds",type=float,default=1.0,help="audio rendered per case and block size")
+	parser.add_argument("--widths",type=int,nargs="*",default=WIDTHS)
+	parser.add_argument("--depths",type=int,nargs="*",default=DEPTHS)
+	parser.add_argument("--only",nargs="+",help="only run cases whose name contains one of these")
+	parser.add_argument("--dtype",choices=["float32","float64"],default=None)
+	parser.add_argument("--no-optimize",action="store_true",help="run the graphs without optimize()")
+	parser.add_argument("--output",help="save the results as JSON")
+	parser.add_argument("--compare",help="JSON results of an earlier run to compare against")
+	parser.add_argument("--threshold",type=float,default=10.0,help="percent slowdown counted as a regression")
+	args = parser.parse_args(args)
+
+	if args.dtype:
+		set_sample_dtype(args.dtype)
+	report = run(args.block_sizes,args.sample_rate,args.seconds,not args.no_optimize,args.only,args.widths,args.depths)
+	if args.output:
+		save(report,args.output)
+	if args.compare:
+		(rows,regressions) = compare(load(args.compare),report,args.threshold/100)
+		print()
+		print_comparison(rows,args.threshold/100)
+		if regressions:
+			print("%d regressions over %g%%" % (len(regressions),args.threshold))
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
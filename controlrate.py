@@ -0,0 +1,97 @@
+import numpy as np
+from .unitgenerator import UnitGenerator
+from .graph import ExecutionPlan
+
+# Runs a slowly changing generator (an envelope, an LFO, a frequency modulator) at a
+# control rate decimation times lower than the audio rate, and brings it back up to
+# audio rate for whatever uses it. The generator only computes one value every
+# decimation frames, so it costs that many times less, and anything reading from a
+# ControlRate gets an ordinary audio rate signal.
+#
+# The wrapped generator sees a sample rate of sample_rate/decimation, so times and
+# frequencies inside it still mean the same thing. With interp "linear" the output
+# ramps from each control value to the next (which delays the signal by one control
+# period), with "hold" every control value is held until the next one.
+#
+# Usually made with generator.kr(). The wrapped generator is driven by the
+# ControlRate, so it should not be read from anywhere else.
+class ControlRate(UnitGenerator):
+	def __init__(self,generator,decimation = 64,interp = "linear"):
+		super().__init__()
+		if decimation < 1:
+			raise ValueError("ControlRate decimation needs to be at least 1")
+		if interp not in ("linear","hold"):
+			raise ValueError("Unknown control rate interpolation "+str(interp))
+		self.decimation = int(decimation)
+		self.interp = interp
+		self.set_generator(generator)
+		self.num_channels = generator.num_channels
+		self.range = generator.range
+		self.drives_inputs = True
+
+		# the last two control values handed out, oldest first. Before the first
+		# control value the signal holds that value.
+		self.history = None
+		self.control_frame_id = 0
+		self.generator_continue = True
+		self.ramp = np.arange(self.decimation,dtype=np.float64)/self.decimation
+		self.frames = np.zeros(0)
+
+	def set_generator(self,generator):
+		super().set_generator(generator)
+		self.plan = ExecutionPlan(generator)
+
+	def get_continue_flag(self,sample_rate):
+		return self.generator_continue and super().get_continue_flag(sample_rate)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		decimation = self.decimation
+		num_channels = self.num_channels
+		start = self.frame
+		# (channels, frames) view, for mono output as well
+		planar = output.reshape(num_channels,num_frames)
+
+		# control value c belongs to audio frame c*decimation, so this block needs the
+		# ones from first up to (not including) last
+		first = -(-start//decimation)
+		last = -(-(start+num_frames)//decimation)
+		if last > first:
+			(data,self.generator_continue) = self.plan.generate(self.control_frame_id,last-first,sample_rate/float(decimation))
+			self.control_frame_id = (self.control_frame_id + 1) % 2
+			data = np.reshape(data,(num_channels,-1))
+			if self.history is None:
+				self.history = np.repeat(data[:,:1],2,axis=1).astype(np.float64)
+			values = np.concatenate((self.history,data),axis=1)
+		else:
+			values = self.history
+
+		# values[:,k] is control value first-2+k. Linear ramps reach a value at the
+		# audio frame after the one it belongs to, so frame n ramps from values[:,k] to
+		# values[:,k+1] with k = n/decimation - first + 1.
+		aligned = start % decimation == 0 and num_frames % decimation == 0
+		if self.interp == "linear":
+			if aligned:
+				blocks = planar.reshape((num_channels,num_frames//decimation,decimation))
+				np.subtract(values[:,2:,np.newaxis],values[:,1:-1,np.newaxis],out=blocks)
+				blocks *= self.ramp
+				blocks += values[:,1:-1,np.newaxis]
+			else:
+				position = self.get_frames(start,num_frames)/decimation - (first-1)
+				points = np.arange(values.shape[1])
+				for channel in range(num_channels):
+					planar[channel] = np.interp(position,points,values[channel])
+		else:
+			if aligned:
+				planar.reshape((num_channels,num_frames//decimation,decimation))[:] = values[:,2:,np.newaxis]
+			else:
+				index = self.get_frames(start,num_frames)//decimation - (first-2)
+				planar[:] = values[:,index.astype(np.intp)]
+
+		self.history = values[:,-2:].copy()
+		return output
+
+	def get_frames(self,start,num_frames):
+		if len(self.frames) < num_frames:
+			self.frames = np.arange(num_frames,dtype=np.float64)
+		return self.frames[:num_frames] + start
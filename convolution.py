@@ -0,0 +1,183 @@
+import threading
+import numpy as np
+from .unitgenerator import UnitGenerator, deinterleave
+
+# An impulse response (a reverb, a speaker cabinet) ready for convolution. Made from
+# a WaveSource (WaveFile, MappedWaveFile, WaveBuffer) or an array of samples, mono
+# (frames,) or planar (channels, frames). The spectra a Convolver needs are worked
+# out once for every partition size asked for and then shared by every Convolver
+# using this response. ImpulseResponse.get(filepath) hands out one shared response
+# per file, with the samples coming from the sample cache.
+class ImpulseResponse(object):
+	shared_responses = {}
+	shared_lock = threading.Lock()
+
+	def __init__(self,source,gain = 1.0):
+		super(ImpulseResponse, self).__init__()
+		if hasattr(source,'get_frames'):
+			data = deinterleave(source.get_frames(0,source.end),source.get_num_channels())
+		else:
+			data = source
+		data = np.atleast_2d(np.asarray(data,dtype=np.float64))*gain
+		if data.ndim != 2 or data.shape[1] == 0:
+			raise ValueError("ImpulseResponse needs at least one frame of mono or planar samples")
+		self.data = data
+		self.num_channels = data.shape[0]
+		self.length = data.shape[1]
+		self.spectra = {}
+		self.lock = threading.Lock()
+
+	@classmethod
+	def get(cls,filepath,cache = None):
+		from .wavefiles import WaveBuffer
+		with cls.shared_lock:
+			if filepath not in cls.shared_responses:
+				cls.shared_responses[filepath] = cls(WaveBuffer(filepath,0,None,cache))
+			return cls.shared_responses[filepath]
+
+	def get_num_partitions(self,partition_size):
+		return -(-self.length//partition_size)
+
+	# Spectra of the response cut into partition_size pieces, each zero padded to
+	# twice that for overlap-save. Returns the first one (channels, partition_size+1)
+	# and the rest (channels, partition_size+1, partitions-1) from the last partition
+	# back to the second, which is the order a Convolver's delay line lines up with.
+	def get_spectra(self,partition_size):
+		with self.lock:
+			if partition_size not in self.spectra:
+				count = self.get_num_partitions(partition_size)
+				padded = np.zeros((self.num_channels,count*partition_size))
+				padded[:,:self.length] = self.data
+				pieces = np.zeros((self.num_channels,count,2*partition_size))
+				pieces[...,:partition_size] = padded.reshape(self.num_channels,count,partition_size)
+				spectra = np.fft.rfft(pieces).astype(np.complex64)
+				rest = np.ascontiguousarray(spectra[:,:0:-1].transpose(0,2,1))
+				self.spectra[partition_size] = (spectra[:,0],rest)
+			return self.spectra[partition_size]
+
+# Convolves generator with an ImpulseResponse using uniformly partitioned
+# overlap-save convolution with a frequency-domain delay line: the response is cut
+# into partitions of partition_size frames, and every partition of input is
+# transformed once and kept in the delay line. The contribution of all the older
+# input is summed in the frequency domain once per partition, and every block only
+# has to transform its own new input against the first partition of the response,
+# so there is no added latency whatever the block size.
+#
+# partition_size defaults to the first block size (rounded up to a power of two),
+# which keeps each block to one forward and one inverse FFT. A mono input with a
+# stereo response comes out stereo, otherwise every input channel goes through the
+# matching channel of the response (or the only one). wet and dry are the gains of
+# the convolved and the untouched signal. After the input finishes the Convolver
+# keeps going until the response has rung out.
+class Convolver(UnitGenerator):
+	def __init__(self,generator,response,wet = 1.0,dry = 0.0,partition_size = None):
+		super().__init__()
+		if not isinstance(response,ImpulseResponse):
+			response = ImpulseResponse(response)
+		if response.num_channels not in (1,generator.num_channels) and generator.num_channels != 1:
+			raise ValueError("Convolver can not run a "+str(generator.num_channels)+" channel signal through a "+str(response.num_channels)+" channel response")
+		if partition_size is not None and partition_size < 1:
+			raise ValueError("Convolver partition size needs to be at least 1")
+		self.set_generator(generator)
+		self.response = response
+		self.num_channels = max(generator.num_channels,response.num_channels)
+		self.wet = wet
+		self.dry = dry
+		self.partition_size = partition_size
+		self.generator_continue = True
+		self.spectra = None
+
+	def set_wet(self,wet):
+		self.wet = wet
+
+	def set_dry(self,dry):
+		self.dry = dry
+
+	# Forgets all past input
+	def reset(self):
+		self.spectra = None
+
+	def setup(self,num_frames):
+		if self.partition_size is None:
+			self.partition_size = max(16,1 << (num_frames-1).bit_length())
+		size = self.partition_size
+		self.spectra = self.response.get_spectra(size)
+		count = self.response.get_num_partitions(size)
+		bins = size+1
+		# the last two partitions of input, the newest one filled up to fill
+		self.window = np.zeros((self.num_channels,2*size))
+		self.fill = 0
+		# input spectra along the last axis, every one stored twice so the newest
+		# count of them are always one slice (oldest first)
+		self.delay_line = np.zeros((self.num_channels,bins,2*count),dtype=np.complex64)
+		self.newest = 0
+		# everything but the first response partition does to the current partition
+		self.tail = np.zeros((self.num_channels,bins),dtype=np.complex64)
+		# frames since the input was last not silent
+		self.quiet_frames = 0
+
+	def get_continue_flag(self,sample_rate):
+		if self.generator_continue:
+			return super().get_continue_flag(sample_rate)
+		return self.quiet_frames < self.get_ring_frames()
+
+	# After this many silent frames every bit of the state is zero again
+	def get_ring_frames(self):
+		if self.spectra is None:
+			return 0
+		return (self.response.get_num_partitions(self.partition_size)+2)*self.partition_size
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		if self.generator_continue:
+			(data,self.generator_continue) = self.generator.generate(frame_id,num_frames,sample_rate)
+			silent = self.generator.is_silent()
+		else:
+			data = 0
+			silent = True
+		if self.spectra is None:
+			self.setup(num_frames)
+		output = self.get_buffer(num_frames)
+		self.quiet_frames = self.quiet_frames + num_frames if silent else 0
+		if silent and self.quiet_frames - num_frames >= self.get_ring_frames():
+			return self.fill_constant(output,0)
+
+		planar = output.reshape(self.num_channels,num_frames)
+		if silent:
+			x = np.zeros((self.num_channels,num_frames))
+		else:
+			x = np.broadcast_to(data,(self.num_channels,num_frames))
+
+		size = self.partition_size
+		(first,rest) = self.spectra
+		count = rest.shape[-1] + 1
+		position = 0
+		while position < num_frames:
+			piece = min(num_frames - position,size - self.fill)
+			start = size + self.fill
+			self.window[:,start:start+piece] = x[:,position:position+piece]
+			self.fill += piece
+
+			spectrum = np.fft.rfft(self.window)
+			result = spectrum*first
+			result += self.tail
+			planar[:,position:position+piece] = np.fft.irfft(result,2*size)[:,start:start+piece]
+			position += piece
+
+			if self.fill == size:
+				# the partition is complete: into the delay line with it, and sum what
+				# all the kept partitions do to the next one
+				self.newest = (self.newest + 1) % count
+				self.delay_line[...,self.newest] = spectrum
+				self.delay_line[...,self.newest+count] = spectrum
+				if count > 1:
+					older = self.delay_line[...,self.newest+2:self.newest+count+1]
+					self.tail[:] = (older[...,np.newaxis,:] @ rest[...,np.newaxis])[...,0,0]
+				self.window[:,:size] = self.window[:,size:]
+				self.window[:,size:] = 0
+				self.fill = 0
+
+		if self.wet != 1:
+			planar *= self.wet
+		if self.dry and not silent:
+			planar += self.dry*x
+		return output
@@ -1,49 +1,220 @@
 import numpy as np
 from .unitgenerator import UnitGenerator
 
+# Breakpoint envelope. The breakpoints are kept in arrays that grow by doubling, with
+# the slope of every segment worked out once when its end point is added (in the
+# log10 domain for "log" interpolation). Generating a block only looks at the
+# segments the block actually covers, starting from a cursor that remembers the
+# segment the last block ended in, so the cost of a block does not depend on how
+# many breakpoints came before it.
+#
+# An envelope that ends on 0 (and can not be extended) is finished once its last
+# point has passed, so that a voice it shapes gets culled like one under an ADSR.
 class Envelope(UnitGenerator):
 	def __init__(self,envelope,interp = "linear",find_next_point = None):
 		super().__init__()
 		self.num_channels = 1
-		self.set_envelope(envelope)
+		self.finished = False
 		self.set_interpolation(interp)
+		self.set_envelope(envelope)
 		self.set_find_next_point(find_next_point)
 
 	def set_envelope(self,env):
 		if type(env) is list or type(env) is tuple:
-			env = np.array(env)
+			env = np.array(env,dtype=np.float64)
 		if type(env) is np.ndarray:
-			if len(env.shape) is not 2 or env.shape[1] != 2 or env.shape[0] < 1:
+			if len(env.shape) != 2 or env.shape[1] != 2 or env.shape[0] < 1:
 				raise TypeError("Envelope needs to be an X by 2 array, where X is greater than 1.")
 		else:
 			raise TypeError("Envelope is not of proper type.")
-		if env[0][0] != 0:
-			np.concatenate(([[0,0]],env),axis=0)
-		self.envelope = env
+
+		self.points = np.zeros((max(16,len(env)),2))
+		self.slopes = np.zeros(len(self.points))
+		self.num_points = 0
+		for point in env:
+			self.add_point(point)
+		self.segment = 0
+
+	@property
+	def envelope(self):
+		return self.points[:self.num_points]
 
 	def set_find_next_point(self,find_next_point):
 		self.find_next_point = find_next_point
 
+	def add_point(self,point):
+		if self.num_points == len(self.points):
+			self.points = np.concatenate((self.points,np.zeros_like(self.points)))
+			self.slopes = np.concatenate((self.slopes,np.zeros_like(self.slopes)))
+		self.points[self.num_points] = point
+		if self.num_points > 0:
+			(t0,v0) = self.points[self.num_points-1]
+			(t1,v1) = self.points[self.num_points]
+			if t1 > t0:
+				self.slopes[self.num_points-1] = (self.to_curve(v1)-self.to_curve(v0))/(t1-t0)
+		self.num_points += 1
+		self.finished = False
+
 	def extend_envelope(self):
 		if self.find_next_point:
 			point = self.find_next_point(self.envelope[-1])
 		else:
 			raise RuntimeError("Trying to extend envelope with no defined find_next_point function.")
-		self.envelope = np.concatenate((self.envelope,[point]),axis=0)
+		# a point that does not move time forward would keep a block extending forever
+		if not point[0] > self.points[self.num_points-1,0]:
+			raise ValueError("find_next_point needs to return a point later than the last one.")
+		self.add_point(point)
 
 	def set_interpolation(self,interp_type):
 		if interp_type == "linear":
 			self.interp = np.interp
-		if interp_type == "log":
+			self.log = False
+		elif interp_type == "log":
 			self.interp = self.log_interp
+			self.log = True
+		else:
+			raise ValueError("Unknown envelope interpolation "+str(interp_type))
+		if hasattr(self,'points'):
+			self.set_envelope(self.envelope.copy())
 
 	def log_interp(self,t,x,y):
 		logy = np.log10(y)
 
 		return np.power(10.0,np.interp(t,x,logy))
 
+	# Values are interpolated in this domain (log10 of the value for log envelopes)
+	def to_curve(self,value):
+		return np.log10(value) if self.log else value
+
+	def get_continue_flag(self,sample_rate):
+		return not self.finished and super().get_continue_flag(sample_rate)
+
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		frames = np.arange(self.frame,self.frame+num_frames)/sample_rate
-		if frames[-1] > self.envelope[-1,0]:
+		output = self.get_buffer(num_frames)
+		end_time = (self.frame+num_frames-1)/sample_rate
+		while self.points[self.num_points-1,0] < end_time and self.find_next_point:
 			self.extend_envelope()
-		return self.interp(frames,self.envelope[:,0],self.envelope[:,1])
+
+		k = 0
+		while k < num_frames:
+			t = (self.frame+k)/sample_rate
+			# move the cursor up to the segment holding t
+			while self.segment+1 < self.num_points and self.points[self.segment+1,0] <= t:
+				self.segment += 1
+			(t0,v0) = self.points[self.segment]
+
+			# before the first point or after the last one the envelope holds its value
+			if t < t0 or self.segment+1 == self.num_points:
+				output[k:] = v0
+				if k == 0:
+					self.constant = v0
+				self.finished = t >= t0 and v0 == 0 and not self.find_next_point
+				break
+
+			t1 = self.points[self.segment+1,0]
+			end = min(num_frames,max(k+1,int(np.ceil(t1*sample_rate - self.frame))))
+			slope = self.slopes[self.segment]
+			ramp = output[k:end]
+			ramp[:] = np.arange(end-k)
+			ramp *= slope/sample_rate
+			ramp += self.to_curve(v0) + slope*(t-t0)
+			if self.log:
+				np.power(10.0,ramp,out=ramp)
+			k = end
+		return output
+
+# Attack/decay/sustain/release envelope that follows a gate. gate_on() starts the
+# attack from whatever level the envelope is at, gate_off() starts the release from
+# the current level. Every stage is a straight line, so each block is generated as
+# one ramp per stage it covers. Times are in seconds, sustain is a level.
+class ADSR(UnitGenerator):
+	IDLE = 0
+	ATTACK = 1
+	DECAY = 2
+	SUSTAIN = 3
+	RELEASE = 4
+
+	def __init__(self,attack,decay,sustain,release,gate = False):
+		super().__init__()
+		self.num_channels = 1
+		self.attack = attack
+		self.decay = decay
+		self.sustain = sustain
+		self.release = release
+
+		self.level = 0.0
+		self.stage = ADSR.IDLE
+		self.release_step = 0.0
+		self.finished = False
+		if gate:
+			self.gate_on()
+
+	def gate_on(self):
+		self.stage = ADSR.ATTACK
+		self.finished = False
+
+	def gate_off(self):
+		if self.stage != ADSR.IDLE:
+			self.stage = ADSR.RELEASE
+			self.release_step = None
+
+	def is_active(self):
+		return self.stage != ADSR.IDLE
+
+	# Done once a release has run all the way down to zero
+	def get_continue_flag(self,sample_rate):
+		return not self.finished and super().get_continue_flag(sample_rate)
+
+	# Writes a straight line from self.level towards target into output[k:], moving by
+	# step every frame. Returns where it stopped, and whether target was reached.
+	def ramp(self,output,k,target,step):
+		if step == 0 or (target - self.level)/step <= 0:
+			self.level = target
+			return (k,True)
+		frames_to_target = int(np.ceil((target - self.level)/step))
+		end = min(len(output),k+frames_to_target)
+		ramp = output[k:end]
+		ramp[:] = np.arange(1,end-k+1)
+		ramp *= step
+		ramp += self.level
+		if end - k == frames_to_target:
+			ramp[-1] = target
+			self.level = target
+			return (end,True)
+		self.level = float(ramp[-1])
+		return (end,False)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		k = 0
+		while k < num_frames:
+			if self.stage == ADSR.ATTACK:
+				step = 1.0/(self.attack*sample_rate) if self.attack > 0 else 0
+				(k,done) = self.ramp(output,k,1.0,step)
+				if done:
+					self.stage = ADSR.DECAY
+			elif self.stage == ADSR.DECAY:
+				step = (self.sustain-1.0)/(self.decay*sample_rate) if self.decay > 0 else 0
+				(k,done) = self.ramp(output,k,self.sustain,step)
+				if done:
+					self.stage = ADSR.SUSTAIN
+			elif self.stage == ADSR.SUSTAIN:
+				output[k:] = self.sustain
+				if k == 0:
+					self.constant = self.sustain
+				self.level = self.sustain
+				k = num_frames
+			elif self.stage == ADSR.RELEASE:
+				# the release takes the full release time from wherever the level was
+				if self.release_step is None:
+					self.release_step = -self.level/(self.release*sample_rate) if self.release > 0 else 0
+				(k,done) = self.ramp(output,k,0.0,self.release_step)
+				if done:
+					self.stage = ADSR.IDLE
+					self.finished = True
+			else:
+				output[k:] = 0
+				if k == 0:
+					self.constant = 0
+				k = num_frames
+		return output
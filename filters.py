@@ -0,0 +1,377 @@
+import numpy as np
+from .unitgenerator import UnitGenerator, read_signal, signal_constant
+
+# Biquad filters from the RBJ audio EQ cookbook. Blocks are filtered without a
+# per-sample loop: a biquad is a linear system with a two number state, so over a
+# segment of L samples its output is a matrix times the input plus a matrix times the
+# starting state. Those matrices are worked out from the coefficients once (or once
+# per segment when the cutoff moves), and every segment of every channel and voice is
+# then filtered together with a few batched matrix products. The state carries over
+# from block to block.
+
+def _lowpass(cos,alpha,A):
+	return ((1-cos)/2,1-cos,(1-cos)/2,1+alpha,-2*cos,1-alpha)
+
+def _highpass(cos,alpha,A):
+	return ((1+cos)/2,-(1+cos),(1+cos)/2,1+alpha,-2*cos,1-alpha)
+
+# constant 0 dB peak gain
+def _bandpass(cos,alpha,A):
+	return (alpha,0*cos,-alpha,1+alpha,-2*cos,1-alpha)
+
+def _notch(cos,alpha,A):
+	return (1+0*cos,-2*cos,1+0*cos,1+alpha,-2*cos,1-alpha)
+
+def _peak(cos,alpha,A):
+	return (1+alpha*A,-2*cos,1-alpha*A,1+alpha/A,-2*cos,1-alpha/A)
+
+def _lowshelf(cos,alpha,A):
+	root = 2*np.sqrt(A)*alpha
+	return (A*((A+1)-(A-1)*cos+root),2*A*((A-1)-(A+1)*cos),A*((A+1)-(A-1)*cos-root),
+		(A+1)+(A-1)*cos+root,-2*((A-1)+(A+1)*cos),(A+1)+(A-1)*cos-root)
+
+def _highshelf(cos,alpha,A):
+	root = 2*np.sqrt(A)*alpha
+	return (A*((A+1)+(A-1)*cos+root),-2*A*((A-1)+(A+1)*cos),A*((A+1)+(A-1)*cos-root),
+		(A+1)-(A-1)*cos+root,2*((A-1)-(A+1)*cos),(A+1)-(A-1)*cos-root)
+
+FILTER_TYPES = {
+	"lowpass": _lowpass,
+	"highpass": _highpass,
+	"bandpass": _bandpass,
+	"notch": _notch,
+	"peak": _peak,
+	"lowshelf": _lowshelf,
+	"highshelf": _highshelf,
+}
+
+# Normalised coefficients (b0, b1, b2, a1, a2) along the last axis. cutoff, q and gain
+# (in dB, only used by peak and shelf filters) can be numbers or arrays.
+def biquad_coefficients(filter_type,cutoff,q,gain,sample_rate):
+	if filter_type not in FILTER_TYPES:
+		raise ValueError("Unknown filter type "+str(filter_type))
+	cutoff = np.clip(np.asarray(cutoff,dtype=np.float64),1.0,0.49*sample_rate)
+	w0 = 2*np.pi*cutoff/sample_rate
+	alpha = np.sin(w0)/(2*np.maximum(np.asarray(q,dtype=np.float64),1e-3))
+	A = 10**(np.asarray(gain,dtype=np.float64)/40)
+	(b0,b1,b2,a0,a1,a2) = np.broadcast_arrays(*FILTER_TYPES[filter_type](np.cos(w0),alpha,A))
+	return np.stack((b0,b1,b2,a1,a2),axis=-1)/a0[...,np.newaxis]
+
+# Q of every section of a Butterworth filter of the given (even) order
+def butterworth_qs(order):
+	if order < 2 or order % 2:
+		raise ValueError("Butterworth order needs to be an even number of at least 2")
+	return [1/(2*np.cos(np.pi*(2*k+1)/(2*order))) for k in range(order//2)]
+
+# Everything needed to filter segments of up to length samples with the given
+# coefficients (..., 5). In transposed direct form II the state s moves on as
+# s' = A s + B x[n] with A = [[-a1, 1], [-a2, 0]], and every power of A is made of
+# the impulse response g of the poles alone:
+#   A**n = [[g[n], g[n-1]], [-a2*g[n-1], -a2*g[n-2]]]
+# so only g (from g[-1] = 0 on) and the filter's impulse response h are kept.
+def section_matrices(coefficients,length):
+	(b0,b1,b2,a1,a2) = [c[...,np.newaxis] for c in np.moveaxis(coefficients,-1,0)]
+	shape = coefficients.shape[:-1]
+
+	# g[n+m] = g[n]*g[m] - a2*g[n-1]*g[m-1] doubles how much of g is known each step
+	g = np.empty(shape+(length+2,))
+	g[...,0] = 0
+	g[...,1] = 1
+	known = 1
+	while known <= length:
+		step = min(known,length+1-known)
+		jump = -a1[...,0]*g[...,known] - a2[...,0]*g[...,known-1]
+		g[...,known+1:known+1+step] = jump[...,np.newaxis]*g[...,1:1+step] - a2*g[...,known,np.newaxis]*g[...,:step]
+		known += step
+
+	# h[0] = b0, h[k] = [1, 0] A**(k-1) B with B = (b1 - a1*b0, b2 - a2*b0)
+	h = np.empty(shape+(length+1,))
+	h[...,:1] = b0
+	h[...,1:] = g[...,1:length+1]*(b1 - a1*b0) + g[...,:length]*(b2 - a2*b0)
+	return (coefficients,g,h)
+
+# The matrices for a segment of length samples:
+#   jump       (..., 2, 2)  A**length, the starting state's share of the final state
+#   impulse    (..., L, L)  output from the segment's input (zero state)
+#   from_state (..., L, 2)  output from the starting state
+#   carry      (..., L, 2)  final state from the input
+def _head(matrices,length):
+	(coefficients,g,h) = matrices
+	a2 = coefficients[...,4,np.newaxis]
+	shape = g.shape[:-1]
+	jump = np.empty(shape+(2,2))
+	jump[...,0,0] = g[...,length+1]
+	jump[...,0,1] = g[...,length]
+	jump[...,1,0] = -a2[...,0]*g[...,length]
+	jump[...,1,1] = -a2[...,0]*g[...,length-1]
+	# Toeplitz view impulse[n,m] = h[n-m] (0 above the diagonal)
+	padded = np.concatenate((np.zeros(shape+(length-1,)),h[...,:length]),axis=-1)
+	impulse = np.lib.stride_tricks.sliding_window_view(padded,length,axis=-1)[...,::-1]
+	from_state = np.stack((g[...,1:length+1],g[...,:length]),axis=-1)
+	# A**j B for j = length-1 down to 0: (h[j+1], -a2*h[j]), the last one being B
+	carry = np.stack((h[...,length:0:-1],-a2*h[...,length-1::-1]),axis=-1)
+	carry[...,-1,1] += coefficients[...,2]
+	return (jump,impulse,from_state,carry)
+
+# Filters x (rows, segments, L) through consecutive segments. matrices come from
+# _head and have a leading (rows, segments) shape that broadcasts against x. Returns
+# the output and the state (rows, 2) after the last segment.
+def _run_segments(x,matrices,state):
+	(jump,impulse,from_state,carry) = matrices
+	if impulse.shape[:2] == (1,1):
+		# the same coefficients all through: plain matrix products over every segment
+		(jump,impulse,from_state,carry) = (jump[0,0],impulse[0,0],from_state[0,0],carry[0,0])
+		inputs = x @ carry
+		output = x @ impulse.T
+		starts = np.empty(x.shape[:2]+(2,))
+		for j in range(x.shape[1]):
+			starts[:,j] = state
+			state = state @ jump.T + inputs[:,j]
+		output += starts @ from_state.T
+		return (output,state)
+
+	(jump,impulse,from_state,carry) = [np.broadcast_to(m,x.shape[:2]+m.shape[2:]) for m in matrices]
+	inputs = (x[...,np.newaxis,:] @ carry)[...,0,:]
+	starts = np.empty(x.shape[:2]+(2,))
+	for j in range(x.shape[1]):
+		starts[:,j] = state
+		state = (jump[:,j] @ state[...,np.newaxis])[...,0] + inputs[:,j]
+	output = (impulse @ x[...,np.newaxis])[...,0]
+	output += (from_state @ starts[...,np.newaxis])[...,0]
+	return (output,state)
+
+# Filters x (rows, frames) in place, split into segments of length frames. matrices
+# are for every segment (leading shape (rows or 1, segments or 1)). Returns the new
+# state. Fixed coefficients can pass a dict as heads to keep the segment matrices
+# from block to block.
+def filter_block(x,matrices,state,length,heads = None):
+	(num_rows,num_frames) = x.shape
+	def get_head(size):
+		if heads is None:
+			return _head(matrices,size)
+		if size not in heads:
+			heads[size] = _head(matrices,size)
+		return heads[size]
+
+	full = num_frames//length
+	if full:
+		head = [m[:,:full] if m.shape[1] > 1 else m for m in get_head(length)]
+		(y,state) = _run_segments(x[:,:full*length].reshape(num_rows,full,length),head,state)
+		x[:,:full*length] = y.reshape(num_rows,-1)
+	rest = num_frames - full*length
+	if rest:
+		last = min(full,matrices[0].shape[1]-1)
+		head = [m[:,last:last+1] for m in get_head(rest)]
+		(y,state) = _run_segments(x[:,np.newaxis,full*length:],head,state)
+		x[:,full*length:] = y[:,0]
+	return state
+
+# Values of a filter parameter for every control_period frames of the block: a
+# number if it stays the same over the block, else an array with one value per
+# segment. Modulators are read at the start of every segment, so they can be an
+# Envelope, an Oscillator, or anything run at control rate with kr().
+def read_control(signal,frame_id,num_frames,sample_rate,control_period):
+	data = read_signal(signal,frame_id,num_frames,sample_rate)
+	constant = signal_constant(signal)
+	if constant is not None:
+		return float(constant)
+	data = np.asarray(data)
+	if data.ndim > 1:
+		data = data[0]
+	return data[::control_period].astype(np.float64)
+
+# A biquad filter on generator: filter_type is one of FILTER_TYPES. cutoff, q and gain
+# (dB, for peak and shelf filters) can be numbers or UnitGenerators, which are read
+# every control_period frames. Giving q as a list runs a cascade of sections with
+# the same cutoff, one per q (see Butterworth).
+class Biquad(UnitGenerator):
+	control_period = 32
+
+	def __init__(self,generator,filter_type = "lowpass",cutoff = 1000,q = 0.7071,gain = 0):
+		super().__init__()
+		self.set_generator(generator)
+		self.num_channels = generator.num_channels
+		self.set_type(filter_type)
+		self.cutoff = cutoff
+		self.gain = gain
+		self.set_q(q)
+
+	def set_type(self,filter_type):
+		if filter_type not in FILTER_TYPES:
+			raise ValueError("Unknown filter type "+str(filter_type))
+		self.filter_type = filter_type
+		self.cache_key = None
+
+	def set_cutoff(self,cutoff):
+		self.set_parameter('cutoff',cutoff)
+
+	def set_gain(self,gain):
+		self.set_parameter('gain',gain)
+
+	def set_q(self,q):
+		old = self.__dict__.get('q',[])
+		self.q = list(q) if isinstance(q,(list,tuple)) else [q]
+		self.states = None
+		self.cache_key = None
+		if any(isinstance(v,UnitGenerator) for v in old + self.q):
+			self.mark_graph_changed()
+
+	# Clears the filter's memory of past samples
+	def reset(self):
+		self.states = None
+
+	def get_continue_flag(self,sample_rate):
+		return self.generator_continue and super().get_continue_flag(sample_rate)
+
+	def get_matrices(self,stage,cutoff,q,gain,sample_rate,num_segments):
+		if all(np.isscalar(v) for v in (cutoff,q,gain)):
+			key = (self.filter_type,cutoff,q,gain,sample_rate,Biquad.control_period)
+			if self.cache_key is None or self.cache_key[stage] != key:
+				if self.cache_key is None:
+					self.cache_key = [None]*len(self.q)
+					self.cache = [None]*len(self.q)
+				coefficients = biquad_coefficients(self.filter_type,cutoff,q,gain,sample_rate)
+				self.cache[stage] = (section_matrices(coefficients.reshape(1,1,5),Biquad.control_period),{})
+				self.cache_key[stage] = key
+			return self.cache[stage]
+		(cutoff,q,gain) = [np.broadcast_to(v,(num_segments,)) for v in (cutoff,q,gain)]
+		coefficients = biquad_coefficients(self.filter_type,cutoff,q,gain,sample_rate)
+		return (section_matrices(coefficients[np.newaxis],Biquad.control_period),None)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		(data,self.generator_continue) = self.generator.generate(frame_id,num_frames,sample_rate)
+		output = self.get_buffer(num_frames)
+		num_channels = self.num_channels
+		if self.states is None or self.states.shape[1] != num_channels:
+			self.states = np.zeros((len(self.q),num_channels,2))
+
+		# nothing left ringing and nothing coming in
+		if self.generator.is_silent() and not self.states.any():
+			return self.fill_constant(output,0)
+
+		period = Biquad.control_period
+		num_segments = -(-num_frames//period)
+		cutoff = read_control(self.cutoff,frame_id,num_frames,sample_rate,period)
+		gain = read_control(self.gain,frame_id,num_frames,sample_rate,period)
+		x = np.array(np.broadcast_to(data,(num_channels,num_frames)),dtype=np.float64)
+		for (stage,q) in enumerate(self.q):
+			q = read_control(q,frame_id,num_frames,sample_rate,period)
+			(matrices,heads) = self.get_matrices(stage,cutoff,q,gain,sample_rate,num_segments)
+			self.states[stage] = filter_block(x,matrices,self.states[stage],period,heads)
+		# let the tail die out instead of running on denormals forever
+		self.states[np.abs(self.states) < 1e-20] = 0
+		output.reshape(num_channels,num_frames)[:] = x
+		return output
+
+class LowPass(Biquad):
+	def __init__(self,generator,cutoff = 1000,q = 0.7071):
+		super().__init__(generator,"lowpass",cutoff,q)
+
+class HighPass(Biquad):
+	def __init__(self,generator,cutoff = 1000,q = 0.7071):
+		super().__init__(generator,"highpass",cutoff,q)
+
+class BandPass(Biquad):
+	def __init__(self,generator,cutoff = 1000,q = 0.7071):
+		super().__init__(generator,"bandpass",cutoff,q)
+
+class Notch(Biquad):
+	def __init__(self,generator,cutoff = 1000,q = 0.7071):
+		super().__init__(generator,"notch",cutoff,q)
+
+# Butterworth lowpass or highpass of an even order, as a cascade of biquads
+class Butterworth(Biquad):
+	def __init__(self,generator,filter_type = "lowpass",cutoff = 1000,order = 4):
+		if filter_type not in ("lowpass","highpass"):
+			raise ValueError("Butterworth filters are lowpass or highpass")
+		super().__init__(generator,filter_type,cutoff,butterworth_qs(order))
+
+# A Mixer of voices that each go through their own biquad, with every voice's filter
+# run in one batched call. All voices share the filter type; cutoff, q and gain are
+# per voice (the bank's own are the defaults) and can be modulated like a Biquad's.
+# Voices are mixed down to num_channels, and finished voices are culled.
+class FilterBank(UnitGenerator):
+	def __init__(self,filter_type = "lowpass",cutoff = 1000,q = 0.7071,gain = 0,num_channels = 1):
+		super().__init__()
+		if filter_type not in FILTER_TYPES:
+			raise ValueError("Unknown filter type "+str(filter_type))
+		self.filter_type = filter_type
+		self.default_settings = (cutoff,q,gain)
+		self.num_channels = num_channels
+		self.generators = []
+		self.cutoffs = []
+		self.qs = []
+		self.gains = []
+		self.states = []
+
+	def add(self,generator,cutoff = None,q = None,gain = None):
+		if generator.num_channels not in (1,self.num_channels):
+			raise ValueError("FilterBank voices need 1 or "+str(self.num_channels)+" channels")
+		settings = [d if v is None else v for (v,d) in zip((cutoff,q,gain),self.default_settings)]
+		self.generators.append(generator)
+		self.cutoffs.append(settings[0])
+		self.qs.append(settings[1])
+		self.gains.append(settings[2])
+		self.states.append(np.zeros((generator.num_channels,2)))
+		self.mark_graph_changed()
+
+	def remove(self,generator):
+		for (i,g) in enumerate(self.generators):
+			if g is generator:
+				for voices in (self.generators,self.cutoffs,self.qs,self.gains,self.states):
+					del voices[i]
+				self.mark_graph_changed()
+				return
+		raise ValueError("Generator is not in the FilterBank.")
+
+	def get_num_generators(self):
+		return len(self.generators)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		output.fill(0)
+		period = Biquad.control_period
+		num_segments = -(-num_frames//period)
+
+		voices = []
+		to_remove = []
+		for i in range(len(self.generators)):
+			generator = self.generators[i]
+			(data,continue_flag) = generator.generate(frame_id,num_frames,sample_rate)
+			if not continue_flag:
+				to_remove.append(generator)
+			if generator.is_silent() and not self.states[i].any():
+				continue
+			settings = [read_control(v[i],frame_id,num_frames,sample_rate,period) for v in (self.cutoffs,self.qs,self.gains)]
+			voices.append((i,data,settings))
+
+		if voices:
+			# one row per channel of every voice, with that voice's settings
+			num_rows = sum(self.generators[i].num_channels for (i,data,settings) in voices)
+			x = np.empty((num_rows,num_frames))
+			values = np.empty((3,num_rows,num_segments))
+			row = 0
+			for (i,data,settings) in voices:
+				count = self.generators[i].num_channels
+				x[row:row+count] = data
+				for (k,value) in enumerate(settings):
+					values[k,row:row+count] = value
+				row += count
+
+			(cutoff,q,gain) = values
+			matrices = section_matrices(biquad_coefficients(self.filter_type,cutoff,q,gain,sample_rate),period)
+			state = filter_block(x,matrices,np.concatenate([self.states[i] for (i,data,settings) in voices]),period)
+			state[np.abs(state) < 1e-20] = 0
+			row = 0
+			planar = output.reshape(self.num_channels,num_frames)
+			for (i,data,settings) in voices:
+				count = self.generators[i].num_channels
+				self.states[i] = state[row:row+count]
+				planar += x[row:row+count]
+				row += count
+		else:
+			self.constant = 0
+
+		for generator in to_remove:
+			self.remove(generator)
+		return output
@@ -0,0 +1,285 @@
+import numbers
+import weakref
+import functools
+import numpy as np
+from .unitgenerator import UnitGenerator, Add, Multiply, Scale, AdditiveInverse, MultiplicativeInverse, Expression
+
+# An ExecutionPlan flattens a UnitGenerator graph into a list of nodes, sorted so
+# that every node comes after all of the generators it pulls data from. Running the
+# plan generates each node exactly once per block, leaves first. By the time a node
+# asks its inputs for data they have already been generated for this frame_id, so
+# instead of a recursive walk down the graph every pull is a cached lookup.
+#
+# The sort is only redone when the graph changes: every node keeps the plans it was
+# compiled into, and a node that changes its inputs (Mixer.add, finished generators
+# being removed, set_generator, ...) marks only those plans as out of date. Changing
+# a parameter value does not touch any plan. Unless told otherwise the graph is also
+# run through optimize() first. The optimized graph only lives in the plan: a node
+# that optimize() replaces stays where it is in the user's graph, and its step in
+# the plan hands it the block its replacement generated, so anything reading it (or
+# looking for it, like Mixer.remove) still finds it.
+class ExecutionPlan(object):
+	# Bumped when UnitGenerator.generate itself is swapped (see Profiler), which
+	# every compiled plan has to pick up
+	generate_version = 0
+
+	def __init__(self,root,optimize=True):
+		super(ExecutionPlan, self).__init__()
+		self.root = root
+		self.optimize = optimize
+		self.nodes = []
+		self.steps = []
+		self.replacements = {}
+		self.compiled = False
+		self.version = None
+
+	def invalidate(self):
+		self.compiled = False
+
+	def is_compiled(self):
+		return self.compiled and self.version == ExecutionPlan.generate_version
+
+	def compile(self):
+		# marked compiled before the nodes are gathered, so that a change made while
+		# compiling still makes the next block compile again
+		self.compiled = True
+		self.version = ExecutionPlan.generate_version
+		for node in topological_sort(self.root):
+			if node.execution_plans is None:
+				node.execution_plans = weakref.WeakSet()
+			node.execution_plans.add(self)
+		if self.optimize:
+			self.replacements = optimize(self.root,self.replacements)
+		self.nodes = topological_sort(self.root,self.replacements)
+		self.steps = [self.get_step(node) for node in self.nodes]
+
+	def get_step(self,node):
+		entry = self.replacements.get(id(node))
+		if entry is None:
+			return node.generate
+		return functools.partial(node.adopt_block,entry[1])
+
+	def get_nodes(self):
+		if not self.is_compiled():
+			self.compile()
+		return self.nodes
+
+	def generate(self,frame_id,num_frames,sample_rate):
+		if not self.is_compiled():
+			self.compile()
+		for step in self.steps:
+			result = step(frame_id,num_frames,sample_rate)
+		# The root is always the last step
+		return result
+
+# Depth first post-order walk of the graph. Generators reachable through more than
+# one path only show up once, at the position of their first use. The walk stops at
+# generators that drive their own inputs. With replacements (see optimize) a
+# replaced node reads from its replacement instead of its own inputs.
+def topological_sort(root,replacements = None):
+	order = []
+	visited = set()
+	in_progress = set()
+	stack = [(root,False)]
+	while stack:
+		(node,expanded) = stack.pop()
+		if expanded:
+			in_progress.discard(id(node))
+			visited.add(id(node))
+			order.append(node)
+			continue
+		if id(node) in visited:
+			continue
+		if id(node) in in_progress:
+			raise ValueError("UnitGenerator graph contains a cycle through ", node.__class__)
+		in_progress.add(id(node))
+		stack.append((node,True))
+		if replacements and id(node) in replacements:
+			inputs = [replacements[id(node)][1]]
+		elif node.drives_inputs:
+			continue
+		else:
+			inputs = node.get_inputs()
+		for generator in reversed(inputs):
+			if id(generator) in in_progress:
+				raise ValueError("UnitGenerator graph contains a cycle through ", generator.__class__)
+			if id(generator) not in visited:
+				stack.append((generator,False))
+	return order
+
+
+# Elementwise arithmetic nodes built by the UnitGenerator operators
+FUSABLE = (Add, Multiply, Scale, AdditiveInverse, MultiplicativeInverse, Expression)
+
+# Works out how to run the graph under root faster:
+#   - subtrees built only out of numbers are folded into a single constant, and
+#   - chains of Add/Multiply/AdditiveInverse/MultiplicativeInverse/Scale nodes are
+#     collapsed into one Expression, with scalar steps merged (osc*0.5*2 -> osc,
+#     -(-x) -> x).
+# Nodes are only folded into a chain if nothing else in the graph reads them. The
+# graph itself is left as it is. Returns a dict from id(node) to (node, replacement)
+# for every node that is to be run as its replacement; Expressions of the previous
+# such dict are reused for chains that have not changed.
+def optimize(root,previous = None):
+	consumers = {}
+	for node in topological_sort(root):
+		for generator in node.get_inputs():
+			consumers[id(generator)] = consumers.get(id(generator),0) + 1
+	replacements = {}
+	_optimize_node(root,consumers,{},replacements,previous or {})
+	return replacements
+
+def _optimize_node(node,consumers,done,replacements,previous):
+	if id(node) in done:
+		return done[id(node)]
+
+	if isinstance(node,FUSABLE):
+		(base,ufuncs,operands) = _build_chain(node,consumers)
+		if isinstance(base,UnitGenerator):
+			base = _optimize_node(base,consumers,done,replacements,previous)
+		operands = [_optimize_node(o,consumers,done,replacements,previous) if isinstance(o,UnitGenerator) else o for o in operands]
+		entry = previous.get(id(node))
+		if not ufuncs and isinstance(base,UnitGenerator):
+			replacement = base
+		elif isinstance(node,Expression) and _same_chain(node,base,ufuncs,operands):
+			replacement = node
+		elif entry is not None and entry[0] is node and isinstance(entry[1],Expression) and _same_chain(entry[1],base,ufuncs,operands):
+			replacement = entry[1]
+		else:
+			replacement = Expression(base,ufuncs,operands)
+	else:
+		# generators that drive their own inputs run them in plans of their own
+		if not node.drives_inputs:
+			for generator in node.get_inputs():
+				_optimize_node(generator,consumers,done,replacements,previous)
+		replacement = node
+
+	if replacement is not node:
+		replacements[id(node)] = (node,replacement)
+	done[id(node)] = replacement
+	return replacement
+
+def _same_chain(expression,base,ufuncs,operands):
+	if len(ufuncs) != len(expression.ufuncs) or not _same_signal(base,expression.base):
+		return False
+	for (ufunc,operand,old_ufunc,old_operand) in zip(ufuncs,operands,expression.ufuncs,expression.operands):
+		if ufunc is not old_ufunc or not _same_signal(operand,old_operand):
+			return False
+	return True
+
+def _same_signal(signal1,signal2):
+	if isinstance(signal1,numbers.Real) and isinstance(signal2,numbers.Real):
+		return signal1 == signal2
+	return signal1 is signal2
+
+# Value of a subtree that does not depend on any generator, None otherwise
+def constant_value(signal):
+	if isinstance(signal,numbers.Real):
+		return float(signal)
+	if isinstance(signal,(Add,Multiply)):
+		value1 = constant_value(signal.sig1)
+		value2 = constant_value(signal.sig2)
+		if value1 is None or value2 is None:
+			return None
+		return value1 + value2 if isinstance(signal,Add) else value1 * value2
+	if isinstance(signal,Scale):
+		return constant_value(signal.generator)
+	if isinstance(signal,AdditiveInverse):
+		value = constant_value(signal.generator)
+		return None if value is None else -value
+	if isinstance(signal,MultiplicativeInverse):
+		value = constant_value(signal.generator)
+		return None if value is None or value == 0 else 1/value
+	if isinstance(signal,Expression) and not signal.ufuncs:
+		return constant_value(signal.base)
+	return None
+
+def _single_consumer(signal,consumers):
+	return isinstance(signal,FUSABLE) and consumers.get(id(signal),0) == 1
+
+# Walks down the chain of fusable nodes starting at node, returning the signal at the
+# bottom of the chain and the list of operations to apply to it, in order.
+def _build_chain(node,consumers):
+	steps = []
+	while True:
+		if isinstance(node,Scale):
+			next_node = node.generator
+		elif isinstance(node,AdditiveInverse):
+			steps.append((np.multiply,-1.0))
+			next_node = node.generator
+		elif isinstance(node,MultiplicativeInverse):
+			steps.append((np.reciprocal,None))
+			next_node = node.generator
+		elif isinstance(node,Expression):
+			steps.extend(reversed(list(zip(node.ufuncs,node.operands))))
+			next_node = node.base
+		else:
+			(next_node,other) = _pick_spine(node.sig1,node.sig2,consumers)
+			steps.append(_binary_step(node,other,consumers))
+
+		if constant_value(next_node) is None and _single_consumer(next_node,consumers):
+			node = next_node
+		else:
+			break
+
+	steps.reverse()
+	base = next_node
+	value = constant_value(base)
+	if value is not None:
+		base = value
+	return _simplify(base,steps)
+
+# Continue the chain through an operand that is itself an arithmetic node nobody
+# else uses, otherwise through one that is at least a generator.
+def _pick_spine(sig1,sig2,consumers):
+	if constant_value(sig1) is None and _single_consumer(sig1,consumers):
+		return (sig1,sig2)
+	if constant_value(sig2) is None and _single_consumer(sig2,consumers):
+		return (sig2,sig1)
+	if not isinstance(sig1,UnitGenerator) and isinstance(sig2,UnitGenerator):
+		return (sig2,sig1)
+	return (sig1,sig2)
+
+def _binary_step(node,other,consumers):
+	value = constant_value(other)
+	if isinstance(node,Add):
+		if value is not None:
+			return (np.add,value)
+		if isinstance(other,AdditiveInverse) and consumers.get(id(other),0) == 1:
+			return (np.subtract,other.generator)
+		return (np.add,other)
+	else:
+		if value is not None:
+			return (np.multiply,value)
+		if isinstance(other,MultiplicativeInverse) and consumers.get(id(other),0) == 1:
+			return (np.divide,other.generator)
+		return (np.multiply,other)
+
+# Merges neighbouring scalar steps and drops the ones that do nothing
+def _simplify(base,steps):
+	ufuncs = []
+	operands = []
+	for (ufunc,operand) in steps:
+		scalar = operand is None or isinstance(operand,numbers.Real)
+		if scalar and isinstance(base,numbers.Real) and not ufuncs:
+			base = ufunc(float(base)) if operand is None else ufunc(float(base),operand)
+			continue
+		if scalar and ufuncs and ufunc is ufuncs[-1] and isinstance(operands[-1],numbers.Real):
+			if ufunc is np.add:
+				operands[-1] += operand
+			elif ufunc is np.multiply:
+				operands[-1] *= operand
+			else:
+				ufuncs.append(ufunc)
+				operands.append(operand)
+		elif ufunc is np.reciprocal and ufuncs and ufuncs[-1] is np.reciprocal:
+			ufuncs.pop()
+			operands.pop()
+			continue
+		else:
+			ufuncs.append(ufunc)
+			operands.append(operand)
+		if (ufuncs[-1] is np.add and operands[-1] == 0) or (ufuncs[-1] is np.multiply and operands[-1] == 1):
+			ufuncs.pop()
+			operands.pop()
+	return (base,ufuncs,operands)
@@ -1,9 +1,149 @@
 import numpy as np
 from .unitgenerator import UnitGenerator
 
+# Every noise generator draws from its own np.random.Generator stream. A generator
+# made with a seed always plays the same noise. One made without a seed gets the
+# next stream spawned from a shared seed sequence, so after set_noise_seed(seed) a
+# patch built in the same order produces exactly the same noise on every render,
+# whether it is rendered in realtime, offline, on threads or in other processes.
+noise_seeds = np.random.SeedSequence()
+
+def set_noise_seed(seed):
+	global noise_seeds
+	if isinstance(seed,np.random.SeedSequence):
+		# a fresh copy, so the same seed always spawns the same streams
+		noise_seeds = np.random.SeedSequence(seed.entropy,spawn_key=seed.spawn_key,pool_size=seed.pool_size)
+	else:
+		noise_seeds = np.random.SeedSequence(seed)
+
+def make_noise_stream(seed = None):
+	if seed is None:
+		seed = noise_seeds.spawn(1)[0]
+	return np.random.Generator(np.random.PCG64(seed))
+
+# White noise, uniform in [-1, 1). The noise is drawn straight into the output
+# buffer in the sample type of the graph.
 class NoiseGen(UnitGenerator):
-	def __init__(self):
-		super().__init__()
+	def __init__(self,seed = None,duration = None):
+		super().__init__(duration=duration)
+		self.seed(seed)
+
+	def seed(self,seed = None):
+		self.rng = make_noise_stream(seed)
+
+	# Fills out (float32 or float64) with uniform noise in [-1, 1)
+	def white(self,out):
+		self.rng.random(out=out,dtype=out.dtype)
+		out *= 2
+		out -= 1
+		return out
+
+	# Uniform noise in [-1, 1) as a (channels, frames) array. Values are drawn frame
+	# by frame, so the noise comes out the same whatever the block sizes are.
+	def white_frames(self,num_channels,num_frames,dtype = np.float64):
+		return self.white(np.empty((num_frames,num_channels),dtype=dtype)).T
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		if self.num_channels == 1:
+			return self.white(output)
+		output[:] = self.white_frames(self.num_channels,num_frames,output.dtype)
+		return output
+
+# Pink (1/f) noise with the Voss-McCartney algorithm: num_rows white noise values
+# are held and summed, row k being redrawn every 2**(k+1) samples, plus a fresh
+# white value every sample. Every sample redraws at most one row, so a block is
+# worked out as one running sum over the changes rather than num_rows passes. The
+# output has about the same RMS level as white noise.
+class PinkNoise(NoiseGen):
+	def __init__(self,seed = None,duration = None,num_rows = 16):
+		super().__init__(seed=seed,duration=duration)
+		self.num_rows = num_rows
+		self.rows = None
+		self.position = 0
+		self.changes = np.zeros(0)
+		self.scale = 1/np.sqrt(num_rows+1)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		num_channels = self.num_channels
+		if self.rows is None or len(self.rows) != num_channels:
+			self.rows = self.white(np.empty((num_channels,self.num_rows)))
+		if self.changes.size < num_channels*num_frames:
+			self.changes = np.zeros(num_channels*num_frames)
+		changes = self.changes[:num_channels*num_frames].reshape(num_channels,num_frames)
+		changes.fill(0)
+
+		# every frame draws the new value of the row it redraws and its white value
+		draws = self.white_frames(2*num_channels,num_frames)
+		updates = draws[:num_channels]
+
+		# frame n redraws row k when n is an odd multiple of 2**k
+		start = self.position
+		for k in range(self.num_rows):
+			period = 2 << k
+			first = (2**k - start) % period
+			if first >= num_frames:
+				continue
+			values = updates[:,first::period]
+			changes[:,first::period] = values
+			changes[:,first+period::period] -= values[:,:-1]
+			changes[:,first] -= self.rows[:,k]
+			self.rows[:,k] = values[:,-1]
+
+		# the running sum ends on the exact sum of the rows, so rounding never adds up
+		total = np.cumsum(changes,axis=1)
+		total += (self.rows.sum(axis=1) - total[:,-1])[:,np.newaxis]
+		total += draws[num_channels:]
+		total *= self.scale
+		self.position += num_frames
+		output = self.get_buffer(num_frames)
+		output.reshape(num_channels,num_frames)[:] = total
+		return output
+
+# Brown (1/f^2) noise: white noise through a leaky integrator whose leak sets in
+# below cutoff Hz, so the output wanders like a random walk without drifting off.
+# The recursion y[n] = a*y[n-1] + g*w[n] is solved a chunk at a time with a
+# cumulative sum. The output has about the same RMS level as white noise.
+class BrownNoise(NoiseGen):
+	chunk_frames = 2048
+	# largest exponent a**-k is allowed to reach within a chunk, well inside float64
+	max_growth = 300.0
+
+	def __init__(self,seed = None,duration = None,cutoff = 20.0):
+		super().__init__(seed=seed,duration=duration)
+		self.cutoff = cutoff
+		self.level = None
+		self.coefficients = None
+
+	def set_coefficients(self,sample_rate):
+		a = np.exp(-2*np.pi*self.cutoff/sample_rate)
+		self.coefficients = (sample_rate,a)
+		self.gain = np.sqrt(1 - a*a)
+		# a**(k+1) and a**-k over one chunk. The chunk is cut short for high cutoffs
+		# (and low control rates) so that a**-k can not overflow.
+		leak = 2*np.pi*self.cutoff/sample_rate
+		self.chunk_frames = max(1,min(BrownNoise.chunk_frames,int(BrownNoise.max_growth/leak)))
+		k = np.arange(self.chunk_frames,dtype=np.float64)
+		self.decay = a**(k+1)
+		self.growth = a**-k
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		return np.random.rand(self.num_channels*num_frames)
\ No newline at end of file
+		num_channels = self.num_channels
+		if self.coefficients is None or self.coefficients[0] != sample_rate:
+			self.set_coefficients(sample_rate)
+		if self.level is None or len(self.level) != num_channels:
+			self.level = np.zeros((num_channels,1))
+		a = self.coefficients[1]
+		noise = self.white_frames(num_channels,num_frames)*self.gain
+		for start in range(0,num_frames,self.chunk_frames):
+			chunk = noise[:,start:start+self.chunk_frames]
+			count = chunk.shape[1]
+			# y[k] = a**(k+1)*y[-1] + a**k * (sum over m<=k of a**-m * g*w[m])
+			chunk *= self.growth[:count]
+			np.cumsum(chunk,axis=1,out=chunk)
+			chunk *= self.decay[:count]/a
+			chunk += self.decay[:count]*self.level
+			self.level = chunk[:,-1:].copy()
+		output = self.get_buffer(num_frames)
+		output.reshape(num_channels,num_frames)[:] = noise
+		return output
@@ -1,5 +1,5 @@
 import numpy as np
-from .unitgenerator import UnitGenerator
+from .unitgenerator import UnitGenerator, read_signal, signal_constant
 
 class Oscillator(UnitGenerator):
 	def __init__(self,freq,phase = 0,duration=None,pitch_type = "freq"):
@@ -10,26 +10,43 @@ class Oscillator(UnitGenerator):
 			raise ValueError("Invalid freq type to ", self.__class__, " object")
 
 		self.phase = phase/180*np.pi
-		self.last_angle = self.phase
+		# Running phase of the oscillator, kept in float64 and wrapped to [0, 2*pi) so
+		# it does not lose precision no matter how long the oscillator plays.
+		self.last_angle = 0.0
+		self.steps = np.zeros(0)
 
 	def set_freq(self,f):
-		self.freq = f
+		self.set_parameter('freq',f)
 
-	def oscillatorFunc(self,T,frames):
-		raise ValueError(self.__class__ +" object does not have its oscillatorFunc specified")
+	def oscillatorFunc(self,angle):
+		raise ValueError(self.__class__.__name__ +" object does not have its oscillatorFunc specified")
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		if isinstance(self.freq,UnitGenerator):
-			[freq,cont] = self.freq.generate(frame_id,num_frames,sample_rate)
-		else:
-			freq = np.ones(num_frames)*self.freq
+		freq = read_signal(self.freq,frame_id,num_frames,sample_rate)
 		if isinstance(self.phase,UnitGenerator):
 			[phase,cont] = self.phase.generate(frame_id,num_frames,sample_rate)
+			if self.phase.constant is not None:
+				phase = self.phase.constant
 		else:
 			phase = self.phase
-		omega = 2*np.pi*freq/sample_rate
-		angle = self.last_angle + np.cumsum(omega) + phase
-		self.last_angle = angle[-1]
+
+		constant_freq = signal_constant(self.freq)
+		if constant_freq is not None:
+			# a steady frequency is a straight line of angles, no need for a running sum
+			omega = 2*np.pi*float(constant_freq)/sample_rate
+			if len(self.steps) < num_frames:
+				self.steps = np.arange(1,num_frames+1,dtype=np.float64)
+			angle = self.steps[:num_frames]*omega
+		else:
+			omega = 2*np.pi*np.asarray(freq,dtype=np.float64)/sample_rate
+			angle = np.cumsum(omega)
+		# kept around for oscillatorFuncs that depend on the frequency (like wavetables)
+		self.omega = omega
+		angle += self.last_angle
+		if num_frames > 0:
+			self.last_angle = angle[-1] % (2*np.pi)
+		angle += phase
+		np.mod(angle,2*np.pi,out=angle)
 		return self.oscillatorFunc(angle)
 
 class SineGen(Oscillator):
@@ -37,4 +54,258 @@ class SineGen(Oscillator):
 		super().__init__(freq,phase=phase,duration=duration,pitch_type=pitch_type)
 
 	def oscillatorFunc(self,angle):
-		return np.sin(angle)
\ No newline at end of file
+		# angles are in [0, 2*pi), so they can be brought down to the sample type
+		# before taking the sine without losing precision
+		output = self.get_buffer(len(angle))
+		output[:] = angle
+		return np.sin(output,out=output)
+
+# A single cycle waveform stored as a set of band-limited tables (a mipmap). Level k
+# keeps only the lowest (size/2)>>k harmonics of the waveform, so playing a level
+# whose top harmonic stays below Nyquist for the current frequency gives a waveform
+# without aliasing. Tables are built once and shared: the standard shapes through
+# Wavetable.get(name) and user supplied waveforms by passing the same Wavetable
+# object to every oscillator that uses it.
+class Wavetable(object):
+	shared_tables = {}
+
+	def __init__(self,samples,size=2048):
+		super(Wavetable, self).__init__()
+		samples = np.asarray(samples,dtype=np.float64)
+		if samples.ndim != 1 or len(samples) < 2:
+			raise ValueError("Wavetable needs a one dimensional array holding a single cycle")
+		if size & (size-1):
+			raise ValueError("Wavetable size needs to be a power of two")
+		self.size = size
+
+		# spectrum of the cycle resampled to size points, without the DC offset
+		spectrum = np.zeros(size//2+1,dtype=complex)
+		source = np.fft.rfft(samples)*(size/float(len(samples)))
+		count = min(len(source),len(spectrum))
+		spectrum[1:count] = source[1:count]
+		self.build_levels(spectrum)
+
+	def build_levels(self,spectrum):
+		self.levels = []
+		harmonics = self.size//2
+		while harmonics >= 1:
+			level = spectrum.copy()
+			level[harmonics+1:] = 0
+			table = np.fft.irfft(level,self.size)
+			# one guard point so lookups never need to wrap around
+			self.levels.append(np.append(table,table[0]))
+			harmonics //= 2
+
+		peak = np.abs(self.levels[0]).max()
+		if peak > 0:
+			for table in self.levels:
+				table /= peak
+		# difference between neighbouring points, for interpolating
+		self.slopes = [np.diff(table,append=table[1]) for table in self.levels]
+
+	# Waveform made of sin(n*angle)*amps[n] for every harmonic n
+	@classmethod
+	def from_harmonics(cls,amps,size=2048):
+		table = cls.__new__(cls)
+		table.size = size
+		spectrum = np.zeros(size//2+1,dtype=complex)
+		count = min(len(amps),len(spectrum))
+		spectrum[:count] = -0.5j*size*np.asarray(amps[:count])
+		spectrum[0] = 0
+		table.build_levels(spectrum)
+		return table
+
+	@classmethod
+	def get(cls,name,size=2048):
+		key = (name,size)
+		if key not in cls.shared_tables:
+			n = np.arange(size//2+1,dtype=np.float64)
+			n[0] = 1
+			if name == 'sine':
+				amps = np.zeros(len(n))
+				amps[1] = 1
+			elif name == 'saw':
+				amps = 2/np.pi*((-1)**(n+1))/n
+			elif name == 'square':
+				amps = 4/np.pi/n*(n%2 == 1)
+			elif name == 'triangle':
+				amps = 8/np.pi**2*((-1)**((n-1)//2))/n**2*(n%2 == 1)
+			else:
+				raise ValueError("Unknown wavetable "+str(name))
+			cls.shared_tables[key] = cls.from_harmonics(amps,size)
+		return cls.shared_tables[key]
+
+	# Picks the most detailed level that has no harmonics above Nyquist for an angular
+	# frequency of omega (radians per sample)
+	def get_level(self,omega):
+		if omega <= 0:
+			return 0
+		level = int(np.ceil(np.log2(self.size/2*omega/np.pi)))
+		return min(max(level,0),len(self.levels)-1)
+
+	# Linearly interpolated lookup of the table at every angle, written into out.
+	# position and index are scratch arrays of the same length as angle.
+	def lookup(self,angle,omega,out,position,index):
+		level = self.get_level(omega)
+		np.multiply(angle,self.size/(2*np.pi),out=position)
+		np.mod(position,self.size,out=position)
+		np.copyto(index,position,casting='unsafe')
+		position -= index
+		np.multiply(self.slopes[level].take(index),position,out=out,casting='unsafe')
+		out += self.levels[level].take(index)
+		return out
+
+# Oscillator playing back a Wavetable. table can be a Wavetable, the name of one of
+# the standard shapes ('sine', 'saw', 'square', 'triangle') or an array holding one
+# cycle of a waveform.
+class WavetableOscillator(Oscillator):
+	def __init__(self,freq,table='sine',phase = 0,duration=None,pitch_type = "freq"):
+		super().__init__(freq,phase=phase,duration=duration,pitch_type=pitch_type)
+		self.set_table(table)
+		self.position = np.zeros(0)
+		self.index = np.zeros(0,dtype=np.intp)
+
+	def set_table(self,table):
+		if isinstance(table,str):
+			table = Wavetable.get(table)
+		elif not isinstance(table,Wavetable):
+			table = Wavetable(table)
+		self.table = table
+
+	def oscillatorFunc(self,angle):
+		if len(self.position) != len(angle):
+			self.position = np.zeros(len(angle))
+			self.index = np.zeros(len(angle),dtype=np.intp)
+		omega = np.max(np.abs(self.omega))
+		return self.table.lookup(angle,omega,self.get_buffer(len(angle)),self.position,self.index)
+
+class SawGen(WavetableOscillator):
+	def __init__(self,freq,phase = 0,duration=None,pitch_type = "freq"):
+		super().__init__(freq,table='saw',phase=phase,duration=duration,pitch_type=pitch_type)
+
+class SquareGen(WavetableOscillator):
+	def __init__(self,freq,phase = 0,duration=None,pitch_type = "freq"):
+		super().__init__(freq,table='square',phase=phase,duration=duration,pitch_type=pitch_type)
+
+class TriangleGen(WavetableOscillator):
+	def __init__(self,freq,phase = 0,duration=None,pitch_type = "freq"):
+		super().__init__(freq,table='triangle',phase=phase,duration=duration,pitch_type=pitch_type)
+
+# A bank of sine voices computed together. The frequency, amplitude and phase of
+# every voice are kept in arrays, so each block is a single (voices x frames) numpy
+# operation no matter how many voices are playing. The bank mixes all voices down to
+# one output; voice(voice_id) gives a generator for a single voice instead.
+#
+# A voice's frequency can also be a UnitGenerator, for per-voice frequency
+# modulation.
+class OscillatorBank(UnitGenerator):
+	def __init__(self,duration=None):
+		super().__init__(duration=duration)
+		self.freqs = np.zeros(0)
+		self.amps = np.zeros(0)
+		self.angles = np.zeros(0)
+		self.modulators = []
+		self.modulated = []
+
+		self.voice_ids = []
+		self.voice_index = {}
+		self.next_voice_id = 0
+
+		self.angle_data = np.zeros((0,0))
+		self.voice_data = np.zeros((0,0),dtype=UnitGenerator.dtype)
+		self.steps = np.zeros(0)
+
+	# Adds a voice and returns its id
+	def add_voice(self,freq,amp=1,phase=0):
+		voice_id = self.next_voice_id
+		self.next_voice_id += 1
+		self.voice_ids.append(voice_id)
+		self.freqs = np.append(self.freqs,0)
+		self.amps = np.append(self.amps,amp)
+		self.angles = np.append(self.angles,phase/180*np.pi)
+		self.modulators.append(None)
+		self.update_voice_index()
+		self.set_voice_freq(voice_id,freq)
+		return voice_id
+
+	def remove_voice(self,voice_id):
+		index = self.voice_index[voice_id]
+		self.voice_ids.pop(index)
+		self.freqs = np.delete(self.freqs,index)
+		self.amps = np.delete(self.amps,index)
+		self.angles = np.delete(self.angles,index)
+		modulator = self.modulators.pop(index)
+		self.update_voice_index()
+		if modulator is not None:
+			self.mark_graph_changed()
+
+	def update_voice_index(self):
+		self.voice_index = {voice_id:i for (i,voice_id) in enumerate(self.voice_ids)}
+		self.modulated = [i for (i,m) in enumerate(self.modulators) if m is not None]
+
+	def get_num_voices(self):
+		return len(self.voice_ids)
+
+	def set_voice_freq(self,voice_id,freq):
+		index = self.voice_index[voice_id]
+		modulator = self.modulators[index]
+		if isinstance(freq,UnitGenerator):
+			self.modulators[index] = freq
+			self.freqs[index] = 0
+		else:
+			self.modulators[index] = None
+			self.freqs[index] = freq
+		self.update_voice_index()
+		if modulator is not None or isinstance(freq,UnitGenerator):
+			self.mark_graph_changed()
+
+	def set_voice_amp(self,voice_id,amp):
+		self.amps[self.voice_index[voice_id]] = amp
+
+	def voice(self,voice_id):
+		return BankVoice(self,voice_id)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		num_voices = len(self.voice_ids)
+		if self.angle_data.shape != (num_voices,num_frames):
+			self.angle_data = np.zeros((num_voices,num_frames))
+		if self.voice_data.shape != (num_voices,num_frames) or self.voice_data.dtype != UnitGenerator.dtype:
+			self.voice_data = np.zeros((num_voices,num_frames),dtype=UnitGenerator.dtype)
+		if len(self.steps) != num_frames:
+			self.steps = np.arange(1,num_frames+1)
+
+		# angle of every voice at every frame of the block, in float64
+		angles = self.angle_data
+		omega = 2*np.pi*self.freqs/sample_rate
+		np.multiply(omega[:,np.newaxis],self.steps,out=angles)
+		for i in self.modulated:
+			(freq,cont) = self.modulators[i].generate(frame_id,num_frames,sample_rate)
+			np.cumsum(2*np.pi*freq/sample_rate,out=angles[i])
+		angles += self.angles[:,np.newaxis]
+
+		# keep the phase wrapped so it does not lose precision over long notes
+		np.mod(angles,2*np.pi,out=angles)
+		if num_frames > 0:
+			self.angles[:] = angles[:,-1]
+		self.voice_data[:] = angles
+		np.sin(self.voice_data,out=self.voice_data)
+
+		amps = self.amps.astype(UnitGenerator.dtype)
+		return np.matmul(amps,self.voice_data,out=self.get_buffer(num_frames))
+
+# Output of a single voice of an OscillatorBank
+class BankVoice(UnitGenerator):
+	def __init__(self,bank,voice_id):
+		super().__init__()
+		self.bank = bank
+		self.voice_id = voice_id
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		self.bank.generate(frame_id,num_frames,sample_rate)
+		index = self.bank.voice_index.get(self.voice_id)
+		output = self.get_buffer(num_frames)
+		if index is None:
+			output.fill(0)
+		else:
+			np.multiply(self.bank.voice_data[index],self.bank.amps[index],out=output)
+		return output
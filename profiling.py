@@ -0,0 +1,217 @@
+import threading
+import time
+import tracemalloc
+from .unitgenerator import UnitGenerator, Expression
+from .graph import ExecutionPlan
+
+# Per generator numbers collected by a Profiler. Times are in nanoseconds. self_time
+# leaves out the time spent generating inputs from inside this generator's own
+# generate() (only happens outside of an ExecutionPlan, or below a generator that
+# drives its own inputs), total_time includes it. Bytes are the peak traced
+# allocation while the generator ran, and do include its inputs.
+class NodeStats(object):
+	def __init__(self,node):
+		super(NodeStats, self).__init__()
+		self.name = node.__class__.__name__
+		self.calls = 0
+		self.blocks = 0
+		self.self_time = 0
+		self.total_time = 0
+		self.max_time = 0
+		self.bytes = 0
+		self.max_bytes = 0
+
+	def get_block_time(self):
+		return self.self_time/self.blocks if self.blocks else 0.0
+
+	def get_block_bytes(self):
+		return self.bytes/self.blocks if self.blocks else 0.0
+
+# Records wall time, call count and (with track_allocations) bytes allocated for
+# every UnitGenerator while enabled:
+#
+#   profiler = Profiler()
+#   with profiler:
+#       controller.render_to_array(10)
+#   profiler.print_report(controller.plan.root)
+#
+# Enabling swaps UnitGenerator.generate for an instrumented version and disabling
+# puts the original back, so when no profiler is running generating costs exactly
+# what it did before. Compiled ExecutionPlans pick up the swap because both mark the
+# graph as changed. Only one profiler can be enabled at a time.
+#
+# Generators an optimized ExecutionPlan runs as a fused Expression are reported with
+# the numbers of that Expression, so the report still follows the graph as it was
+# built.
+class Profiler(object):
+	active = None
+
+	def __init__(self,track_allocations=False):
+		super(Profiler, self).__init__()
+		self.track_allocations = track_allocations
+		self.stats = {}
+		# what ExecutionPlans ran in place of a generator, id(generator) to
+		# (generator, replacement)
+		self.replaced = {}
+		self.local = threading.local()
+		self.original_generate = None
+		self.original_adopt_block = None
+		self.started_tracing = False
+
+	def __enter__(self):
+		self.enable()
+		return self
+
+	def __exit__(self,*args):
+		self.disable()
+
+	def enable(self):
+		if Profiler.active is self:
+			return
+		if Profiler.active is not None:
+			raise RuntimeError("Another Profiler is already enabled.")
+		if self.track_allocations and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.started_tracing = True
+		Profiler.active = self
+		self.original_generate = UnitGenerator.generate
+		self.original_adopt_block = UnitGenerator.adopt_block
+		UnitGenerator.generate = self.make_generate(self.original_generate)
+		UnitGenerator.adopt_block = self.make_adopt_block(self.original_adopt_block)
+		ExecutionPlan.generate_version += 1
+
+	def disable(self):
+		if Profiler.active is not self:
+			return
+		UnitGenerator.generate = self.original_generate
+		UnitGenerator.adopt_block = self.original_adopt_block
+		self.original_generate = None
+		self.original_adopt_block = None
+		Profiler.active = None
+		if self.started_tracing:
+			tracemalloc.stop()
+			self.started_tracing = False
+		ExecutionPlan.generate_version += 1
+
+	def reset(self):
+		self.stats = {}
+		self.replaced = {}
+
+	def get_stats(self,node):
+		entry = self.stats.get(id(node))
+		if entry is None or entry[0] is not node:
+			return None
+		return entry[1]
+
+	def make_generate(self,generate):
+		profiler = self
+		track_allocations = self.track_allocations
+
+		def profiled_generate(node,frame_id,num_frames,sample_rate):
+			# every generate call on this thread pushes a record of how much of
+			# its time went into nested generate calls
+			stack = getattr(profiler.local,'stack',None)
+			if stack is None:
+				stack = profiler.local.stack = []
+			record = [0,0]
+			if track_allocations:
+				(start_bytes,peak) = tracemalloc.get_traced_memory()
+				tracemalloc.reset_peak()
+			stack.append(record)
+			frame_before = node.frame
+			start = time.perf_counter_ns()
+			try:
+				return generate(node,frame_id,num_frames,sample_rate)
+			finally:
+				elapsed = time.perf_counter_ns() - start
+				stack.pop()
+				if track_allocations:
+					# a nested call resets the peak, so it hands its own peak back up
+					peak = max(record[1],tracemalloc.get_traced_memory()[1])
+					tracemalloc.reset_peak()
+					if stack:
+						stack[-1][1] = max(stack[-1][1],peak)
+					allocated = max(0,peak - start_bytes)
+				if stack:
+					stack[-1][0] += elapsed
+
+				entry = profiler.stats.get(id(node))
+				if entry is None or entry[0] is not node:
+					entry = (node,NodeStats(node))
+					profiler.stats[id(node)] = entry
+				stats = entry[1]
+				stats.calls += 1
+				# cached lookups count as calls but not as blocks
+				if node.frame != frame_before:
+					stats.blocks += 1
+					stats.total_time += elapsed
+					stats.self_time += elapsed - record[0]
+					stats.max_time = max(stats.max_time,elapsed - record[0])
+					if track_allocations:
+						stats.bytes += allocated
+						stats.max_bytes = max(stats.max_bytes,allocated)
+
+		return profiled_generate
+
+	def make_adopt_block(self,adopt_block):
+		profiler = self
+
+		def profiled_adopt_block(node,source,frame_id,num_frames,sample_rate):
+			profiler.replaced[id(node)] = (node,source)
+			return adopt_block(node,source,frame_id,num_frames,sample_rate)
+
+		return profiled_adopt_block
+
+	# The generator that did the work of node: the Expression a plan fused it into,
+	# the input it was folded into, or node itself
+	def get_runner(self,node):
+		entry = self.replaced.get(id(node))
+		if entry is None or entry[0] is not node:
+			return node
+		return entry[1]
+
+	# Walks the graph under root the same way generate pulls data, listing every
+	# generator under the ones that use it as (depth, node, stats, note). stats is None
+	# for generators with nothing of their own to report, and note says why. A
+	# generator used in several places is only expanded the first time, so every
+	# recorded NodeStats shows up at most once.
+	def get_rows(self,root):
+		rows = []
+		seen = set()
+		stack = [(root,0)]
+		while stack:
+			(node,depth) = stack.pop()
+			runner = self.get_runner(node)
+			if id(node) in seen or id(runner) in seen:
+				rows.append((depth,node,None,"(shared, see above)"))
+				continue
+			seen.add(id(node))
+			if runner is not node and not isinstance(runner,Expression):
+				# folded away into one of its inputs, which does the work
+				rows.append((depth,node,None,"(folded into its input)"))
+				inputs = [runner]
+			else:
+				seen.add(id(runner))
+				stats = self.get_stats(runner)
+				rows.append((depth,node,stats,None if stats else "(not run)"))
+				inputs = runner.get_inputs()
+			for generator in reversed(inputs):
+				stack.append((generator,depth+1))
+		return rows
+
+	def get_report(self,root):
+		lines = []
+		total = sum(entry[1].self_time for entry in self.stats.values())
+		lines.append("%-40s %8s %8s %12s %12s %7s %12s" % ("generator","calls","blocks","us/block","max us","%","bytes/block"))
+		for (depth,node,stats,note) in self.get_rows(root):
+			name = "  "*depth + node.__class__.__name__
+			if stats is None:
+				lines.append("%-40s %s" % (name,note))
+			else:
+				share = 100.0*stats.self_time/total if total else 0.0
+				lines.append("%-40s %8d %8d %12.2f %12.2f %7.2f %12.0f" % (name,stats.calls,stats.blocks,
+					stats.get_block_time()/1000,stats.max_time/1000,share,stats.get_block_bytes()))
+		return "\n".join(lines)
+
+	def print_report(self,root):
+		print(self.get_report(root))
@@ -0,0 +1,116 @@
+import threading
+import time
+import numpy as np
+
+# Fixed size single-producer, single-consumer ring buffer of samples. The producer
+# only ever moves write_count and the consumer only ever moves read_count, so one
+# thread can write while another reads without taking any locks.
+class RingBuffer(object):
+	def __init__(self,size,dtype=np.float32):
+		super(RingBuffer, self).__init__()
+		self.size = size
+		self.buffer = np.zeros(size,dtype=dtype)
+		self.write_count = 0
+		self.read_count = 0
+
+	def get_read_available(self):
+		return self.write_count - self.read_count
+
+	def get_write_available(self):
+		return self.size - (self.write_count - self.read_count)
+
+	# Copies as much of data as fits, returns the number of samples written
+	def write(self,data):
+		count = min(len(data),self.get_write_available())
+		start = self.write_count % self.size
+		first = min(count,self.size - start)
+		self.buffer[start:start+first] = data[:first]
+		self.buffer[:count-first] = data[first:count]
+		self.write_count += count
+		return count
+
+	# Fills as much of out as possible, returns the number of samples read
+	def read(self,out):
+		count = min(len(out),self.get_read_available())
+		start = self.read_count % self.size
+		first = min(count,self.size - start)
+		out[:first] = self.buffer[start:start+first]
+		out[first:count] = self.buffer[:count-first]
+		self.read_count += count
+		return count
+
+	# Only safe to call while neither side is using the buffer
+	def reset(self):
+		self.write_count = 0
+		self.read_count = 0
+
+# Runs an AudioController in callback mode. A dedicated render thread keeps the ring
+# buffer topped up to render_ahead blocks in advance, while the backend's callback
+# (running on the audio device's thread) only copies finished samples out of it.
+# If the ring buffer runs dry the callback plays silence and counts an underrun
+# rather than waiting for the render thread.
+class RealtimeEngine(object):
+	def __init__(self,controller,render_ahead=4):
+		super(RealtimeEngine, self).__init__()
+		if render_ahead < 1:
+			raise ValueError("RealtimeEngine needs to render at least one block ahead")
+		self.controller = controller
+		self.render_ahead = render_ahead
+		self.block_size = controller.buffer_size
+		self.num_channels = controller.num_channels
+
+		self.ring = RingBuffer(self.render_ahead*self.block_size*self.num_channels)
+		self.callback_buffer = np.zeros(self.block_size*self.num_channels,dtype=np.float32)
+
+		self.running = False
+		self.thread = None
+		self.underruns = 0
+
+	def start(self):
+		if self.running:
+			return
+		self.ring.reset()
+		# render a full ring buffer of audio before the device starts asking for it
+		while self.ring.get_write_available() >= self.block_size*self.num_channels:
+			self.render_block()
+		self.running = True
+		self.thread = threading.Thread(target=self.render_loop,name="ocelot render thread",daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+	def render_block(self):
+		data = self.controller.generate_block(self.block_size)
+		self.ring.write(self.controller.interleave(data))
+		if self.controller.listener:
+			self.controller.listener.add_audio(data,self.controller.sample_rate,self.num_channels)
+
+	def render_loop(self):
+		block_time = self.block_size/float(self.controller.sample_rate)
+		while self.running:
+			if self.ring.get_write_available() >= self.block_size*self.num_channels:
+				self.render_block()
+			else:
+				time.sleep(block_time/2)
+
+	# Called by the backend from the audio device's thread
+	def callback(self,num_frames):
+		num_samples = num_frames*self.num_channels
+		if len(self.callback_buffer) < num_samples:
+			self.callback_buffer = np.zeros(num_samples,dtype=np.float32)
+		out = self.callback_buffer[:num_samples]
+		count = self.ring.read(out)
+		if count < num_samples:
+			out[count:] = 0
+			self.underruns += 1
+		return out
+
+	# Time in seconds between a block being rendered and it being heard: the audio
+	# waiting in the ring buffer plus whatever latency the device itself reports.
+	def get_latency(self):
+		buffered_frames = self.ring.get_read_available()//self.num_channels
+		return buffered_frames/float(self.controller.sample_rate) + self.controller.backend.get_output_latency()
@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+from .wavefiles import MappedWaveFile
+
+# Process wide cache of decoded sample data. Every region of a file is decoded once
+# and the same read-only array is handed to everyone who asks for it, so twenty
+# WaveBuffers playing the same drum hit share one copy. Once the cache holds more
+# than budget bytes the least recently used regions are dropped from it (arrays that
+# are still in use stay alive until their users let go of them).
+class SampleCache(object):
+	def __init__(self,budget=512*1024*1024):
+		super(SampleCache, self).__init__()
+		self.budget = budget
+		self.entries = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	# Key for a region of a file. Includes the file's size and modification time, so
+	# that a file that changes on disk gets decoded again.
+	def get_key(self,filepath,start_frame,num_frames):
+		stat = os.stat(filepath)
+		return (os.path.abspath(filepath),stat.st_size,stat.st_mtime_ns,start_frame,num_frames,'float32')
+
+	# Returns (data, num_channels) for num_frames frames of the file starting at
+	# start_frame (the rest of the file if num_frames is None). data is interleaved
+	# float32 and read only.
+	def get(self,filepath,start_frame=0,num_frames=None):
+		key = self.get_key(filepath,start_frame,num_frames)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+			self.misses += 1
+
+		entry = self.decode(filepath,start_frame,num_frames)
+
+		with self.lock:
+			# another thread may have decoded the same region in the meantime
+			if key in self.entries:
+				return self.entries[key]
+			self.entries[key] = entry
+			self.bytes += entry[0].nbytes
+			self.evict()
+		return entry
+
+	def decode(self,filepath,start_frame,num_frames):
+		source = MappedWaveFile(filepath)
+		end_frame = source.end if num_frames is None else start_frame + num_frames
+		data = source.get_frames(start_frame,end_frame)
+		data.flags.writeable = False
+		return (data,source.get_num_channels())
+
+	# Drops least recently used entries until the cache fits in its budget. Needs to
+	# be called with the lock held.
+	def evict(self):
+		while self.bytes > self.budget and self.entries:
+			(key,(data,num_channels)) = self.entries.popitem(last=False)
+			self.bytes -= data.nbytes
+			self.evictions += 1
+
+	def set_budget(self,budget):
+		with self.lock:
+			self.budget = budget
+			self.evict()
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+	def get_stats(self):
+		with self.lock:
+			return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+				'entries':len(self.entries), 'bytes':self.bytes, 'budget':self.budget}
+
+	# Decodes a set of samples into the cache. Each item is either a filepath or a
+	# (filepath, start_frame, num_frames) tuple. With background set this happens on
+	# its own thread, which is returned so the caller can join() it.
+	def preload(self,items,background=True):
+		def load():
+			for item in items:
+				if isinstance(item,(tuple,list)):
+					self.get(*item)
+				else:
+					self.get(item)
+		if not background:
+			load()
+			return None
+		thread = threading.Thread(target=load,name="ocelot sample preload",daemon=True)
+		thread.start()
+		return thread
+
+# The cache WaveBuffers use unless they are given one of their own
+sample_cache = SampleCache()
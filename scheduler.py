@@ -0,0 +1,226 @@
+import heapq
+import threading
+from .unitgenerator import UnitGenerator
+from .trackcontrols import Mixer
+from .graph import ExecutionPlan
+
+# Runs timestamped events (starting and stopping sounds, parameter changes, any
+# function call) at exact sample positions. The Scheduler sits in the graph above
+# the generator it controls (a Mixer by default) and renders that generator itself:
+# every block is split at the frames events are due on, the events are fired
+# between the pieces, and the pieces are copied into one output block. Timing is as
+# accurate as a single sample whatever the buffer size is.
+#
+# Times are in seconds on the scheduler's own clock, which starts at 0 and runs with
+# the audio it renders (see get_time()). Events scheduled in the past fire at the
+# start of the next block. Events can be scheduled from any thread.
+#
+# The generators under a scheduler are generated once per piece, so they must not
+# also be used by anything outside of it.
+class Scheduler(UnitGenerator):
+	def __init__(self,sample_rate,generator = None):
+		super().__init__()
+		if generator is None:
+			generator = Mixer()
+		self.sample_rate = sample_rate
+		self.set_generator(generator)
+		self.num_channels = generator.num_channels
+		self.drives_inputs = True
+
+		self.events = []
+		self.event_count = 0
+		# ids of the events that have not fired or been cancelled yet, and of the
+		# cancelled ones still in the heap
+		self.pending = set()
+		self.cancelled = set()
+		self.lock = threading.Lock()
+
+		# frame the scheduler is at while it fires events, so event functions can
+		# schedule relative to the exact time they run at
+		self.now = 0
+		self.piece_frame_id = 0
+		self.generator_continue = True
+
+	def set_generator(self,generator):
+		super().set_generator(generator)
+		self.plan = ExecutionPlan(generator)
+
+	def get_time(self):
+		return self.now/float(self.sample_rate)
+
+	def to_frame(self,time):
+		return int(round(time*self.sample_rate))
+
+	# Calls func(*args) when the scheduler reaches time. Returns an id for cancel().
+	def schedule(self,time,func,*args):
+		return self.schedule_frame(self.to_frame(time),func,*args)
+
+	def schedule_frame(self,frame,func,*args):
+		with self.lock:
+			event_id = self.event_count
+			self.event_count += 1
+			heapq.heappush(self.events,(frame,event_id,func,args))
+			self.pending.add(event_id)
+		return event_id
+
+	# Cancelling an event that has already fired does nothing
+	def cancel(self,event_id):
+		with self.lock:
+			if event_id in self.pending:
+				self.pending.discard(event_id)
+				self.cancelled.add(event_id)
+
+	def clear(self):
+		with self.lock:
+			self.events = []
+			self.pending = set()
+			self.cancelled = set()
+
+	def get_num_events(self):
+		return len(self.pending)
+
+	def schedule_add(self,time,generator):
+		return self.schedule(time,self.generator.add,generator)
+
+	def schedule_remove(self,time,generator):
+		return self.schedule(time,self.generator.remove,generator)
+
+	def schedule_set(self,time,target,attribute,value):
+		return self.schedule(time,setattr,target,attribute,value)
+
+	# Starts generator at time. With an envelope (something with gate_on/gate_off,
+	# like an ADSR) the envelope is gated on at the same frame, gated off after
+	# duration, and the generator is taken out once the release is over. Without
+	# one the generator is taken out after duration.
+	def schedule_note(self,time,generator,duration = None,envelope = None):
+		start = self.to_frame(time)
+		self.schedule_frame(start,self.generator.add,generator)
+		if envelope is not None:
+			self.schedule_frame(start,envelope.gate_on)
+		if duration is None:
+			return
+		end = self.to_frame(time+duration)
+		if envelope is not None:
+			self.schedule_frame(end,envelope.gate_off)
+			end += self.to_frame(getattr(envelope,'release',0))
+		self.schedule_frame(end,self.drop,generator)
+
+	# Takes generator out of the generator under the scheduler if it is still there
+	# (a Mixer drops generators by itself once they finish)
+	def drop(self,generator):
+		for g in self.generator.generators:
+			if g is generator or getattr(g,'generator',None) is generator:
+				self.generator.remove(generator)
+				return
+
+	# Frame of the next event still to fire, or None
+	def get_next_frame(self):
+		with self.lock:
+			while self.events and self.events[0][1] in self.cancelled:
+				self.cancelled.discard(heapq.heappop(self.events)[1])
+			if self.events:
+				return self.events[0][0]
+			return None
+
+	def fire_events(self,frame):
+		while True:
+			with self.lock:
+				if not self.events or self.events[0][0] > frame:
+					return
+				(event_frame,event_id,func,args) = heapq.heappop(self.events)
+				if event_id in self.cancelled:
+					self.cancelled.discard(event_id)
+					continue
+				self.pending.discard(event_id)
+			func(*args)
+
+	def get_continue_flag(self,sample_rate):
+		return (self.generator_continue or bool(self.events)) and super().get_continue_flag(sample_rate)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		if sample_rate != self.sample_rate:
+			raise ValueError("Scheduler was set up for a sample rate of "+str(self.sample_rate)+", not "+str(sample_rate))
+		output = self.get_buffer(num_frames)
+		position = 0
+		while position < num_frames:
+			self.now = self.frame + position
+			self.fire_events(self.now)
+			next_frame = self.get_next_frame()
+			if next_frame is None:
+				end = num_frames
+			else:
+				end = min(num_frames,max(position+1,next_frame - self.frame))
+
+			# every piece is a new block as far as the generators below are concerned
+			(data,self.generator_continue) = self.plan.generate(self.piece_frame_id,end-position,sample_rate)
+			self.piece_frame_id = (self.piece_frame_id + 1) % 2
+			output[...,position:end] = data
+			position = end
+		self.now = self.frame + num_frames
+		return output
+
+# Steps through pattern at tempo beats per minute, steps_per_beat steps to a beat,
+# calling play(value) for every step that is not None. Steps are scheduled on a
+# Scheduler one at a time, each at the exact frame it falls on, and are counted from
+# where the sequence started so rounding never adds up to drift.
+class Sequencer(object):
+	def __init__(self,scheduler,tempo,pattern,play,steps_per_beat = 4,loop = True):
+		super(Sequencer, self).__init__()
+		self.scheduler = scheduler
+		self.pattern = list(pattern)
+		self.play = play
+		self.steps_per_beat = steps_per_beat
+		self.loop = loop
+
+		self.step = 0
+		self.origin_frame = 0
+		self.origin_step = 0
+		self.event_id = None
+		self.set_tempo(tempo)
+
+	def get_step_frames(self):
+		return self.scheduler.sample_rate*60.0/(self.tempo*self.steps_per_beat)
+
+	def get_step_frame(self,step):
+		return self.origin_frame + int(round((step - self.origin_step)*self.get_step_frames()))
+
+	# The step that is already scheduled keeps its time, the new tempo takes effect
+	# from the one after it
+	def set_tempo(self,tempo):
+		if tempo <= 0:
+			raise ValueError("Sequencer tempo needs to be positive")
+		if self.event_id is not None:
+			self.origin_frame = self.get_step_frame(self.step)
+			self.origin_step = self.step
+		self.tempo = tempo
+
+	def is_playing(self):
+		return self.event_id is not None
+
+	def start(self,time = None):
+		self.stop()
+		if time is None:
+			time = self.scheduler.get_time()
+		self.step = 0
+		self.origin_step = 0
+		self.origin_frame = self.scheduler.to_frame(time)
+		self.event_id = self.scheduler.schedule_frame(self.origin_frame,self.play_step)
+
+	def stop(self):
+		if self.event_id is not None:
+			self.scheduler.cancel(self.event_id)
+			self.event_id = None
+
+	def play_step(self):
+		if self.step >= len(self.pattern):
+			if not self.loop or not self.pattern:
+				self.event_id = None
+				return
+			self.origin_frame = self.get_step_frame(self.step)
+			self.origin_step = 0
+			self.step = 0
+		value = self.pattern[self.step]
+		if value is not None:
+			self.play(value)
+		self.step += 1
+		self.event_id = self.scheduler.schedule_frame(self.get_step_frame(self.step),self.play_step)
@@ -0,0 +1,12 @@
+import importlib.util
+import os
+import sys
+
+# The repository is the ocelot package itself, so it is imported under that name
+# whatever the checkout directory is called.
+if "ocelot" not in sys.modules:
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	spec = importlib.util.spec_from_file_location("ocelot",os.path.join(root,"__init__.py"),submodule_search_locations=[root])
+	module = importlib.util.module_from_spec(spec)
+	sys.modules["ocelot"] = module
+	spec.loader.exec_module(module)
@@ -0,0 +1,40 @@
+import itertools
+import numpy as np
+from ocelot import UnitGenerator
+from ocelot.graph import ExecutionPlan
+
+# Plays a planar array (frames,) or (channels, frames), then silence
+class ArraySignal(UnitGenerator):
+	def __init__(self,data):
+		super().__init__()
+		self.data = np.asarray(data,dtype=np.float64)
+		self.num_channels = 1 if self.data.ndim == 1 else self.data.shape[0]
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		if self.frame >= self.data.shape[-1]:
+			return self.fill_constant(output,0)
+		output.fill(0)
+		piece = self.data[...,self.frame:self.frame+num_frames]
+		output[...,:piece.shape[-1]] = piece
+		return output
+
+	def get_continue_flag(self,sample_rate):
+		return self.frame < self.data.shape[-1]
+
+# frame ids keep alternating across calls, so no block looks like a repeat of the last
+frame_ids = itertools.count()
+
+# Runs generator in its own plan for num_frames frames, cycling through block_sizes,
+# and returns everything it made as one float64 array
+def render(generator,block_sizes,num_frames,sample_rate = 44100.0):
+	plan = ExecutionPlan(generator)
+	blocks = []
+	done = 0
+	for size in itertools.cycle(block_sizes):
+		if done >= num_frames:
+			break
+		size = min(size,num_frames - done)
+		blocks.append(np.array(plan.generate(next(frame_ids) % 2,size,sample_rate)[0],dtype=np.float64))
+		done += size
+	return np.concatenate(blocks,axis=-1)
@@ -0,0 +1,57 @@
+import numpy as np
+from ocelot import Convolver, ImpulseResponse
+from signals import ArraySignal, render
+
+def noise(shape,seed = 1):
+	return np.random.default_rng(seed).uniform(-0.5,0.5,shape)
+
+def test_matches_np_convolve_at_uneven_block_sizes():
+	x = noise(2000)
+	response = noise(300,seed=2)
+	expected = np.convolve(x,response)
+	for (block_sizes,partition_size) in (((100,),64),((37,200,5),64),((256,),100),((1000,),16)):
+		output = render(Convolver(ArraySignal(x),response,partition_size=partition_size),block_sizes,len(expected))
+		assert np.allclose(output,expected,atol=1e-4)
+
+def test_default_partition_size_follows_first_block():
+	x = noise(1500)
+	response = noise(1000,seed=2)
+	convolver = Convolver(ArraySignal(x),response)
+	output = render(convolver,(100,),len(x)+len(response)-1)
+	assert convolver.partition_size == 128
+	assert np.allclose(output,np.convolve(x,response),atol=1e-4)
+
+def test_response_shorter_than_a_partition():
+	x = noise(500)
+	response = np.array([0.5,0.25,-0.125])
+	output = render(Convolver(ArraySignal(x),response,partition_size=64),(48,),502)
+	assert np.allclose(output,np.convolve(x,response),atol=1e-5)
+
+def test_stereo_response_on_mono_input_with_dry_signal():
+	x = noise(800)
+	response = noise((2,150),seed=3)
+	convolver = Convolver(ArraySignal(x),ImpulseResponse(response),wet=0.5,dry=0.25,partition_size=32)
+	assert convolver.num_channels == 2
+	output = render(convolver,(50,),949)
+	for channel in range(2):
+		expected = 0.5*np.convolve(x,response[channel])
+		expected[:len(x)] += 0.25*x
+		assert np.allclose(output[channel],expected,atol=1e-4)
+
+def test_rings_out_then_finishes():
+	x = noise(256)
+	response = noise(400,seed=4)
+	convolver = Convolver(ArraySignal(x),response,partition_size=64)
+	ring = len(x)+len(response)-1
+	output = render(convolver,(64,),2048)
+	assert np.allclose(output[:ring],np.convolve(x,response),atol=1e-4)
+	assert np.allclose(output[ring:],0,atol=1e-6)
+	assert convolver.is_silent()
+	assert not convolver.reused_continue_flag
+
+def test_shared_spectra():
+	response = ImpulseResponse(noise(300,seed=5))
+	(first,rest) = response.get_spectra(64)
+	assert first.shape == (1,65)
+	assert rest.shape == (1,65,4)
+	assert response.get_spectra(64)[1] is rest
@@ -0,0 +1,48 @@
+import itertools
+import numpy as np
+import pytest
+from ocelot import Envelope, Mixer, SineGen
+from ocelot.graph import ExecutionPlan
+
+# frame ids keep alternating across calls, so no block looks like a repeat of the last
+frame_ids = itertools.count()
+
+def render(plan,blocks,num_frames = 256):
+	for i in range(blocks):
+		(data,continue_flag) = plan.generate(next(frame_ids) % 2,num_frames,44100)
+	return (data,continue_flag)
+
+def test_envelope_finishes_after_last_point_at_zero():
+	envelope = Envelope([[0,0],[0.001,1],[0.01,0]])
+	plan = ExecutionPlan(envelope)
+	(data,continue_flag) = render(plan,1)
+	assert continue_flag
+	(data,continue_flag) = render(plan,2)
+	assert not continue_flag
+	assert envelope.is_silent()
+
+def test_envelope_holding_a_level_keeps_going():
+	envelope = Envelope([[0,0],[0.001,0.5]])
+	(data,continue_flag) = render(ExecutionPlan(envelope),4)
+	assert continue_flag
+	assert envelope.constant == 0.5
+
+def test_voices_under_envelopes_are_culled():
+	mixer = Mixer()
+	plan = ExecutionPlan(mixer)
+	for i in range(3):
+		mixer.add(SineGen(220*(i+1))*Envelope([[0,0],[0.001,1],[0.005*(i+1),0]])*0.5)
+	render(plan,1)
+	assert mixer.get_num_generators() == 3
+	render(plan,4)
+	assert mixer.get_num_generators() == 0
+	(data,continue_flag) = render(plan,1)
+	assert not np.any(data)
+
+def test_extending_envelope_has_to_move_forward():
+	envelope = Envelope([[0,0],[0.001,1]],find_next_point=lambda point: (point[0]+0.001,1-point[1]))
+	render(ExecutionPlan(envelope),2)
+	assert envelope.num_points > 10
+	stuck = Envelope([[0,0],[0.001,1]],find_next_point=lambda point: (point[0],point[1]))
+	with pytest.raises(ValueError):
+		render(ExecutionPlan(stuck),1)
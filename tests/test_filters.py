@@ -0,0 +1,77 @@
+import numpy as np
+from ocelot import Biquad, Butterworth, FilterBank, biquad_coefficients, butterworth_qs
+from signals import ArraySignal, render
+
+SAMPLE_RATE = 44100.0
+
+# Transposed direct form II, one sample at a time. coefficients is (5,) or one row of
+# (b0, b1, b2, a1, a2) per sample.
+def tdf2(x,coefficients):
+	coefficients = np.broadcast_to(coefficients,(len(x),5))
+	y = np.zeros(len(x))
+	(s1,s2) = (0.0,0.0)
+	for (n,(b0,b1,b2,a1,a2)) in enumerate(coefficients):
+		y[n] = b0*x[n] + s1
+		s1 = b1*x[n] - a1*y[n] + s2
+		s2 = b2*x[n] - a2*y[n]
+	return y
+
+def noise(shape,seed = 1):
+	return np.random.default_rng(seed).uniform(-0.5,0.5,shape)
+
+def test_biquad_types_match_reference():
+	x = noise(1500)
+	for filter_type in ("lowpass","highpass","bandpass","notch","peak","lowshelf","highshelf"):
+		coefficients = biquad_coefficients(filter_type,2000,1.3,6,SAMPLE_RATE)
+		output = render(Biquad(ArraySignal(x),filter_type,2000,1.3,6),(100,37,256),len(x))
+		assert np.allclose(output,tdf2(x,coefficients),atol=1e-5)
+
+def test_biquad_state_carries_over_channels_and_blocks():
+	x = noise((2,1000))
+	coefficients = biquad_coefficients("lowpass",300,4,0,SAMPLE_RATE)
+	output = render(Biquad(ArraySignal(x),"lowpass",300,4),(33,512,7),1000)
+	for channel in range(2):
+		assert np.allclose(output[channel],tdf2(x[channel],coefficients),atol=1e-5)
+
+def test_butterworth_cascade_matches_reference():
+	x = noise(1200)
+	expected = x
+	for q in butterworth_qs(6):
+		expected = tdf2(expected,biquad_coefficients("highpass",800,q,0,SAMPLE_RATE))
+	output = render(Butterworth(ArraySignal(x),"highpass",800,order=6),(100,),len(x))
+	assert np.allclose(output,expected,atol=1e-5)
+
+def test_modulated_cutoff_is_read_every_control_period():
+	x = noise(1000)
+	cutoff = np.linspace(200,5000,1000)
+	block_size = 100
+	period = Biquad.control_period
+	# every segment of a block uses the cutoff at its first frame
+	starts = np.arange(1000)
+	starts = starts - (starts % block_size) % period
+	coefficients = biquad_coefficients("lowpass",cutoff[starts],0.9,0,SAMPLE_RATE)
+	output = render(Biquad(ArraySignal(x),"lowpass",ArraySignal(cutoff),0.9),(block_size,),len(x))
+	assert np.allclose(output,tdf2(x,coefficients),atol=1e-5)
+
+def test_reset_and_silence():
+	x = np.zeros(600)
+	x[0] = 1
+	biquad = Biquad(ArraySignal(x),"lowpass",1000)
+	output = render(biquad,(128,),600)
+	assert np.allclose(output,tdf2(x,biquad_coefficients("lowpass",1000,0.7071,0,SAMPLE_RATE)),atol=1e-6)
+	biquad.reset()
+	output = render(biquad,(128,),256)
+	assert not output.any()
+	assert biquad.is_silent()
+
+def test_filter_bank_matches_separate_filters():
+	voices = [noise(900,seed) for seed in range(3)]
+	settings = [(500,0.7),(2000,2.0),(8000,0.5)]
+	bank = FilterBank("bandpass",num_channels=1)
+	for (x,(cutoff,q)) in zip(voices,settings):
+		bank.add(ArraySignal(x),cutoff,q)
+	output = render(bank,(100,57),900)
+	expected = sum(tdf2(x,biquad_coefficients("bandpass",cutoff,q,0,SAMPLE_RATE)) for (x,(cutoff,q)) in zip(voices,settings))
+	assert np.allclose(output,expected,atol=1e-5)
+	render(bank,(100,),100)
+	assert bank.get_num_generators() == 0
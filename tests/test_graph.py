@@ -0,0 +1,84 @@
+import gc
+import itertools
+import threading
+import time
+import numpy as np
+from ocelot import Mixer, SineGen
+from ocelot.graph import ExecutionPlan
+
+# frame ids keep alternating across calls, so no block looks like a repeat of the last
+frame_ids = itertools.count()
+
+def render(plan,blocks,num_frames = 128):
+	return np.concatenate([np.array(plan.generate(next(frame_ids) % 2,num_frames,44100)[0]) for i in range(blocks)],axis=1)
+
+def make_mix():
+	osc = SineGen(440)
+	voice = osc*0.5
+	mixer = Mixer()
+	mixer.add(voice)
+	mixer.add((SineGen(3)+1)*0.25*osc)
+	return (mixer,voice)
+
+def test_optimized_plan_matches_unoptimized():
+	(mixer,voice) = make_mix()
+	expected = render(ExecutionPlan(mixer,optimize=False),6)
+	(mixer,voice) = make_mix()
+	assert np.array_equal(render(ExecutionPlan(mixer),6),expected)
+
+def test_optimize_leaves_user_graph_alone():
+	(mixer,voice) = make_mix()
+	generators = list(mixer.generators)
+	plan = ExecutionPlan(mixer)
+	render(plan,2)
+	assert plan.replacements
+	assert mixer.generators == generators
+	assert generators[0].generator is voice
+	mixer.remove(voice)
+	render(plan,1)
+	assert mixer.get_num_generators() == 1
+
+def test_parameter_change_keeps_plan():
+	osc = SineGen(440)
+	mixer = Mixer([osc*0.5])
+	plan = ExecutionPlan(mixer)
+	render(plan,1)
+	steps = plan.steps
+	osc.set_freq(220)
+	render(plan,1)
+	assert plan.steps is steps
+	mixer.add(SineGen(100))
+	render(plan,1)
+	assert plan.steps is not steps
+
+def test_optimize_stops_at_generators_driving_their_inputs():
+	voice = SineGen(440)*0.5*2
+	mixer = Mixer(parallel=True)
+	mixer.add(voice)
+	plan = ExecutionPlan(mixer)
+	render(plan,2)
+	assert plan.replacements == {}
+	branch = mixer.get_plan(mixer.generators[0])
+	assert id(voice) in branch.replacements
+	mixer.close()
+
+def worker_threads():
+	return [thread for thread in threading.enumerate() if thread.name.startswith("ocelot mixer")]
+
+def test_parallel_mixer_releases_its_threads():
+	before = len(worker_threads())
+	mixer = Mixer([SineGen(440),SineGen(660)],parallel=True)
+	render(ExecutionPlan(mixer),2)
+	assert len(worker_threads()) > before
+	mixer.close()
+	assert len(worker_threads()) == before
+
+	mixer = Mixer([SineGen(440),SineGen(660)],parallel=True)
+	render(ExecutionPlan(mixer),2)
+	del mixer
+	gc.collect()
+	for i in range(100):
+		if len(worker_threads()) == before:
+			break
+		time.sleep(0.01)
+	assert len(worker_threads()) == before
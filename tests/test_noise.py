@@ -0,0 +1,29 @@
+import numpy as np
+from ocelot import BrownNoise
+
+def render(generator,sample_rate,blocks = 8,num_frames = 4096):
+	return np.concatenate([np.array(generator.generate(i % 2,num_frames,sample_rate)[0]) for i in range(blocks)])
+
+# y[n] = a*y[n-1] + g*w[n] worked out one sample at a time
+def reference(white,cutoff,sample_rate):
+	a = np.exp(-2*np.pi*cutoff/sample_rate)
+	gain = np.sqrt(1 - a*a)
+	output = np.zeros(len(white))
+	level = 0.0
+	for (n,value) in enumerate(white):
+		level = a*level + gain*value
+		output[n] = level
+	return output
+
+def test_brown_noise_is_finite_at_high_cutoffs():
+	for (cutoff,sample_rate) in ((5000,44100),(20000,44100),(20,44100/512.0),(300,44100/64.0)):
+		data = render(BrownNoise(seed=1,cutoff=cutoff),sample_rate)
+		assert np.all(np.isfinite(data))
+		assert np.max(np.abs(data)) < 10
+
+def test_brown_noise_follows_leaky_integrator():
+	for (cutoff,sample_rate) in ((20,44100),(5000,44100),(300,44100/64.0)):
+		noise = BrownNoise(seed=2,cutoff=cutoff)
+		data = render(noise,sample_rate,blocks=2)
+		white = BrownNoise(seed=2).white_frames(1,len(data))[0]
+		assert np.allclose(data,reference(white,cutoff,sample_rate),atol=1e-5)
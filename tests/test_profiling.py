@@ -0,0 +1,20 @@
+from ocelot import Profiler, SineGen
+from ocelot.graph import ExecutionPlan
+
+def test_fused_nodes_are_charged_to_the_graph():
+	osc = SineGen(440)
+	osc2 = SineGen(660)
+	root = osc*0.5+osc2
+	plan = ExecutionPlan(root)
+	with Profiler() as profiler:
+		for i in range(20):
+			plan.generate(i % 2,256,44100)
+	assert plan.replacements
+
+	rows = profiler.get_rows(root)
+	assert [(depth,node) for (depth,node,stats,note) in rows] == [(0,root),(1,osc),(1,osc2)]
+	for (depth,node,stats,note) in rows:
+		assert stats is not None and stats.blocks == 20
+	total = sum(stats.self_time for (node,stats) in profiler.stats.values())
+	assert sum(stats.self_time for (depth,node,stats,note) in rows) == total
+	assert "not run" not in profiler.get_report(root)
@@ -0,0 +1,40 @@
+import itertools
+from ocelot import Scheduler, SineGen
+from ocelot.graph import ExecutionPlan
+
+# frame ids keep alternating across calls, so no block looks like a repeat of the last
+frame_ids = itertools.count()
+
+def render(plan,blocks,num_frames = 256):
+	for i in range(blocks):
+		(data,continue_flag) = plan.generate(next(frame_ids) % 2,num_frames,44100)
+	return data
+
+def test_note_is_dropped_from_optimized_graph():
+	scheduler = Scheduler(44100)
+	plan = ExecutionPlan(scheduler)
+	for i in range(4):
+		scheduler.schedule_note(0.001*i,SineGen(220*(i+1))*0.5*0.5,duration=0.01)
+	render(plan,1)
+	assert scheduler.generator.get_num_generators() == 4
+	render(plan,2)
+	assert scheduler.generator.get_num_generators() == 0
+	assert scheduler.get_num_events() == 0
+
+def test_cancelling_fired_event_is_ignored():
+	scheduler = Scheduler(44100)
+	plan = ExecutionPlan(scheduler)
+	calls = []
+	fired = scheduler.schedule(0,calls.append,1)
+	later = scheduler.schedule(1,calls.append,2)
+	assert scheduler.get_num_events() == 2
+	render(plan,1)
+	assert calls == [1]
+	scheduler.cancel(fired)
+	assert scheduler.get_num_events() == 1
+	scheduler.cancel(later)
+	scheduler.cancel(later)
+	assert scheduler.get_num_events() == 0
+	render(plan,200)
+	assert calls == [1]
+	assert scheduler.get_num_events() == 0
@@ -0,0 +1,48 @@
+import numpy as np
+from ocelot import StreamingWaveSource, WaveGenerator
+
+# In-memory WaveSource of interleaved float32 frames
+class ArraySource(object):
+	def __init__(self,num_frames,num_channels):
+		self.num_channels = num_channels
+		self.data = np.random.default_rng(1).uniform(-1,1,num_frames*num_channels).astype(np.float32)
+		self.end = num_frames
+
+	def get_frames(self,start_frame,end_frame):
+		return self.data[start_frame*self.num_channels:end_frame*self.num_channels]
+
+	def get_num_channels(self):
+		return self.num_channels
+
+def test_first_block_after_preroll():
+	source = ArraySource(50000,2)
+	stream = StreamingWaveSource(source,preroll_frames=8192,chunk_frames=1024)
+	try:
+		assert stream.wait_ready(5)
+		assert stream.ready
+		generator = WaveGenerator(stream)
+		(data,continue_flag) = generator.generate(0,256,44100)
+		assert np.array_equal(data,source.data[:512].reshape(256,2).T)
+		assert stream.underruns == 0
+	finally:
+		stream.close()
+
+def test_seek_waits_for_new_position():
+	source = ArraySource(50000,1)
+	stream = StreamingWaveSource(source,preroll_frames=8192,chunk_frames=1024)
+	try:
+		assert stream.wait_ready(5)
+		stream.seek(30000)
+		assert stream.wait_ready(5)
+		assert np.array_equal(stream.get_frames(30000,30256),source.data[30000:30256])
+	finally:
+		stream.close()
+
+def test_short_file_is_ready_at_its_end():
+	source = ArraySource(100,1)
+	stream = StreamingWaveSource(source,preroll_frames=8192,chunk_frames=1024)
+	try:
+		assert stream.wait_ready(5)
+		assert np.array_equal(stream.get_frames(0,256),source.data)
+	finally:
+		stream.close()
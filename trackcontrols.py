@@ -1,5 +1,8 @@
+import weakref
 import numpy as np
-from .unitgenerator import UnitGenerator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .unitgenerator import UnitGenerator, interleave, read_signal, signal_constant
+from .graph import ExecutionPlan
 
 class MonoToStereo(UnitGenerator):
 	def __init__(self,generator):
@@ -7,108 +10,364 @@ class MonoToStereo(UnitGenerator):
 		self.set_generator(generator)
 		self.num_channels = 2
 
-	def generate(self,frame_id,num_frames,sample_rate):
+	def __generate__(self,frame_id,num_frames,sample_rate):
 		(data,continue_flag) = self.generator.generate(frame_id,num_frames,sample_rate)
-		return np.stack((data,data),axis=1).flatten(), continue_flag
+		output = self.get_buffer(num_frames)
+		if self.generator.constant is not None:
+			return self.fill_constant(output,self.generator.constant)
+		output[:] = data
+		return output
+
+	def get_continue_flag(self,sample_rate):
+		return self.generator.reused_continue_flag
+
+# Renders a private copy of generator for num_frames frames, used by
+# Mixer.render_branches in worker processes.
+def _render_branch(generator,num_frames,block_size,sample_rate):
+	plan = ExecutionPlan(generator)
+	output = np.zeros((generator.num_channels,num_frames), dtype=np.float32)
+	frame_id = 0
+	for start in range(0,num_frames,block_size):
+		count = min(block_size,num_frames - start)
+		(data,continue_flag) = plan.generate(frame_id,count,sample_rate)
+		output[:,start:start+count] = data
+		frame_id = (frame_id + 1) % 2
+		if not continue_flag:
+			break
+	return output
 
 class Mixer(UnitGenerator):
-	def __init__(self,generators = [],gain=1):
+	def __init__(self,generators = None,gain=1,parallel=False,max_workers=None):
 		super().__init__()
 		self.num_channels = 2
+		if generators is None:
+			generators = []
 		self.generators = generators
 
+		self.executor = None
+		self.finalizer = None
+		self.plans = {}
+		self.set_parallel(parallel,max_workers)
+
+	# In parallel mode every generator added to the mixer is run as its own branch on
+	# a thread pool (numpy releases the GIL for the heavy array math). Branches must
+	# not share any generators with each other. Their outputs are still summed in the
+	# order the generators were added, so the result does not depend on scheduling.
+	#
+	# The thread pool is shut down by close() or set_parallel(False), or when the
+	# mixer is garbage collected.
+	def set_parallel(self,parallel,max_workers=None):
+		self.shutdown_executor()
+		self.plans = {}
+		if parallel:
+			self.executor = ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix="ocelot mixer")
+			# the finalizer only holds on to the pool, not to the mixer
+			self.finalizer = weakref.finalize(self,self.executor.shutdown,False)
+		self.drives_inputs = parallel
+		self.mark_graph_changed()
+
+	def shutdown_executor(self):
+		if self.executor:
+			self.finalizer.detach()
+			self.finalizer = None
+			self.executor.shutdown()
+			self.executor = None
+
+	# Stops the worker threads of parallel mode. The mixer keeps working, serially.
+	def close(self):
+		self.set_parallel(False)
+
+	def get_plan(self,generator):
+		entry = self.plans.get(id(generator))
+		if entry is None or entry[0] is not generator:
+			entry = (generator,ExecutionPlan(generator))
+			self.plans[id(generator)] = entry
+		return entry[1]
+
 	def add(self, gen) :
 		if gen.num_channels == 1:
 			gen = MonoToStereo(gen)
 		self.generators.append(gen)
+		self.mark_graph_changed()
+
+	# Takes a generator back out of the mixer, whether it was added as it is or
+	# wrapped in a MonoToStereo by add()
+	def remove(self, gen) :
+		for generator in self.generators:
+			if generator is gen or (isinstance(generator,MonoToStereo) and generator.generator is gen):
+				self.generators.remove(generator)
+				self.plans.pop(id(generator),None)
+				self.mark_graph_changed()
+				return
+		raise ValueError("Generator is not in the Mixer.")
 
 	def get_num_generators(self) :
 		return len(self.generators)
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		output = np.zeros(num_frames * self.num_channels)
+		output = self.get_buffer(num_frames)
+		output.fill(0)
 
 		# this calls generate() for each generator. generator must return:
 		# (signal, keep_going). If keep_going is True, it means the generator
 		# has more to generate. False means generator is done and will be
-		# removed from the list. signal must be a numpay array of length
-		# num_frames * num_channels (or less)
+		# removed from the list. signal must be a planar numpy array of
+		# num_frames frames, mono signals are added to both channels
+		generators = list(self.generators)
+		if self.executor:
+			plans = [self.get_plan(generator) for generator in generators]
+			results = list(self.executor.map(lambda plan: plan.generate(frame_id, num_frames, sample_rate), plans))
+		else:
+			results = [generator.generate(frame_id, num_frames, sample_rate) for generator in generators]
+
+		# silent generators are skipped, and finished ones (including voices whose
+		# envelope ran out, see ArithmeticGenerator) are culled
 		to_remove = []
-		for generator in self.generators:
-			(data, continue_flag) = generator.generate(frame_id, num_frames, sample_rate)
-			output += data
+		silent = True
+		for (generator,(data, continue_flag)) in zip(generators,results):
+			if not generator.is_silent():
+				output += data
+				silent = False
 			if not continue_flag:
 				to_remove.append(generator)
+		if silent:
+			self.constant = 0
 
 		# remove generators that are done
 		for generator in to_remove:
 			self.generators.remove(generator)
+			self.plans.pop(id(generator),None)
+		if to_remove:
+			self.mark_graph_changed()
 
 		return output
 
-class Panner(UnitGenerator):
-	def __init__(self,generator,pan,pan_func="Linear"):
+	# Offline alternative to parallel mode: renders time seconds of every generator in
+	# the mixer in its own process and returns the sum as one interleaved array. The
+	# generators are pickled into the worker processes, so the mixer and its
+	# generators are left untouched and have to be picklable.
+	def render_branches(self,time,sample_rate,block_size=1024,processes=None):
+		num_frames = int(round(time*sample_rate))
+		output = np.zeros((self.num_channels,num_frames), dtype=np.float32)
+		with ProcessPoolExecutor(max_workers=processes) as pool:
+			futures = [pool.submit(_render_branch,generator,num_frames,block_size,sample_rate) for generator in self.generators]
+			# summed in a fixed order so the result is the same from run to run
+			for future in futures:
+				output += future.result()
+		return interleave(output,np.empty(num_frames * self.num_channels, dtype=np.float32))
+
+	def __getstate__(self):
+		# thread pools and compiled plans are not carried over into other processes
+		state = super().__getstate__()
+		state['executor'] = None
+		state['finalizer'] = None
+		state['plans'] = {}
+		state['drives_inputs'] = False
+		return state
+
+# Speaker angles in degrees (0 is straight ahead, positive to the right) for every
+# output channel, in channel order. None marks a channel that is never panned to,
+# like the LFE channel of a 5.1 layout.
+SPEAKER_LAYOUTS = {
+	"stereo": [-30,30],
+	"quad": [-45,45,-135,135],
+	"5.1": [-30,30,0,None,-110,110],
+	"7.1": [-30,30,0,None,-90,90,-150,150],
+}
+
+# Places a mono generator at an azimuth (degrees, a number or a UnitGenerator for
+# per-sample movement) among the speakers of a layout. The signal is panned
+# between the two speakers either side of it, with the "EqualPower" (constant
+# power, sin/cos) or "Linear" (constant amplitude) law. Layouts of more than two
+# speakers wrap around the listener, two speakers form a line and azimuths past
+# either end stay at that speaker. A stereo generator into a stereo layout is
+# balanced instead: each side is turned down as the signal moves away from it.
+#
+# Every block builds a (channels, frames) gain matrix and applies it in a single
+# multiply. With a fixed azimuth the gains are worked out once, and changing the
+# azimuth ramps them to the new values over smoothing seconds instead of jumping.
+class Spatializer(UnitGenerator):
+	def __init__(self,generator,azimuth = 0,layout = "stereo",law = "EqualPower",smoothing = .005):
 		super().__init__()
+		self.set_layout(layout)
+		self.set_law(law)
+		self.smoothing = smoothing
+		self.set_generator(generator)
+		self.set_azimuth(azimuth)
 
-		self.num_channels = 2
-		self.set_pan_function(pan_func)
-		self.set_pan(pan)
-		self.set_generator(generator)		
+		# gains the last frame was played with, and where a ramp is heading
+		self.gains = None
+		self.target = None
+		self.target_key = None
+		self.ramp_left = 0
+		self.steps = np.zeros(0)
 
-	def set_pan_function(self,func):
+	def set_layout(self,layout):
+		if isinstance(layout,str):
+			if layout not in SPEAKER_LAYOUTS:
+				raise ValueError("Unknown speaker layout "+layout)
+			layout = SPEAKER_LAYOUTS[layout]
+		channels = [c for c in range(len(layout)) if layout[c] is not None]
+		if not channels:
+			raise ValueError("Speaker layout needs at least one speaker to pan to")
+		channels.sort(key=lambda c: layout[c])
+		self.layout = list(layout)
+		self.num_channels = len(layout)
+		# the speakers that can be panned to, sorted by angle
+		self.channels = np.array(channels,dtype=np.intp)
+		self.angles = np.array([layout[c] for c in channels],dtype=np.float64)
+		self.ring = len(channels) > 2
+		if self.ring:
+			self.angles = np.append(self.angles,self.angles[0]+360)
+		self.gains = None
 
-		if func == 'Linear':
-			self.pan_func = self.__linear_pan__
+	def set_law(self,law):
+		if law == "EqualPower":
+			self.law = self.equal_power
+		elif law == "Linear":
+			self.law = self.linear
+		else:
+			raise ValueError("Unknown pan law "+str(law))
+		self.law_name = law
+		self.gains = None
 
-	def set_pan(self,pan):
-		self.pan = pan
+	def set_azimuth(self,azimuth):
+		self.set_parameter('azimuth',azimuth)
 
-	def reset_pan(self):
-		self.pan = .5
+	# Gains for both speakers a fraction of the way from the first to the second
+	def equal_power(self,fraction):
+		angle = fraction*(np.pi/2)
+		return (np.cos(angle),np.sin(angle))
+
+	def linear(self,fraction):
+		return (1-fraction,fraction)
 
-	def __linear_pan__(self,frame_id,num_frames,sample_rate):
-		if isinstance(self.pan,UnitGenerator):
-			assert self.pan.num_channels == 1, "Pan modulators must be one channel signals"
-			(pan,continue_flag) = self.pan.generate(frame_id,num_frames,sample_rate)
-			pan = pan/2+.5
+	# Azimuth of every frame of this block, or a single number if it is fixed
+	def read_azimuth(self,frame_id,num_frames,sample_rate):
+		azimuth = read_signal(self.azimuth,frame_id,num_frames,sample_rate)
+		constant = signal_constant(self.azimuth)
+		return azimuth if constant is None else constant
 
+	# (channels, len(azimuth)) matrix of speaker gains
+	def get_gains(self,azimuth,balance):
+		azimuth = np.atleast_1d(np.asarray(azimuth,dtype=np.float64))
+		gains = np.zeros((self.num_channels,len(azimuth)),dtype=UnitGenerator.dtype)
+		angles = self.angles
+		channels = self.channels
+		if len(channels) == 1:
+			gains[channels[0]] = 1
+		elif not self.ring:
+			# two speakers, every frame sits between the same pair
+			fraction = np.clip((azimuth - angles[0])/(angles[1] - angles[0]),0,1)
+			(gains[channels[0]],gains[channels[1]]) = self.law(fraction)
 		else:
-			pan = self.pan
+			azimuth = np.mod(azimuth - angles[0],360) + angles[0]
+			index = np.clip(np.searchsorted(angles,azimuth,side='right') - 1,0,len(channels)-1)
+			fraction = (azimuth - angles[index])/(angles[index+1] - angles[index])
+			(first,second) = self.law(fraction)
+			frames = np.arange(len(azimuth))
+			gains[channels[index],frames] = first
+			gains[channels[(index+1) % len(channels)],frames] = second
+		if balance:
+			# full level on both sides in the middle, fading only the far side
+			gains /= self.law(.5)[0]
+			np.minimum(gains,1,out=gains)
+		return gains
 
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		azimuth = self.read_azimuth(frame_id,num_frames,sample_rate)
 		(data,continue_flag) = self.generator.generate(frame_id,num_frames,sample_rate)
+		output = self.get_buffer(num_frames)
+		if self.generator.is_silent():
+			return self.fill_constant(output,0)
 
-		if not continue_flag:
-			self.remove_generator()
-
-		if self.generator.num_channels == 2:
-			print("balancing")
-			data.resize((len(data)//2,2))
-			balance = (pan-.5)*2
-			if balance > 0:
-				balance = (1-balance,1)
-			elif balance < 0:
-				balance = (1,1-balance)
+		if self.generator.num_channels == 1:
+			balance = False
+			data = data[np.newaxis,:]
+		elif self.generator.num_channels == 2 and self.num_channels == 2:
+			balance = True
+		else:
+			raise ValueError("Cannot pan a "+str(self.generator.num_channels)+" channel generator to "+str(self.num_channels)+" channels")
+
+		if isinstance(azimuth,np.ndarray):
+			# moving source, one column of gains per frame
+			gains = self.get_gains(azimuth,balance)
+			self.gains = gains[:,-1].copy()
+			self.target = self.gains
+			self.target_key = None
+			self.ramp_left = 0
+			return np.multiply(data,gains,out=output,casting='unsafe')
+
+		# the gains only need working out again when the azimuth moves
+		if (azimuth,balance) != self.target_key or self.gains is None:
+			target = self.get_gains(azimuth,balance)[:,0].astype(UnitGenerator.dtype)
+			if self.gains is None:
+				self.gains = target
 			else:
-				balance = (1,1)
-			return (data*balance).flatten()
+				self.ramp_left = max(1,int(self.smoothing*sample_rate))
+			self.target = target
+			self.target_key = (azimuth,balance)
+		target = self.target
 
-		elif self.generator.num_channels == 1:
-			return np.stack(((1-pan)*data,pan*data),axis=1).flatten()
-		else:
-			raise ValueError("Pan for " + self.generator.num_channels + " channel not implemented")
+		if self.ramp_left == 0:
+			return np.multiply(data,target[:,np.newaxis],out=output,casting='unsafe')
 
-	def __generate__(self,frame_id,num_frames,sample_rate):
-		return self.pan_func(frame_id,num_frames,sample_rate)
+		# ramp the gains from where they are to the target, then hold the target
+		count = min(num_frames,self.ramp_left)
+		if len(self.steps) < num_frames:
+			self.steps = np.arange(1,num_frames+1,dtype=np.float64)
+		gains = np.empty((self.num_channels,num_frames))
+		gains[:] = target[:,np.newaxis]
+		step = (target - self.gains)/self.ramp_left
+		gains[:,:count] = self.gains[:,np.newaxis] + step[:,np.newaxis]*self.steps[:count]
+		self.gains = gains[:,count-1].copy()
+		self.ramp_left -= count
+		return np.multiply(data,gains,out=output,casting='unsafe')
+
+	# Stops along with the generator it pans
+	def get_continue_flag(self,sample_rate):
+		return self.generator.reused_continue_flag and super().get_continue_flag(sample_rate)
+
+# Stereo Spatializer with the position given as pan: 0 is hard left, 1 hard right.
+# A pan modulator runs from -1 (left) to 1 (right). pan_func is the pan law,
+# "Linear" or "EqualPower".
+class Panner(Spatializer):
+	def __init__(self,generator,pan,pan_func="Linear",smoothing = .005):
+		super().__init__(generator,layout="stereo",law=pan_func,smoothing=smoothing)
+		self.set_pan(pan)
+
+	def set_pan_function(self,func):
+		self.set_law(func)
+
+	def set_pan(self,pan):
+		self.set_parameter('pan',pan)
+
+	def reset_pan(self):
+		self.set_pan(.5)
+
+	def read_azimuth(self,frame_id,num_frames,sample_rate):
+		if not isinstance(self.pan,UnitGenerator):
+			return 60.0*self.pan - 30.0
+		(pan,continue_flag) = self.pan.generate(frame_id,num_frames,sample_rate)
+		if self.pan.constant is not None:
+			return 30.0*self.pan.constant
+		return 30.0*np.asarray(pan,dtype=np.float64)
 
 
 class StereoTrack(UnitGenerator):
-	def __init__(self,mixer = Mixer(),pan = .5):
+	def __init__(self,mixer = None,pan = .5):
 		
 		super().__init__()
 		self.num_channels = 2
+		if mixer is None:
+			mixer = Mixer()
 		self.mixer = mixer
 		self.panner = Panner(self.mixer,pan)
 
-	def generate(self,frame_id,num_frames,sample_rate):
-		return self.panner.generate(frame_id,num_frames,sample_rate)
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		(data,continue_flag) = self.panner.generate(frame_id,num_frames,sample_rate)
+		return data
+
+	def get_continue_flag(self,sample_rate):
+		return self.panner.reused_continue_flag
 		
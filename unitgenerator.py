@@ -3,6 +3,11 @@ import numbers
 
 class UnitGenerator(object):
 	num_generators = 0
+
+	# Sample type that all the built-in generators allocate and compute in. Change it
+	# with set_sample_dtype.
+	dtype = np.float32
+
 	def __init__(self,duration=None,frame = 0):
 		UnitGenerator.num_generators += 1
 
@@ -18,7 +23,22 @@ class UnitGenerator(object):
 
 		self.duration = duration
 
-		self.frame_id = 1
+		self.frame_id = None
+
+		self.output_buffer = None
+
+		# Set by __generate__ when every sample of the block it returned has the same
+		# value (0 for a silent block), so that generators reading it can skip work or
+		# use scalar math. The block itself is always returned in full as well.
+		self.constant = None
+
+		# Set by generators that run their inputs themselves (like a parallel Mixer),
+		# so that ExecutionPlans leave those inputs to them.
+		self.drives_inputs = False
+
+		# ExecutionPlans this generator has been compiled into (a WeakSet, made by the
+		# first one), told to re-sort when the generator changes its inputs
+		self.execution_plans = None
 
 	def __mul__(self,other):
 		return Multiply(self,other)
@@ -47,29 +67,95 @@ class UnitGenerator(object):
 	def __neg__(self):
 		return AdditiveInverse(self)
 
+	# This generator run at a control rate, see ControlRate
+	def kr(self,decimation = 64,interp = "linear"):
+		from .controlrate import ControlRate
+		return ControlRate(self,decimation,interp)
+
 	def set_frame(self, frame):
 		self.frame = frame
 
 	def set_generator(self,generator):
 		self.generator = generator
+		self.mark_graph_changed()
 
 	def remove_generator(self):
 		self.generator = None
+		self.mark_graph_changed()
+
+	# Tells the ExecutionPlans this generator is in that it changed which generators it
+	# reads from, so they re-sort their graph before the next block. Plans that do not
+	# contain it are left alone.
+	def mark_graph_changed(self):
+		if self.execution_plans:
+			for plan in list(self.execution_plans):
+				plan.invalidate()
+
+	# Sets a parameter that can be either a number or a generator. A new value only
+	# changes the graph when a generator is plugged in or taken out.
+	def set_parameter(self,name,value):
+		old = self.__dict__.get(name)
+		setattr(self,name,value)
+		if isinstance(old,UnitGenerator) or isinstance(value,UnitGenerator):
+			self.mark_graph_changed()
+
+	def __getstate__(self):
+		# compiled plans stay behind when a generator is pickled into another process
+		state = self.__dict__.copy()
+		state['execution_plans'] = None
+		return state
+
+	# Returns every UnitGenerator this one pulls data from, either stored directly as
+	# an attribute or held in a list (like Mixer.generators).
+	def get_inputs(self):
+		inputs = []
+		for value in self.__dict__.values():
+			if isinstance(value,UnitGenerator):
+				inputs.append(value)
+			elif isinstance(value,list):
+				inputs.extend(v for v in value if isinstance(v,UnitGenerator))
+		return inputs
+
+	# Output array owned by this generator that is reused from block to block. It is
+	# only reallocated when a block is bigger than any before it (shorter blocks get
+	# the front of it), so data returned from it is only valid until the next time
+	# this generator generates.
+	#
+	# Blocks are planar: a mono generator returns a (frames,) array and a generator
+	# with more channels a (channels, frames) array, with every channel contiguous.
+	# Mono blocks broadcast against multichannel ones in numpy arithmetic. Audio is
+	# only interleaved on its way out (AudioController, AudioWriter).
+	def get_buffer(self,num_frames):
+		size = num_frames*self.num_channels
+		if self.output_buffer is None or len(self.output_buffer) < size or self.output_buffer.dtype != UnitGenerator.dtype:
+			self.output_buffer = np.zeros(size,dtype=UnitGenerator.dtype)
+		if self.num_channels == 1:
+			return self.output_buffer[:size]
+		return self.output_buffer[:size].reshape(self.num_channels,num_frames)
+
+	def is_silent(self):
+		return self.constant == 0
+
+	# Fills output with value and marks the block as constant
+	def fill_constant(self,output,value):
+		output.fill(value)
+		self.constant = value
+		return output
+
+	def get_continue_flag(self,sample_rate):
+		if self.duration:
+			return self.frame/float(sample_rate) <= self.duration
+		return True
 
 	def generate(self,frame_id,num_frames,sample_rate):
 		if not (self.frame_id == frame_id) or frame_id == 2:
 
+			self.constant = None
 			data = self.__generate__(frame_id,num_frames,sample_rate)
 
 			self.frame += num_frames
-			
-			if self.duration:
-				if self.frame/float(sample_rate) > self.duration:
-					self.reused_continue_flag = False
-				else:
-					self.reused_continue_flag = True
-			else:
-				self.reused_continue_flag = True
+
+			self.reused_continue_flag = self.get_continue_flag(sample_rate)
 
 			self.reused_frame_data = data
 
@@ -77,50 +163,136 @@ class UnitGenerator(object):
 
 		return (self.reused_frame_data,self.reused_continue_flag)
 
+	# Takes the block another generator made in place of this one (an ExecutionPlan
+	# running an optimized replacement of it), as if this one had generated it
+	def adopt_block(self,source,frame_id,num_frames,sample_rate):
+		self.constant = source.constant
+		self.frame += num_frames
+		self.reused_continue_flag = source.reused_continue_flag
+		self.reused_frame_data = source.reused_frame_data
+		self.frame_id = frame_id
+		return (self.reused_frame_data,self.reused_continue_flag)
+
 	def __generate__(self,frame_id,num_frames,sample_rate):
 		# This is the internal version of the generate function. This will be defined by
 		# each specific unit generator, and 
 		raise ValueError("Did not properly set up __generate__ function on class ", self.__class__)
 
-class Add(UnitGenerator):
+def set_sample_dtype(dtype):
+	dtype = np.dtype(dtype)
+	if dtype not in (np.float32,np.float64):
+		raise ValueError("Sample type needs to be float32 or float64, not "+str(dtype))
+	UnitGenerator.dtype = dtype.type
+
+# Writes a planar block (see UnitGenerator.get_buffer) into out as interleaved
+# frames, converting to out's sample type on the way.
+def interleave(data,out):
+	if data.ndim == 1:
+		out[:] = data
+	else:
+		out.reshape(data.shape[1],data.shape[0])[:] = data.T
+	return out
+
+# Planar copy of interleaved frames, like the ones read from a wave file
+def deinterleave(data,num_channels):
+	if num_channels == 1:
+		return data
+	return data.reshape(-1,num_channels).T
+
+# Signals feeding a generator can either be other UnitGenerators or plain numbers.
+def read_signal(signal,frame_id,num_frames,sample_rate):
+	if isinstance(signal,UnitGenerator):
+		(data,continue_flag) = signal.generate(frame_id,num_frames,sample_rate)
+		return data
+	return signal
+
+def signal_channels(*signals):
+	return max([s.num_channels for s in signals if isinstance(s,UnitGenerator)],default=1)
+
+# Value every sample of the signal's current block has, or None if it varies.
+def signal_constant(signal):
+	if isinstance(signal,UnitGenerator):
+		return signal.constant
+	return signal
+
+# True when the signal's current constant value will never change again: plain
+# numbers, and generators that are constant and have stopped.
+def signal_static(signal):
+	if isinstance(signal,UnitGenerator):
+		return signal.constant is not None and signal.reused_continue_flag is False
+	return True
+
+# Arithmetic generators report themselves finished once their output is stuck at
+# silence, like an oscillator multiplied by an envelope that has finished, so that a
+# Mixer culls them.
+class ArithmeticGenerator(UnitGenerator):
+	def __init__(self):
+		super().__init__()
+		self.finished = False
+
+	def get_continue_flag(self,sample_rate):
+		return not self.finished and super().get_continue_flag(sample_rate)
+
+class Add(ArithmeticGenerator):
 	def __init__(self,sig1,sig2):
 		super().__init__()
 		assert isinstance(sig1,UnitGenerator) or isinstance(sig1,numbers.Real)
 		assert isinstance(sig2,UnitGenerator) or isinstance(sig2,numbers.Real)
 		self.sig1 = sig1
 		self.sig2 = sig2
+		self.num_channels = signal_channels(sig1,sig2)
 
 	def __generate__(self, frame_id,num_frames,sample_rate):
-		if isinstance(self.sig1,UnitGenerator):
-			[frame_data1, continue_flag1] = self.sig1.generate(frame_id,num_frames,sample_rate)
-		else:
-			frame_data1 = self.sig1
-		if isinstance(self.sig2,UnitGenerator):
-			[frame_data2, continue_flag2] = self.sig2.generate(frame_id,num_frames,sample_rate)
-		else:
-			frame_data2 = self.sig2
-
-		return frame_data1 + frame_data2
-
-class Multiply(UnitGenerator):
+		frame_data1 = read_signal(self.sig1,frame_id,num_frames,sample_rate)
+		frame_data2 = read_signal(self.sig2,frame_id,num_frames,sample_rate)
+		output = self.get_buffer(num_frames)
+		constant1 = signal_constant(self.sig1)
+		constant2 = signal_constant(self.sig2)
+		if constant1 is not None and constant2 is not None:
+			self.fill_constant(output,constant1+constant2)
+			self.finished = self.constant == 0 and signal_static(self.sig1) and signal_static(self.sig2)
+			return output
+		self.finished = False
+		if constant1 == 0:
+			output[:] = frame_data2
+			return output
+		if constant2 == 0:
+			output[:] = frame_data1
+			return output
+		if constant1 is not None:
+			frame_data1 = constant1
+		if constant2 is not None:
+			frame_data2 = constant2
+		return np.add(frame_data1,frame_data2,out=output)
+
+class Multiply(ArithmeticGenerator):
 	def __init__(self,sig1,sig2):
 		super().__init__()
 		assert isinstance(sig1,UnitGenerator) or isinstance(sig1,numbers.Real)
 		assert isinstance(sig2,UnitGenerator) or isinstance(sig2,numbers.Real)
 		self.sig1 = sig1
 		self.sig2 = sig2
+		self.num_channels = signal_channels(sig1,sig2)
 
 	def __generate__(self, frame_id,num_frames,sample_rate):
-		if isinstance(self.sig1,UnitGenerator):
-			[frame_data1, continue_flag1] = self.sig1.generate(frame_id,num_frames,sample_rate)
-		else:
-			frame_data1 = self.sig1
-		if isinstance(self.sig2,UnitGenerator):
-			[frame_data2, continue_flag2] = self.sig2.generate(frame_id,num_frames,sample_rate)
-		else:
-			frame_data2 = self.sig2
-
-		return frame_data1 * frame_data2
+		frame_data1 = read_signal(self.sig1,frame_id,num_frames,sample_rate)
+		frame_data2 = read_signal(self.sig2,frame_id,num_frames,sample_rate)
+		output = self.get_buffer(num_frames)
+		constant1 = signal_constant(self.sig1)
+		constant2 = signal_constant(self.sig2)
+		# anything times a silent block is silent, for good if the silence is
+		if constant1 == 0 or constant2 == 0:
+			self.fill_constant(output,0)
+			self.finished = (constant1 == 0 and signal_static(self.sig1)) or (constant2 == 0 and signal_static(self.sig2))
+			return output
+		self.finished = False
+		if constant1 is not None and constant2 is not None:
+			return self.fill_constant(output,constant1*constant2)
+		if constant1 is not None:
+			frame_data1 = constant1
+		if constant2 is not None:
+			frame_data2 = constant2
+		return np.multiply(frame_data1,frame_data2,out=output)
 
 class Scale(UnitGenerator):
 	def __init__(self,generator,out_range):
@@ -130,38 +302,96 @@ class Scale(UnitGenerator):
 		offset = (in_range[1]+in_range[0]+out_range[1]+out_range[0])/2
 
 		self.generator = generator/multiplier+offset
+		self.num_channels = generator.num_channels
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
 		(data,continue_flag) = self.generator.generate(frame_id,num_frames,sample_rate)
+		self.constant = self.generator.constant
 		return data
 
 class AdditiveInverse(UnitGenerator):
 	def __init__(self,generator):
 		super().__init__()
 		self.generator = generator
+		self.num_channels = signal_channels(generator)
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		if isinstance(self.generator,UnitGenerator):
-			data,continue_flag = self.generator.generate(frame_id,num_frames,sample_rate)
-			return -data
-		else:
-			return -self.generator
+		data = read_signal(self.generator,frame_id,num_frames,sample_rate)
+		constant = signal_constant(self.generator)
+		if constant is not None:
+			return self.fill_constant(self.get_buffer(num_frames),-constant)
+		return np.negative(data,out=self.get_buffer(num_frames))
 
 class MultiplicativeInverse(UnitGenerator):
 	def __init__(self,generator):
 		super().__init__()
 		self.generator = generator
+		self.num_channels = signal_channels(generator)
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		if isinstance(self.generator,UnitGenerator):
-			data,continue_flag = self.generator.generate(frame_id,num_frames,sample_rate)
-			return 1/data
-		else:
-			return 1/self.generator
+		data = read_signal(self.generator,frame_id,num_frames,sample_rate)
+		constant = signal_constant(self.generator)
+		if constant is not None:
+			return self.fill_constant(self.get_buffer(num_frames),np.divide(1,constant))
+		return np.divide(1,data,out=self.get_buffer(num_frames))
 
 class ZeroGen(UnitGenerator):
 	def __init__(self):
 		super().__init__()
 
 	def __generate__(self,frame_id,num_frames,sample_rate):
-		return np.zeros(num_frames)
\ No newline at end of file
+		return self.fill_constant(self.get_buffer(num_frames),0)
+
+# A chain of elementwise operations fused into a single generator. The base signal is
+# written into one output buffer and then every (ufunc, operand) pair is applied to
+# it in place, so a chain like (osc*0.5+env)/2 costs one buffer and one Python frame
+# instead of a temporary array and a generate call per operation. Unary ufuncs (like
+# np.reciprocal) have None as their operand. Built by graph.optimize.
+class Expression(ArithmeticGenerator):
+	def __init__(self,base,ufuncs,operands):
+		super().__init__()
+		assert len(ufuncs) == len(operands)
+		self.base = base
+		self.ufuncs = list(ufuncs)
+		self.operands = list(operands)
+		self.num_channels = signal_channels(base,*self.operands)
+
+	def __generate__(self,frame_id,num_frames,sample_rate):
+		output = self.get_buffer(num_frames)
+		data = read_signal(self.base,frame_id,num_frames,sample_rate)
+		operands = [read_signal(operand,frame_id,num_frames,sample_rate) if operand is not None else None for operand in self.operands]
+
+		# Work out with scalars whether the whole chain comes out constant. A
+		# multiplication by a silent block is silent whatever came before it.
+		value = signal_constant(self.base)
+		static = signal_static(self.base)
+		for (ufunc,operand) in zip(self.ufuncs,self.operands):
+			if operand is None:
+				if value is not None:
+					value = ufunc(value)
+				continue
+			constant = signal_constant(operand)
+			if ufunc is np.multiply and constant == 0:
+				(value,static) = (0,signal_static(operand))
+			elif value is not None and constant is not None:
+				value = ufunc(value,constant)
+				static = static and signal_static(operand)
+			else:
+				value = None
+		if value is not None:
+			self.fill_constant(output,value)
+			self.finished = static and self.constant == 0
+			return output
+		self.finished = False
+
+		if not self.ufuncs:
+			output[:] = data
+			return output
+		for (ufunc,operand,operand_data) in zip(self.ufuncs,self.operands,operands):
+			if operand is None:
+				ufunc(data,out=output)
+			else:
+				constant = signal_constant(operand)
+				ufunc(data,operand_data if constant is None else constant,out=output)
+			data = output
+		return output
@@ -1,6 +1,9 @@
 import wave
+import threading
 import numpy as np
-from .unitgenerator import UnitGenerator
+from .unitgenerator import UnitGenerator, deinterleave
+from .realtime import RingBuffer
+from .graph import ExecutionPlan
 
 # Simple call to get_frames() to get data in format we like (numpy array, float32)
 class WaveFile(object):
@@ -23,7 +26,7 @@ class WaveFile(object):
         raw_bytes = self.wave.readframes(end_frame - start_frame)
 
         # convert raw data to numpy array, assuming int16 arrangement
-        samples = np.fromstring(raw_bytes, dtype = np.int16)
+        samples = np.frombuffer(raw_bytes, dtype = np.int16)
 
         # convert from integer type to floating point, and scale to [-1, 1]
         samples = samples.astype(np.float32)
@@ -34,6 +37,105 @@ class WaveFile(object):
     def get_num_channels(self):
         return self.num_channels
 
+
+# WaveSource that memory maps the data chunk of a wave file instead of reading it.
+# get_raw_frames() hands out views straight into the mapping (no copy), and
+# get_frames() only converts the requested frames to float. Any sample rate,
+# channel count and 8/16/24/32 bit integer or 32/64 bit float data is accepted.
+# Since the data lives in the OS page cache, processes playing the same file share
+# one copy of it and jumping around a large file only touches the pages it reads.
+class MappedWaveFile(object):
+    def __init__(self, filepath):
+        super(MappedWaveFile, self).__init__()
+
+        self.filepath = filepath
+        (fmt, data_offset, data_size) = self._read_chunks(filepath)
+        (format_tag, self.num_channels, self.sr, self.sampwidth) = fmt
+
+        frame_size = self.num_channels * self.sampwidth
+        self.end = data_size // frame_size
+
+        if format_tag == 3 and self.sampwidth in (4, 8):
+            dtype = np.float32 if self.sampwidth == 4 else np.float64
+            self.scale = 1.0
+        elif format_tag == 1 and self.sampwidth in (1, 2, 3, 4):
+            dtype = {1: np.uint8, 2: np.int16, 3: np.uint8, 4: np.int32}[self.sampwidth]
+            self.scale = 1.0 / 2**(8*self.sampwidth - 1)
+        else:
+            raise ValueError("Unsupported wave format %d with %d byte samples in %s" % (format_tag, self.sampwidth, filepath))
+
+        # 24 bit samples have no numpy type, so they are mapped as their raw bytes
+        if self.sampwidth == 3:
+            shape = (self.end, self.num_channels, 3)
+        else:
+            shape = (self.end, self.num_channels)
+
+        if self.end > 0:
+            self.raw = np.memmap(filepath, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+        else:
+            self.raw = np.zeros(shape, dtype=dtype)
+
+    @staticmethod
+    def _read_chunks(filepath):
+        fmt = None
+        data = None
+        with open(filepath, 'rb') as f:
+            header = f.read(12)
+            if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+                raise ValueError(filepath + " is not a RIFF wave file")
+            file_size = f.seek(0, 2)
+            position = 12
+            while position + 8 <= file_size and (fmt is None or data is None):
+                f.seek(position)
+                chunk_header = f.read(8)
+                chunk_id = chunk_header[0:4]
+                chunk_size = int.from_bytes(chunk_header[4:8], 'little')
+                if chunk_id == b'fmt ':
+                    chunk = f.read(chunk_size)
+                    format_tag = int.from_bytes(chunk[0:2], 'little')
+                    num_channels = int.from_bytes(chunk[2:4], 'little')
+                    sample_rate = int.from_bytes(chunk[4:8], 'little')
+                    bits = int.from_bytes(chunk[14:16], 'little')
+                    # WAVE_FORMAT_EXTENSIBLE keeps the real format at the start of the sub format GUID
+                    if format_tag == 0xFFFE and len(chunk) >= 26:
+                        format_tag = int.from_bytes(chunk[24:26], 'little')
+                    fmt = (format_tag, num_channels, sample_rate, (bits + 7) // 8)
+                elif chunk_id == b'data':
+                    # don't trust the size of a data chunk in a truncated file
+                    data = (position + 8, min(chunk_size, file_size - position - 8))
+                # chunks are padded to an even number of bytes
+                position += 8 + chunk_size + (chunk_size & 1)
+        if fmt is None or data is None:
+            raise ValueError(filepath + " is missing its fmt or data chunk")
+        return (fmt, data[0], data[1])
+
+    # Frames start_frame up to end_frame as a view of the file's own samples, shaped
+    # (frames, channels), or (frames, channels, 3) bytes for 24 bit files
+    def get_raw_frames(self, start_frame, end_frame):
+        return self.raw[start_frame:end_frame]
+
+    # Same as WaveFile.get_frames: interleaved float32 samples scaled to [-1, 1]
+    def get_frames(self, start_frame, end_frame):
+        raw = self.raw[max(start_frame, 0):max(end_frame, 0)]
+        if self.sampwidth == 3:
+            samples = np.empty(raw.shape[:2], dtype=np.int32)
+            np.copyto(samples, raw[..., 2].view(np.int8), casting='unsafe')
+            samples <<= 8
+            samples |= raw[..., 1]
+            samples <<= 8
+            samples |= raw[..., 0]
+            samples = samples.astype(np.float32)
+        else:
+            samples = raw.astype(np.float32)
+            if self.sampwidth == 1:
+                samples -= 128
+        if self.scale != 1.0:
+            samples *= self.scale
+        return samples.reshape(-1)
+
+    def get_num_channels(self):
+        return self.num_channels
+
         # generates audio data by asking an audio-source (ie, WaveFile) for that data.
 class WaveGenerator(UnitGenerator):
     def __init__(self, wave_source, loop=False):
@@ -43,10 +145,14 @@ class WaveGenerator(UnitGenerator):
         self.loop = loop
         self.paused = False
         self._release = False
+        # read position in the source, in frames
+        self.position = 0
+        self.finished = False
 
     def reset(self):
         self.paused = True
-        self.frame = 0
+        self.position = 0
+        self.finished = False
 
     def play_toggle(self):
         self.paused = not self.paused
@@ -66,73 +172,370 @@ class WaveGenerator(UnitGenerator):
     def get_gain(self):
         return self.gain
 
+    def get_continue_flag(self, sample_rate):
+        return not self.finished and super(WaveGenerator, self).get_continue_flag(sample_rate)
+
     def  __generate__(self, frame_id,num_frames,sample_rate):
-        if self.paused:
-            output = np.zeros(num_frames * self.source.num_channels)
-            return (output, True)
+        output = self.get_buffer(num_frames)
+        if self.paused or self.finished:
+            return self.fill_constant(output, 0)
+
+        # get data based on our position and requested # of frames. Sources hand out
+        # interleaved frames, the way they are stored in the file.
+        filled = 0
+        while filled < num_frames:
+            data = self.source.get_frames(self.position, self.position + num_frames - filled)
+            count = len(data) // self.num_channels
+            output[..., filled:filled+count] = deinterleave(data, self.num_channels)
+            filled += count
+            self.position += count
 
-        else:
-            # get data based on our position and requested # of frames
-            output = self.source.get_frames(self.frame, self.frame + num_frames)
             # check for end-of-buffer condition:
-            actual_num_frames = int(len(output) / self.num_channels)
+            if filled < num_frames:
+                # looping. If we got to the end of the buffer, don't actually end.
+                # Instead, read some more from the beginning
+                if self.loop and self.position > 0:
+                    self.position = 0
+                else:
+                    # zero-pad, the source has run out
+                    output[..., filled:] = 0
+                    self.finished = True
+                    break
 
+        return output
 
-            # looping. If we got to the end of the buffer, don't actually end.
-            # Instead, read some more from the beginning
 
-            shortfall = num_frames * self.num_channels - len(output)
-            if self.loop and not shortfall>0:
-                remainder = num_frames - actual_num_frames
-                output = np.append(output, self.source.get_frames(0, remainder))
-                self.frame = remainder
 
-            # zero-pad if output is too short (may happen if not looping / end of buffer)
-            shortfall = num_frames * self.num_channels - len(output)
-            if shortfall > 0:
-                output = np.append(output, np.zeros(shortfall))
-                self.frame=0
-
-            # return
+# Plays a WaveSource back at a different speed (which also shifts its pitch). speed
+# can be a number or a UnitGenerator for audio rate modulation. The fractional read
+# position is carried over from block to block, so there are no clicks at block
+# edges. All channels are resampled together.
+#
+# mode "linear" interpolates between neighbouring frames. mode "sinc" uses a
+# polyphase windowed-sinc kernel of `taps` points, picked from `phases` precomputed
+# fractional offsets, which is slower but much cleaner. The kernel is not widened
+# for speeds above 1, so squashing a file a long way down still aliases.
+class Resampler(UnitGenerator):
+    kernels = {}
+
+    def __init__(self, source, speed=1.0, mode="linear", loop=False, taps=16, phases=256):
+        super(Resampler, self).__init__()
+        self.source = source
+        self.num_channels = source.get_num_channels()
+        self.length = source.end
+        self.loop = loop
+        self.position = 0.0
+        self.set_speed(speed)
+        self.set_mode(mode, taps, phases)
+
+    def set_speed(self, speed):
+        self.set_parameter('speed', speed)
+
+    def set_mode(self, mode, taps=16, phases=256):
+        if mode == "linear":
+            self.taps = 2
+            self.kernel = None
+        elif mode == "sinc":
+            if taps < 2 or taps % 2:
+                raise ValueError("Resampler needs an even number of sinc taps")
+            self.taps = taps
+            self.kernel = Resampler.get_kernel(taps, phases)
+        else:
+            raise ValueError("Unknown Resampler mode " + str(mode))
+        self.mode = mode
+
+    def reset(self, position=0.0):
+        self.position = float(position)
+
+    # Blackman windowed sinc, one row of taps weights per fractional offset (plus an
+    # extra row for an offset of a whole frame). Shared between all Resamplers.
+    @classmethod
+    def get_kernel(cls, taps, phases):
+        key = (taps, phases)
+        if key not in cls.kernels:
+            offsets = np.arange(phases + 1)[:, np.newaxis] / float(phases)
+            t = np.arange(taps)[np.newaxis, :] - (taps // 2 - 1) - offsets
+            window = 0.42 + 0.5*np.cos(np.pi*t/(taps//2)) + 0.08*np.cos(2*np.pi*t/(taps//2))
+            kernel = np.sinc(t) * window
+            kernel /= kernel.sum(axis=1, keepdims=True)
+            cls.kernels[key] = kernel.astype(np.float32)
+        return cls.kernels[key]
+
+    # Frames start_frame up to end_frame of the source as a (frames, channels) array,
+    # wrapping around when looping and padded with silence otherwise.
+    def read_frames(self, start_frame, end_frame):
+        output = np.zeros((end_frame - start_frame, self.num_channels), dtype=np.float32)
+        if self.length == 0:
+            return output
+        frame = start_frame
+        while frame < end_frame:
+            if self.loop:
+                offset = frame % self.length
+                count = min(end_frame - frame, self.length - offset)
+            elif frame < 0:
+                count = min(end_frame, 0) - frame
+                frame += count
+                continue
+            elif frame >= self.length:
+                break
+            else:
+                offset = frame
+                count = min(end_frame, self.length) - frame
+            data = self.source.get_frames(offset, offset + count)
+            output[frame - start_frame:frame - start_frame + len(data)//self.num_channels] = data.reshape(-1, self.num_channels)
+            frame += count
+        return output
+
+    def __generate__(self, frame_id, num_frames, sample_rate):
+        output = self.get_buffer(num_frames)
+        if num_frames == 0:
             return output
 
-
-
-class SpeedModulator(object):
-    def __init__(self, generator, speed = 1.0):
+        # read position of every output frame
+        if isinstance(self.speed, UnitGenerator):
+            (speed, continue_flag) = self.speed.generate(frame_id, num_frames, sample_rate)
+            steps = np.cumsum(speed, dtype=np.float64)
+            positions = np.empty(num_frames)
+            positions[0] = self.position
+            positions[1:] = self.position + steps[:-1]
+            self.position += steps[-1]
+        else:
+            positions = self.position + self.speed*np.arange(num_frames)
+            self.position += self.speed*num_frames
+        if self.loop and self.length > 0:
+            self.position %= self.length
+
+        # source frames needed to interpolate every one of those positions
+        whole = np.floor(positions)
+        fraction = positions - whole
+        first = int(whole.min()) - (self.taps//2 - 1)
+        last = int(whole.max()) + self.taps//2 + 1
+        data = self.read_frames(first, last)
+        index = whole.astype(np.intp) - first - (self.taps//2 - 1)
+
+        # (frames, channels) view of the planar output
+        frames = output.reshape(self.num_channels, num_frames).T
+        if self.kernel is None:
+            start = data[index]
+            np.subtract(data[index + 1], start, out=frames)
+            frames *= fraction[:, np.newaxis]
+            frames += start
+        else:
+            phases = len(self.kernel) - 1
+            weights = self.kernel[np.rint(fraction*phases).astype(np.intp)]
+            window = data[index[:, np.newaxis] + np.arange(self.taps)]
+            np.einsum('nt,ntc->nc', weights, window, out=frames, casting='same_kind')
+        return output
+
+    def get_continue_flag(self, sample_rate):
+        if not self.loop and self.position >= self.length:
+            return False
+        return super(Resampler, self).get_continue_flag(sample_rate)
+
+# Plays any generator back at speed by asking it for more (or fewer) frames every
+# block and stretching them to the block size, the way it has always done. Each
+# block is stretched on its own, so it is rough around block edges; use a Resampler
+# to change the speed of a WaveSource. The wrapped generator runs in its own
+# ExecutionPlan, so it should not be read from anywhere else.
+class SpeedModulator(UnitGenerator):
+    def __init__(self, generator, speed=1.0):
         super(SpeedModulator, self).__init__()
-        self.generator = generator
+        self.set_generator(generator)
+        self.num_channels = generator.num_channels
         self.speed = speed
+        self.drives_inputs = True
+        self.generator_continue = True
 
-    def set_speed(self, speed) :
+    def set_generator(self, generator):
+        super(SpeedModulator, self).set_generator(generator)
+        self.plan = ExecutionPlan(generator)
+
+    def set_speed(self, speed):
         self.speed = speed
 
-    def generate(self, num_frames, num_channels) :
-        # optimization if speed is 1.0
-        if self.speed == 1.0:
-            return self.generator.generate(num_frames, num_channels)
+    def get_continue_flag(self, sample_rate):
+        return self.generator_continue and super(SpeedModulator, self).get_continue_flag(sample_rate)
+
+    def __generate__(self, frame_id, num_frames, sample_rate):
+        adj_frames = max(1, int(round(num_frames * self.speed)))
+        (data, self.generator_continue) = self.plan.generate(frame_id, adj_frames, sample_rate)
+        output = self.get_buffer(num_frames)
+        if self.generator.constant is not None:
+            return self.fill_constant(output, self.generator.constant)
+        if adj_frames == num_frames:
+            output[:] = data
+            return output
 
-        # otherwise, we need to ask self.generator for a number of frames that is
-        # larger or smaller than num_frames, depending on self.speed
-        adj_frames = int(round(num_frames * self.speed))
+        # stretch or squash the data to fit exactly into num_frames
+        from_range = np.arange(adj_frames)
+        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
+        planar = output.reshape(self.num_channels, num_frames)
+        for (n, channel) in enumerate(np.reshape(data, (self.num_channels, adj_frames))):
+            planar[n] = np.interp(to_range, from_range, channel)
+        return output
 
-        # get data from generator
-        data, continue_flag = self.generator.generate(adj_frames, num_channels)
 
-        # split into multi-channels:
-        data_chans = [ data[n::num_channels] for n in range(num_channels) ]
+# WaveSource that streams a long file from disk. A background thread reads ahead of
+# the playback position into a ring buffer holding preroll_frames frames, in reads
+# of chunk_frames frames, so get_frames() never has to wait for the disk. With loop
+# set the thread carries on from the start of the file when it reaches the end.
+#
+# Reading from anywhere other than where the last read left off is a seek: the
+# thread is sent to the new position, and until it has caught up get_frames()
+# returns silence and counts an underrun instead of blocking. The same happens if
+# the thread falls behind. wait_ready() waits for the thread to fill the ring
+# buffer for the current position (or read up to the end of the file), so playback
+# started after it does not begin with silence; ready tells whether it has.
+class StreamingWaveSource(object):
+    def __init__(self, source, preroll_frames=44100, chunk_frames=4096, loop=False):
+        super(StreamingWaveSource, self).__init__()
+        self.source = source
+        self.num_channels = source.get_num_channels()
+        self.end = source.end
+        self.loop = loop
+        self.chunk_frames = chunk_frames
+        self.ring = RingBuffer(max(preroll_frames, 2*chunk_frames) * self.num_channels)
+        self.scratch = np.zeros(chunk_frames * self.num_channels, dtype=np.float32)
+        self.underruns = 0
+
+        # Seeks are requests to the reader thread: bump generation with the new
+        # seek_position. The thread answers in acknowledged with (generation, ring
+        # write count, file position) for where the data for that seek starts.
+        self.generation = 0
+        self.seek_position = 0
+        self.acknowledged = (None, 0, 0)
+        # the last generation the thread filled the ring buffer for
+        self.filled_generation = None
+        self.filled = threading.Condition()
+
+        # playback side: the generation being played, the file position of the next
+        # frame in the ring buffer and the position the next read should start at
+        self.current = None
+        self.head_position = 0
+        self.read_position = 0
+
+        self.wakeup = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.read_loop, name="ocelot wave streamer", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        with self.filled:
+            self.filled.notify_all()
 
-        # stretch or squash data to fit exactly into num_frames
-        from_range = np.arange(adj_frames)
-        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
-        resampled = [ np.interp(to_range, from_range, data_chans[n]) for n in range(num_channels) ]
+    def get_num_channels(self):
+        return self.num_channels
 
-        # convert back by interleaving into a single buffer
-        output = np.empty(num_channels * num_frames, dtype=np.float32)
-        for n in range(num_channels) :
-            output[n::num_channels] = resampled[n]
+    @property
+    def ready(self):
+        return self.filled_generation == self.generation
+
+    # Blocks until the preroll is buffered, returns False if timeout seconds passed
+    # (or the source was closed) first
+    def wait_ready(self, timeout=None):
+        with self.filled:
+            return self.filled.wait_for(lambda: self.ready or not self.running, timeout) and self.ready
+
+    def read_loop(self):
+        generation = None
+        position = 0
+        while self.running:
+            if generation != self.generation:
+                generation = self.generation
+                position = self.seek_position
+                self.acknowledged = (generation, self.ring.write_count, position)
+
+            done = not self.loop and position >= self.end
+            if done or self.ring.get_write_available() < self.chunk_frames * self.num_channels:
+                if self.filled_generation != generation:
+                    with self.filled:
+                        self.filled_generation = generation
+                        self.filled.notify_all()
+                self.wakeup.wait(0.01)
+                self.wakeup.clear()
+                continue
+
+            count = min(self.chunk_frames, self.end - position)
+            data = self.source.get_frames(position, position + count)
+            # throw the chunk away if there was a seek while it was being read
+            if generation != self.generation:
+                continue
+            self.ring.write(data)
+            position += count
+            if self.loop and position >= self.end:
+                position = 0
+
+    def seek(self, frame):
+        self.read_position = frame
+        self.seek_position = frame
+        self.generation += 1
+        # everything buffered so far is for the old position, make room for the new one
+        self.discard(self.ring.get_read_available() // self.num_channels)
+        self.wakeup.set()
+
+    # Drops up to num_frames frames from the ring buffer, returns how many were dropped
+    def discard(self, num_frames):
+        dropped = 0
+        while dropped < num_frames:
+            count = min(num_frames - dropped, self.chunk_frames)
+            count = self.ring.read(self.scratch[:count * self.num_channels]) // self.num_channels
+            if count == 0:
+                break
+            dropped += count
+        return dropped
+
+    def advance_head(self, num_frames):
+        self.head_position += num_frames
+        if self.loop and self.head_position >= self.end:
+            self.head_position -= self.end
+
+    def get_frames(self, start_frame, end_frame):
+        # a looping reader picks up from the start of the file right after the end
+        if self.loop and self.read_position >= self.end and start_frame == 0:
+            self.read_position = 0
+        if start_frame != self.read_position:
+            self.seek(start_frame)
+
+        # like WaveFile, reads stop short at the end of the file
+        end_frame = min(end_frame, self.end)
+        num_frames = max(end_frame - start_frame, 0)
+        output = np.zeros(num_frames * self.num_channels, dtype=np.float32)
+        self.read_position += num_frames
+
+        (generation, ring_start, position) = self.acknowledged
+        if generation != self.generation:
+            # the reader thread has not got to the last seek yet, move the seek along
+            # with playback so the thread starts where it will be needed
+            self.seek_position = self.read_position
+            self.underruns += 1
+            return output
+        if self.current != generation:
+            # drop whatever was buffered before the seek
+            self.discard((ring_start - self.ring.read_count) // self.num_channels)
+            self.current = generation
+            self.head_position = position
+
+        # catch up with frames that were skipped over by earlier underruns
+        behind = start_frame - self.head_position
+        if self.loop and self.end > 0:
+            behind %= self.end
+        dropped = self.discard(behind)
+        self.advance_head(dropped)
+        if dropped < behind:
+            # too far behind to catch up by dropping frames, send the reader ahead
+            self.underruns += 1
+            self.seek(self.read_position)
+            return output
 
-        return (output, continue_flag)
+        count = self.ring.read(output) // self.num_channels
+        self.advance_head(count)
+        if count < num_frames:
+            self.underruns += 1
+        self.wakeup.set()
+        return output
 
 
 # We can generalize the thing that WaveFile does - it provides arbitrary wave
@@ -142,15 +545,17 @@ class SpeedModulator(object):
 # get_frames(self, start_frame, end_frame)
 #
 # Now create WaveBuffer. Same WaveSource interface, but can take a subset of
-# audio data from a wave file and holds all that data in memory.
+# audio data from a wave file and holds all that data in memory. The data comes
+# from a SampleCache (the shared samplecache.sample_cache unless another one is
+# given), so every WaveBuffer of the same region shares one read-only copy.
 class WaveBuffer(object):
-    def __init__(self, filepath, start_frame, num_frames):
+    def __init__(self, filepath, start_frame, num_frames, cache=None):
         super(WaveBuffer, self).__init__()
 
-        # get a local copy of the audio data from WaveFile
-        wr = WaveFile(filepath)
-        self.data = wr.get_frames(start_frame, start_frame + num_frames)
-        self.num_channels = wr.get_num_channels()
+        if cache is None:
+            from .samplecache import sample_cache as cache
+        self.data, self.num_channels = cache.get(filepath, start_frame, num_frames)
+        self.end = len(self.data) // self.num_channels
 
     # start and end args are in units of frames,
     # so take into account num_channels when accessing sample data